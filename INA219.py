@@ -18,6 +18,10 @@ _REG_CURRENT                = 0x04
 # CALIBRATION REGISTER (R/W)
 _REG_CALIBRATION            = 0x05
 
+# Bus voltage register flags
+_CNVR                       = 0x02      # conversion ready
+_OVF                        = 0x01      # math overflow
+
 class BusVoltageRange:
     """Constants for ``bus_voltage_range``"""
     RANGE_16V               = 0x00      # set bus voltage range to 16V
@@ -44,6 +48,10 @@ class ADCResolution:
     ADCRES_12BIT_64S        = 0x0E      # 12bit,  64 samples, 34.05ms
     ADCRES_12BIT_128S       = 0x0F      # 12bit, 128 samples, 68.10ms
 
+# Conversion time in seconds of each ``ADCResolution``
+_CONVERSION_TIME = {0x00: 0.000084, 0x01: 0.000148, 0x02: 0.000276, 0x03: 0.000532, 0x09: 0.00106, 0x0A: 0.00213,
+                    0x0B: 0.00426, 0x0C: 0.00851, 0x0D: 0.01702, 0x0E: 0.03405, 0x0F: 0.0681}
+
 class Mode:
     """Constants for ``mode``"""
     POWERDOW                = 0x00      # power down
@@ -56,10 +64,27 @@ class Mode:
     SANDBVOLT_CONTINUOUS    = 0x07      # shunt and bus voltage continuous
 
 
+class Snapshot:
+    """All readings of one conversion"""
+    __slots__ = ('time', 'bus_voltage_V', 'shunt_voltage_mV', 'current_mA', 'power_W', 'overflow', 'transactions')
+
+    def __init__(self, time, bus_voltage_V, shunt_voltage_mV, current_mA, power_W, overflow, transactions):
+        self.time = time                            # time.monotonic() of the reading
+        self.bus_voltage_V = bus_voltage_V          # voltage on V- (load side)
+        self.shunt_voltage_mV = shunt_voltage_mV    # voltage between V+ and V- across the shunt
+        self.current_mA = current_mA
+        self.power_W = power_W
+        self.overflow = overflow                    # current or power out of range
+        self.transactions = transactions            # I2C transactions it took
+
 class INA219:
     def __init__(self, i2c_bus=1, addr=0x40):
-        self.bus = smbus.SMBus(i2c_bus)
+        # Either the number of an I2C bus or an object with the smbus.SMBus interface
+        self.bus = smbus.SMBus(i2c_bus) if isinstance(i2c_bus, int) else i2c_bus
         self.addr = addr
+        self.transactions = 0
+        self.resets = 0
+        self._snapshot = None
 
         # Set chip to known config values to start
         self._cal_value = 0
@@ -68,10 +93,12 @@ class INA219:
         self.set_calibration_32V_2A()
 
     def read(self,address):
+        self.transactions += 1
         data = self.bus.read_i2c_block_data(self.addr, address, 2)
         return ((data[0] * 256 ) + data[1])
 
     def write(self,address,data):
+        self.transactions += 1
         temp = [0,0]
         temp[1] = data & 0xFF
         temp[0] =(data & 0xFF00) >> 8
@@ -153,9 +180,15 @@ class INA219:
         # Set Config register to take into account the settings above
         self.bus_voltage_range = BusVoltageRange.RANGE_32V
         self.gain = Gain.DIV_8_320MV
-        self.bus_adc_resolution = ADCResolution.ADCRES_12BIT_32S
-        self.shunt_adc_resolution = ADCResolution.ADCRES_12BIT_32S
-        self.mode = Mode.SANDBVOLT_CONTINUOUS
+        self.set_sampling(Mode.SANDBVOLT_CONTINUOUS, ADCResolution.ADCRES_12BIT_32S)
+
+    def set_sampling(self, mode, adc_resolution):
+        """Sets the operating mode and the ADC resolution or averaging of both channels.
+           In a triggered mode read_snapshot() starts every conversion.
+        """
+        self.bus_adc_resolution = adc_resolution
+        self.shunt_adc_resolution = adc_resolution
+        self.mode = mode
         self.config = self.bus_voltage_range << 13 | \
                       self.gain << 11 | \
                       self.bus_adc_resolution << 7 | \
@@ -163,6 +196,67 @@ class INA219:
                       self.mode
         self.write(_REG_CONFIG,self.config)
 
+    def read_snapshot(self, retries=3):
+        """Reads bus voltage, shunt voltage, current and power of the same conversion.
+
+           Calibration is only written again when the chip has lost it. In
+           continuous mode the previous snapshot is returned while no new
+           conversion has completed.
+        """
+        start = self.transactions
+        triggered = Mode.POWERDOW < self.mode < Mode.ADCOFF
+        conversion_time = _CONVERSION_TIME[self.bus_adc_resolution] + _CONVERSION_TIME[self.shunt_adc_resolution]
+        reuse = self._snapshot is not None and not triggered
+        for _ in range(retries):
+            if triggered:
+                # Writing the config starts a conversion
+                self.write(_REG_CONFIG, self.config)
+                time.sleep(conversion_time)
+
+            bus = self.read(_REG_BUSVOLTAGE)
+            if not bus & _CNVR:
+                if reuse:
+                    return self._snapshot
+                # Wait for the first conversion or for the triggered one to complete
+                polls = 8
+                while not bus & _CNVR and polls > 0:
+                    time.sleep(conversion_time / 4)
+                    bus = self.read(_REG_BUSVOLTAGE)
+                    polls -= 1
+                if not bus & _CNVR:
+                    continue
+
+            shunt = self._signed(self.read(_REG_SHUNTVOLTAGE))
+            current = self._signed(self.read(_REG_CURRENT))
+            # Reading power clears the conversion ready flag
+            power = self._signed(self.read(_REG_POWER))
+
+            if current == 0 and power == 0 and shunt != 0 and self.read(_REG_CALIBRATION) != self._cal_value:
+                # The chip was reset and lost calibration and config
+                self.resets += 1
+                self.write(_REG_CALIBRATION, self._cal_value)
+                self.write(_REG_CONFIG, self.config)
+                reuse = False
+                continue
+
+            if not triggered and self.read(_REG_BUSVOLTAGE) & _CNVR:
+                # Another conversion completed while the registers were read
+                continue
+
+            self._snapshot = Snapshot(time.monotonic(),
+                                      (bus >> 3) * 0.004,
+                                      shunt * 0.01,
+                                      current * self._current_lsb,
+                                      power * self._power_lsb,
+                                      bool(bus & _OVF),
+                                      self.transactions - start)
+            return self._snapshot
+        return self._snapshot
+
+    @staticmethod
+    def _signed(value):
+        return value - 65536 if value > 32767 else value
+
     def getShuntVoltage_mV(self):
         self.write(_REG_CALIBRATION,self._cal_value)
         value = self.read(_REG_SHUNTVOLTAGE)
@@ -193,10 +287,11 @@ if __name__=='__main__':
     # Create an INA219 instance.
     ina219 = INA219(addr=0x42)
     while True:
-        bus_voltage = ina219.getBusVoltage_V()             # voltage on V- (load side)
-        shunt_voltage = ina219.getShuntVoltage_mV() / 1000 # voltage between V+ and V- across the shunt
-        current = ina219.getCurrent_mA()                   # current in mA
-        power = ina219.getPower_W()                        # power in W
+        snapshot = ina219.read_snapshot()
+        bus_voltage = snapshot.bus_voltage_V               # voltage on V- (load side)
+        shunt_voltage = snapshot.shunt_voltage_mV / 1000   # voltage between V+ and V- across the shunt
+        current = snapshot.current_mA                      # current in mA
+        power = snapshot.power_W                           # power in W
         p = (bus_voltage - 6)/2.4*100
         if(p > 100):p = 100
         if(p < 0):p = 0
@@ -208,6 +303,7 @@ if __name__=='__main__':
         print("Current:       {:9.6f} A".format(current/1000))
         print("Power:         {:6.3f} W".format(power))
         print("Percent:       {:3.1f}%".format(p))
+        print("Transactions:  {}".format(snapshot.transactions))
         print("")
 
         time.sleep(2)
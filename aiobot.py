@@ -0,0 +1,168 @@
+import asyncio
+import traceback
+from time import monotonic
+from mBot import mBot, mParser, mWriter
+
+
+class mAsyncWriter(mWriter):
+    """mWriter driven by a task on the running event loop instead of a thread."""
+
+    def start(self):
+        self._wake = asyncio.Event()
+        self._task = asyncio.ensure_future(self._run())
+
+    def is_alive(self):
+        return hasattr(self, '_task') and not self._task.done()
+
+    async def close(self, timeout=1):
+        """Stops the task once the frames already queued are sent."""
+        self._exiting = True
+        if self.is_alive():
+            self._wake.set()
+            try:
+                await asyncio.wait_for(asyncio.shield(self._task), timeout)
+            except asyncio.TimeoutError:
+                self._task.cancel()
+
+    def put(self, package, priority=mWriter.REQUEST, key=None):
+        self._put(package, priority, key)
+        self._wake.set()
+
+    async def _run(self):
+        ready = monotonic()
+        while True:
+            while not self._depth and not self._exiting:
+                self._wake.clear()
+                await self._wake.wait()
+            if not self._depth:
+                return
+
+            delay = ready - monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+
+            package, queued, frames = self._pop()
+            if not self._write(package):
+                self._exiting = True
+                self._clear()
+                if self._onError is not None:
+                    self._onError()
+                return
+
+            ready = self._sent(package, queued, ready, frames)
+
+
+class mBotAsync(mBot):
+    """mBot for asyncio programs.
+
+       The serial port is watched by the event loop and every sensor has an
+       awaitable read, e.g. ``distance = await bot.ultrasonic(3)``. Requests
+       get their own extID, so any number of them may be in flight at once.
+       All methods must be called from the thread running the event loop.
+    """
+
+    def __init__(self, timeout=1):
+        super().__init__(timeout)
+        self._extID = 0
+        self._alive = False
+
+    async def start(self, silent=False):
+        try:
+            self.starts += 1
+            self._retire('_parser')
+            self._parser = mParser(self._onParse)
+            self._selectors.clear()
+
+            if hasattr(self, '_writer'):
+                await self._writer.close()
+            if self._device.isOpen():
+                self._stopReading()
+                self._device.close()
+            self._device.start()
+
+            self._loop = asyncio.get_running_loop()
+            self._loop.add_reader(self._device.fileno(), self._onReadReady)
+            self._alive = True
+
+            self._retire('_writer')
+            self._writer = mAsyncWriter(self._device, self._onError, recorder=self.recorder)
+            self._writer.start()
+            return True
+        except OSError:
+            if silent:
+                traceback.print_exc()
+                return False
+            else:
+                raise
+
+    def is_alive(self):
+        return self._alive
+
+    async def close(self):
+        if hasattr(self, '_writer'):
+            await self._writer.close()
+        if self._device.isOpen():
+            self._stopReading()
+            self._device.close()
+        self._alive = False
+
+    def _stopReading(self):
+        if hasattr(self, '_loop'):
+            self._loop.remove_reader(self._device.fileno())
+
+    def _onReadReady(self):
+        try:
+            self._onReadable(self._parser.feed)
+        except OSError:
+            traceback.print_exc()
+            self._onError()
+
+    def _onError(self):
+        """Drops the connection after an I/O error. Requests in flight time out."""
+        self._alive = False
+        if self._device.isOpen():
+            self._stopReading()
+            self._device.close()
+
+    def _nextExtID(self):
+        # extID 0 marks commands that expect no reply
+        for _ in range(255):
+            self._extID = self._extID % 255 + 1
+            if self._extID not in self._selectors:
+                return self._extID
+        raise RuntimeError("Too many requests in flight")
+
+    async def _request(self, method, *args, timeout=None):
+        if timeout is None:
+            timeout = self._selectors.timeout
+        extID = self._nextExtID()
+        future = self._loop.create_future()
+
+        def callback(value):
+            if not future.done():
+                future.set_result(value)
+
+        method(extID, *args, callback)
+        try:
+            return await asyncio.wait_for(future, timeout)
+        except asyncio.TimeoutError:
+            self._selectors.cancel(extID)
+            raise
+
+    async def ultrasonic(self, port, timeout=None):
+        return await self._request(self.requestUltrasonicSensor, port, timeout=timeout)
+
+    async def light(self, port, timeout=None):
+        return await self._request(self.requestLight, port, timeout=timeout)
+
+    async def lightOnBoard(self, timeout=None):
+        return await self._request(self.requestLightOnBoard, timeout=timeout)
+
+    async def buttonOnBoard(self, timeout=None):
+        return await self._request(self.requestButtonOnBoard, timeout=timeout)
+
+    async def irOnBoard(self, timeout=None):
+        return await self._request(self.requestIROnBoard, timeout=timeout)
+
+    async def lineFollower(self, port, timeout=None):
+        return await self._request(self.requestLineFollower, port, timeout=timeout)
@@ -0,0 +1,1110 @@
+import argparse
+import http.client
+import json
+import math
+import os
+import random
+import struct
+import threading
+import time
+import mBot
+import sim
+from functools import partial
+from multiprocessing import Manager, Process, Queue
+
+_results = []
+_json = False
+
+
+def _ns_per_op(fn, n):
+    start = time.perf_counter_ns()
+    fn(n)
+    return (time.perf_counter_ns() - start) / n
+
+
+def _report(name, value, unit):
+    _results.append({'name': name, 'value': value, 'unit': unit})
+    if not _json:
+        print("{:<32} {:>12.1f} {}".format(name, value, unit))
+
+
+def _report_percentiles(name, values, scale, unit):
+    values = sorted(values)
+    for p in (50, 90, 99):
+        _report("{} p{}".format(name, p), values[min(len(values) * p // 100, len(values) - 1)] * scale, unit)
+    _report("{} max".format(name), values[-1] * scale, unit)
+
+
+def _noop(*_args):
+    pass
+
+
+def bench_pending(args):
+    """Request/response round trip through the pending-request table."""
+
+    manager = Manager()
+    selectors = manager.dict()
+
+    def legacy(n):
+        # The former Manager-backed table in mBot
+        def do_callback(extID, callback):
+            key = "callback_" + str(extID)
+            try:
+                callback, t = selectors[key]
+                return time.time() - t > 1
+            except KeyError:
+                selectors[key] = callback, time.time()
+                return True
+
+        def response_value(extID, value):
+            key = "callback_" + str(extID)
+            try:
+                callback, _ = selectors.pop(key)
+                callback(value)
+            except KeyError:
+                pass
+
+        for i in range(n):
+            extID = i & 0x3f
+            do_callback(extID, _noop)
+            response_value(extID, i)
+
+    def pending(n):
+        table = mBot.mPending()
+        for i in range(n):
+            extID = i & 0x3f
+            table.add(extID, _noop)
+            callback, _ = table.pop(extID)
+            callback(i)
+
+    try:
+        _report("pending: manager dict", _ns_per_op(legacy, args.count // 10), "ns/op")
+    finally:
+        manager.shutdown()
+    _report("pending: mPending", _ns_per_op(pending, args.count), "ns/op")
+
+
+class _NullDevice():
+    """Discards frames, accepting them at the byte rate of the Bluetooth link."""
+
+    rate = 115200 / 10
+
+    def writePackage(self, package):
+        pass
+
+
+def bench_writer(args):
+    """Cost to the caller of queueing one control loop tick of frames."""
+
+    writer = mBot.mWriter(_NullDevice())
+    writer.start()
+
+    ticks = args.count // 6
+
+    def tick(n):
+        for i in range(n):
+            writer.put(b'\xff\x55\x04\x14\x01\x01\x03', mBot.mWriter.REQUEST, 20)
+            writer.put(b'\xff\x55\x04\x1e\x01\x03\x08', mBot.mWriter.REQUEST, 30)
+            writer.put(b'\xff\x55\x04\x28\x01\x1f\x07', mBot.mWriter.REQUEST, 40)
+            writer.put(b'\xff\x55\x07\x00\x02\x05\x00\x00\x00\x00', mBot.mWriter.MOTION, 'move')
+            writer.put(b'\xff\x55\x09\x00\x02\x08\x07\x02\x00\x00\x00\x00', mBot.mWriter.DISPLAY, 'led')
+            writer.put(b'\xff\x55\x07\x00\x02\x22\x7b\x00\xfa\x00', mBot.mWriter.SOUND, 'buzzer')
+
+    _report("writer: legacy sleeps", 6 * 0.01 * 1e9, "ns/tick")
+    _report("writer: enqueue", _ns_per_op(tick, ticks), "ns/tick")
+    writer.close(10)
+
+    stats = writer.stats()
+    _report("writer: sent", stats['sent'], "frames")
+    _report("writer: coalesced", stats['coalesced'], "frames")
+    _report("writer: max depth", stats['maxDepth'], "frames")
+    _report("writer: avg latency", stats['latencyAvg'] * 1e3, "ms")
+    _report("writer: max latency", stats['latencyMax'] * 1e3, "ms")
+
+
+class _LegacyParser():
+    """The former byte at a time parser of mBot, kept for comparison."""
+
+    def __init__(self, callback):
+        self._callback = callback
+        self.__buffer = []
+        self.__isParseStart = False
+        self.__isParseStartIndex = 0
+
+    def feed(self, data):
+        for byte in data:
+            self._onParse(byte)
+
+    def _onParse(self, byte):
+        value = 0
+        self.__buffer += [byte]
+        bufferLength = len(self.__buffer)
+        if bufferLength >= 2:
+            if self.__buffer[bufferLength - 1] == 0x55 \
+                    and self.__buffer[bufferLength - 2] == 0xff:
+                self.__isParseStart = True
+                self.__isParseStartIndex = bufferLength - 2
+            if self.__buffer[bufferLength - 1] == 0xa and \
+                    self.__buffer[bufferLength - 2] == 0xd and self.__isParseStart == True:
+                self.__isParseStart = False
+                position = self.__isParseStartIndex + 2
+                extID = self.__buffer[position]
+                position += 1
+                type = self.__buffer[position]
+                position += 1
+                if type == 1:
+                    value = self.__buffer[position]
+                if type == 2:
+                    value = self._readFloat(position)
+                    if (value < -255 or value > 1023):
+                        value = 0
+                if type == 3:
+                    value = self._readShort(position)
+                if (type <= 5):
+                    self._callback(extID, value)
+                self.__buffer = []
+
+    def _readFloat(self, position):
+        v = [self.__buffer[position], self.__buffer[position + 1], self.__buffer[position + 2],
+             self.__buffer[position + 3]]
+        return struct.unpack('<f', struct.pack('4B', *v))[0]
+
+    def _readShort(self, position):
+        v = [self.__buffer[position], self.__buffer[position + 1]]
+        return struct.unpack('<h', struct.pack('2B', *v))[0]
+
+
+def _replies(count):
+    """A stream of ultrasonic, light and button replies with some line noise."""
+    frames = [
+        b'\xff\x55\x14\x02' + struct.pack('<f', 12.5) + b'\r\n',
+        b'\xff\x55\x1e\x02' + struct.pack('<f', 340.0) + b'\r\n',
+        b'\xff\x55\x28\x02' + struct.pack('<f', 1023.0) + b'\r\n',
+        b'\x00\x13',
+    ]
+    return b''.join(frames[i % len(frames)] for i in range(count))
+
+
+def bench_parser(args):
+    """Reply frames parsed per second from a stream read in 64 byte chunks."""
+
+    data = _replies(args.count * 4 // 3)
+    chunks = [data[i:i + 64] for i in range(0, len(data), 64)]
+
+    for name, parser_class in (("legacy", _LegacyParser), ("mParser", mBot.mParser)):
+        frames = [0]
+
+        def callback(extID, value):
+            frames[0] += 1
+
+        parser = parser_class(callback)
+        start = time.perf_counter()
+        for chunk in chunks:
+            parser.feed(chunk)
+        elapsed = time.perf_counter() - start
+        _report("parser: {}".format(name), frames[0] / elapsed, "frames/s")
+
+
+class _LegacyEncoder():
+    """The former frame building of mBot, kept for comparison."""
+
+    def move(self, leftSpeed, rightSpeed):
+        return bytearray([0xff, 0x55, 0x7, 0x0, 0x2, 0x5] + self._short2bytes(-leftSpeed) + self._short2bytes(rightSpeed))
+
+    def rgbLed(self, port, slot, index, red, green, blue):
+        return bytearray([0xff, 0x55, 0x9, 0x0, 0x2, 0x8, port, slot, index, red, green, blue])
+
+    def buzzer(self, buzzer, time=0):
+        return bytearray([0xff, 0x55, 0x7, 0x0, 0x2, 0x22] + self._short2bytes(buzzer) + self._short2bytes(time))
+
+    def sevSeg(self, port, display):
+        return bytearray([0xff, 0x55, 0x8, 0x0, 0x2, 0x9, port] + self._float2bytes(display))
+
+    def ultrasonic(self, extID, port):
+        return bytearray([0xff, 0x55, 0x4, extID, 0x1, 0x1, port])
+
+    def _float2bytes(self, fval):
+        val = struct.pack("f", fval)
+        return [val[0], val[1], val[2], val[3]]
+
+    def _short2bytes(self, sval):
+        val = struct.pack("h", sval)
+        return [val[0], val[1]]
+
+
+def _encoders():
+    """Frames of one control loop tick from the former encoder and from the command table."""
+    legacy = _LegacyEncoder()
+    commands = mBot._COMMANDS
+
+    def legacy_tick(n):
+        for i in range(n):
+            legacy.ultrasonic(20, 3)
+            legacy.move(i & 0xff, 100)
+            legacy.move(0, 0)
+            legacy.rgbLed(7, 2, 0, 0, 0, 0)
+            legacy.buzzer(1400, 250)
+            legacy.sevSeg(9, 12.5)
+
+    def table_tick(n):
+        move = commands['move']
+        for i in range(n):
+            commands['ultrasonic'].cached(20, 3)
+            move.encode(0, -(i & 0xff), 100)
+            mBot._STOP
+            commands['rgbLed'].cached(0, 7, 2, 0, 0, 0, 0)
+            commands['buzzer'].encode(0, 1400, 250)
+            commands['sevSeg'].encode(0, 9, 12.5)
+
+    return legacy_tick, table_tick
+
+
+def bench_codec(args):
+    """Encoding of command frames and decoding of replies of every type, former and table-driven."""
+    legacy_tick, table_tick = _encoders()
+    count = args.count // 6
+    _report("codec: legacy encode", _ns_per_op(legacy_tick, count) / 6, "ns/frame")
+    _report("codec: table encode", _ns_per_op(table_tick, count) / 6, "ns/frame")
+
+    frames = [
+        b'\xff\x55\x14\x01\x07\r\n',
+        b'\xff\x55\x1e\x02' + struct.pack('<f', 340.0) + b'\r\n',
+        b'\xff\x55\x28\x03' + struct.pack('<h', -300) + b'\r\n',
+        b'\xff\x55\x32\x04\x05hello\r\n',
+        b'\xff\x55\x3c\x05' + struct.pack('<f', 12.5) + b'\r\n',
+        b'\xff\x55\x46\x05' + struct.pack('<d', 12.5) + b'\r\n',
+    ]
+    data = b''.join(frames[i % len(frames)] for i in range(count * 6))
+    for name, parser_class in (("legacy", _LegacyParser), ("table", mBot.mParser)):
+        values = []
+        parser = parser_class(lambda extID, value: values.append(value))
+        start = time.perf_counter_ns()
+        for i in range(0, len(data), 64):
+            parser.feed(data[i:i + 64])
+        elapsed = time.perf_counter_ns() - start
+        _report("codec: {} decode".format(name), elapsed / max(len(values), 1), "ns/frame")
+        # The former parser decoded neither strings nor doubles
+        correct = sum(value == expected for value, expected in zip(values, [7, 340.0, -300, 'hello', 12.5, 12.5] * count))
+        _report("codec: {} decoded right".format(name), correct * 100 / (count * 6), "%")
+
+
+class _PollingBot(mBot.mBot):
+    """mBot with the former reader, which polled the port every 10 ms."""
+
+    def _onRead(self, callback):
+        while not self._closed.is_set():
+            n = self._device.inWaiting()
+            if n:
+                callback(self._device.read(n))
+            time.sleep(0.01)
+
+    def close(self):
+        self._closed.set()
+        super().close()
+
+    def start(self, silent=False):
+        self._closed = threading.Event()
+        return super().start(silent)
+
+
+def _connect(bot_class=mBot.mBot, **kwargs):
+    """Starts a simulated board and a bot connected to it."""
+    simulator = sim.mCoreSimulator(**kwargs)
+    simulator.start()
+    bot = bot_class()
+    bot.createSerial(simulator.port)
+    bot.start()
+    return simulator, bot
+
+
+def _disconnect(simulator, bot):
+    bot.close()
+    simulator.close()
+
+
+def _round_trips(bot, count):
+    replied = threading.Event()
+    latencies = []
+    for i in range(count):
+        replied.clear()
+        start = time.perf_counter()
+        bot.requestUltrasonicSensor(20, 3, lambda value: replied.set())
+        if replied.wait(1):
+            latencies.append(time.perf_counter() - start)
+    return latencies
+
+
+def bench_reader(args):
+    """Reply latency and idle CPU of the serial reader."""
+
+    for name, bot_class in (("polling", _PollingBot), ("select", mBot.mBot)):
+        simulator, bot = _connect(bot_class)
+        try:
+            latencies = sorted(_round_trips(bot, max(args.count // 1000, 10)))
+
+            cpu = time.process_time()
+            time.sleep(2)
+            cpu = time.process_time() - cpu
+        finally:
+            _disconnect(simulator, bot)
+
+        _report("reader: {} median latency".format(name), latencies[len(latencies) // 2] * 1e3, "ms")
+        _report("reader: {} idle cpu".format(name), cpu / 2 * 100, "%")
+
+
+def bench_rtt(args):
+    """Round trip of a sensor request through the simulated board."""
+
+    simulator, bot = _connect()
+    try:
+        latencies = _round_trips(bot, max(args.count // 100, 100))
+    finally:
+        _disconnect(simulator, bot)
+
+    _report_percentiles("rtt:", latencies, 1e3, "ms")
+
+
+def bench_hid(args):
+    """Round trip and frames per report of the USB HID transport, against a fake dongle."""
+    module = sim.HIDModule()
+    bot = mBot.mBot()
+    bot.createHID(module)
+    bot.start()
+    try:
+        latencies = _round_trips(bot, max(args.count // 1000, 20))
+
+        # A tick worth of commands at once, as the car sends them
+        written = module.written
+        for i in range(max(args.count // 1000, 20)):
+            bot.doMove(i, -i)
+            bot.doRGBLedOnBoard(0, i % 256, 0, 0)
+            bot.requestUltrasonicSensor(20, 3, _noop)
+            bot.requestLightOnBoard(30, _noop)
+            time.sleep(0.05)
+        stats = bot._writer.stats()
+    finally:
+        bot.close()
+
+    _report_percentiles("hid: rtt", latencies, 1e3, "ms")
+    _report("hid: frames per report", stats['sent'] / stats['writes'], "frames")
+    _report("hid: reports per tick", (module.written - written) / max(args.count // 1000, 20), "reports")
+
+
+def bench_throughput(args):
+    """Sustained request rate with several requests kept in flight."""
+
+    simulator, bot = _connect()
+    try:
+        replies = [0]
+        stop = threading.Event()
+
+        def request(extID):
+            if not stop.is_set():
+                bot.requestUltrasonicSensor(extID, 3, lambda value: on_reply(extID))
+
+        def on_reply(extID):
+            replies[0] += 1
+            request(extID)
+
+        start = time.perf_counter()
+        for extID in range(1, 9):
+            request(extID)
+        time.sleep(2)
+        stop.set()
+        elapsed = time.perf_counter() - start
+    finally:
+        _disconnect(simulator, bot)
+
+    _report("throughput: requests", replies[0] / elapsed, "req/s")
+    _report("throughput: link", bot._writer.bytes / elapsed, "B/s")
+
+
+def bench_loop(args):
+    """Duration and period of control loop ticks driving the simulated board."""
+    os.environ.setdefault('PYGAME_HIDE_SUPPORT_PROMPT', '1')
+    import control
+    import metrics
+    import state
+    import ticker
+
+    simulator, bot = _connect()
+    timer = metrics.LoopTimer(1 / 20)
+    try:
+        controller = control.Controller(bot, None, state.StateStore(control.SENSORS, control.max_ages), timer)
+        clock = ticker.Ticker(20)
+        durations = []
+        periods = []
+        last = time.perf_counter()
+        for i in range(max(args.count // 1000, 40)):
+            clock.wait()
+            start = time.perf_counter()
+            periods.append(start - last)
+            last = start
+            timer.begin()
+            timer.phase('input')
+            controller.step(math.sin(i / 10), -abs(math.cos(i / 7)), i % 50 == 0)
+            timer.end()
+            durations.append(time.perf_counter() - start)
+        controller.stop()
+    finally:
+        _disconnect(simulator, bot)
+
+    _report_percentiles("loop: tick", durations[1:], 1e3, "ms")
+    _report_percentiles("loop: period", periods[1:], 1e3, "ms")
+
+
+def bench_link(args):
+    """Reply latency, loss and rates with fixed and adaptive rates over a link that slows down and recovers."""
+    os.environ.setdefault('PYGAME_HIDE_SUPPORT_PROMPT', '1')
+    import control
+    import link
+    import metrics
+    import state
+    import ticker
+
+    fast, slow, recovery = 3, 8, 8
+    for name, min_scale in (("fixed", 1.0), ("adaptive", 0.25)):
+        simulator, bot = _connect()
+        store = state.StateStore(control.SENSORS, control.max_ages)
+        sensors = control.sensor_poller(bot, control.poll_rates, *control.store_writers(store))
+        controller = control.Controller(bot, None, store, metrics.LoopTimer(1 / 20), sensors)
+        clock = ticker.Ticker(20)
+        monitor = link.LinkMonitor(bot, sensors, clock, min_scale=min_scale)
+        sensors.start()
+        samples = {}
+        try:
+            start = time.monotonic()
+            phase = None
+            i = 0
+            while time.monotonic() - start < fast + slow + recovery:
+                elapsed = time.monotonic() - start
+                # A slow link dropping some of the frames, after a fast one
+                current = 'fast' if elapsed < fast else 'slow' if elapsed < fast + slow else 'recovery'
+                if current != phase:
+                    phase = current
+                    simulator.rate = 240 if phase == 'slow' else 11520
+                    simulator.drop = 0.05 if phase == 'slow' else 0.0
+                    samples[phase] = [time.monotonic(), clock.ticks, sensors['ultrasonic'].replies]
+                clock.wait()
+                controller.step(math.sin(i / 10), -abs(math.cos(i / 7)), False)
+                monitor.update()
+                i += 1
+            controller.stop()
+            samples['end'] = [time.monotonic(), clock.ticks, sensors['ultrasonic'].replies]
+            scale = monitor.scale
+        finally:
+            sensors.close()
+            _disconnect(simulator, bot)
+
+        # The second half of the slow phase, once the rates have settled
+        since = samples['slow'][0] + slow / 2
+        rtts = [rtt for time_, rtt in bot.roundTrips(since) if time_ < samples['recovery'][0]]
+        stats = bot.counters()
+        _report_percentiles("link: {} slow rtt".format(name), rtts or [float('nan')], 1e3, "ms")
+        for phase, following in (('slow', 'recovery'), ('recovery', 'end')):
+            duration = samples[following][0] - samples[phase][0]
+            _report("link: {} {} tick rate".format(name, phase), (samples[following][1] - samples[phase][1]) / duration,
+                    "Hz")
+            _report("link: {} {} distance rate".format(name, phase),
+                    (samples[following][2] - samples[phase][2]) / duration, "Hz")
+        _report("link: {} timeouts".format(name), stats['timeouts'], "requests")
+        _report("link: {} final scale".format(name), scale * 100, "%")
+
+
+def bench_timer(args):
+    """Cost of timing every phase of a control loop tick."""
+    import metrics
+
+    timer = metrics.LoopTimer(1 / 20)
+
+    def tick(n):
+        for i in range(n):
+            timer.begin()
+            for phase in metrics.LoopTimer.PHASES:
+                timer.phase(phase)
+            timer.age('ultrasonic', 0.02)
+            timer.age('light', 0.5)
+            timer.end()
+
+    _report("timer: instrumented tick", _ns_per_op(tick, args.count), "ns/tick")
+
+
+def bench_power(args):
+    """I2C transactions and time per INA219 reading."""
+    import INA219
+
+    bus = sim.INA219Bus(conversion_time=0.0001)
+    ina219 = INA219.INA219(bus, 0x42)
+
+    def getters(n):
+        for i in range(n):
+            ina219.getBusVoltage_V()
+            ina219.getShuntVoltage_mV()
+            ina219.getCurrent_mA()
+            ina219.getPower_W()
+
+    def snapshot(n):
+        for i in range(n):
+            time.sleep(0.0001)
+            ina219.read_snapshot()
+
+    count = max(args.count // 100, 10)
+    for name, fn in (("getters", getters), ("snapshot", snapshot)):
+        transactions = bus.transactions
+        _report("power: {}".format(name), _ns_per_op(fn, count) / 1e3, "us/reading")
+        _report("power: {} transactions".format(name), (bus.transactions - transactions) / count, "/reading")
+
+
+def bench_recorder(args):
+    """Cost of recording what happens in one control loop tick."""
+    import tempfile
+    import recorder
+
+    frame = bytearray(b'\xff\x55\x07\x00\x02\x05\x00\x00\x00\x00')
+
+    def tick(n):
+        # A tick sends a move and a sensor request and receives a reply
+        for i in range(n):
+            flight.sent(frame)
+            flight.sent(frame)
+            flight.received(20, 12.5)
+            flight.tick(0.1, -0.5, 100, 120)
+
+    with tempfile.TemporaryDirectory() as directory:
+        with recorder.FlightRecorder(directory, 1 << 20, 4) as flight:
+            _report("recorder: tick", _ns_per_op(tick, args.count), "ns/tick")
+            _report("recorder: rotations", flight.rotations, "")
+
+
+def bench_replay(args):
+    """Control loop ticks per second when replaying a drive on a virtual clock."""
+    import replay
+
+    seconds = max(args.count // 20, 1)
+    events = list(replay.synthetic(seconds))
+    start = time.perf_counter()
+    commands, ticks = replay.replay(events)
+    elapsed = time.perf_counter() - start
+    _report("replay: ticks", ticks / elapsed, "ticks/s")
+    _report("replay: faster than real time", seconds / elapsed, "x")
+
+
+def bench_motion(args):
+    """Move commands sent per minute with and without motion shaping, for a steady and a noisy joystick."""
+    import motion
+    import replay
+
+    for noise in (0.0, 0.03):
+        events = list(replay.synthetic(600, noise=noise))
+        for name, shaper in (('unshaped', motion.MotionShaper(0, 0, 1, 0, 0)), ('shaped', motion.MotionShaper())):
+            replay.replay(events, shaper=shaper)
+            _report("motion: {} noise {}".format(name, noise), shaper.sent / 10, "moves/min")
+        _report("motion: saved noise {}".format(noise), shaper.stats()['saved_per_minute'], "moves/min")
+
+
+def bench_state(args):
+    """Cost of writing a sensor value and of taking a snapshot of all of them."""
+    import state
+
+    store = state.StateStore(('distance', 'light', 'line_follow', 'button', 'power', 'battery'))
+
+    def write(n):
+        for i in range(n):
+            store.write('distance', 40.0)
+
+    def snapshot(n):
+        for i in range(n):
+            store.snapshot().value('distance')
+
+    _report("state: write", _ns_per_op(write, args.count), "ns/write")
+    _report("state: snapshot", _ns_per_op(snapshot, args.count), "ns/snapshot")
+
+    # Snapshots taken while another thread writes at the rate of the sensors
+    stop = threading.Event()
+
+    def writer():
+        while not stop.wait(0.001):
+            store.write('distance', 40.0)
+            store.write('light', 500.0)
+
+    th = threading.Thread(target=writer)
+    th.start()
+    retries = store.retries
+    _report("state: snapshot with writer", _ns_per_op(snapshot, args.count), "ns/snapshot")
+    stop.set()
+    th.join()
+    _report("state: snapshot retries", store.retries - retries, "")
+
+
+def bench_telemetry(args):
+    """Cost of recording a power sample and of reading back the history."""
+    import INA219
+    import power
+
+    telemetry = power.PowerTelemetry()
+    start = time.time()
+
+    def add(n):
+        for i in range(n):
+            snapshot = INA219.Snapshot(i * 0.1, 7.4, 30.0, 300.0, 2.2, False, 5)
+            telemetry.add(snapshot, start + i * 0.1)
+
+    _report("telemetry: add", _ns_per_op(add, args.count), "ns/sample")
+    columns, rows = telemetry.history()
+    _report("telemetry: raw history", len(power.PowerTelemetry.pack(rows)) / 1024, "KiB")
+    _report("telemetry: history", _ns_per_op(lambda n: [telemetry.history() for i in range(n)], 100) / 1e3,
+            "us/request")
+
+
+def _legacy_dispatch(environ, start_response):
+    """The former metrics handler, formatting the sensor values of car on every request."""
+    import car
+    from werkzeug.wrappers import Response
+
+    distance = car._state.read('distance').value
+    light = car._state.read('light').value
+    snapshot = car._state.read('power').value
+    percent = car._state.read('battery').value
+
+    sensors = dict()
+    if distance is not None:
+        sensors['Distance'] = "{:.1f} cm".format(distance)
+    if light is not None:
+        sensors['Light'] = "{:.0f}".format(light)
+
+    battery = dict()
+    if percent is not None:
+        bus_voltage = snapshot.bus_voltage_V
+        shunt_voltage = snapshot.shunt_voltage_mV / 1000
+        battery['PSU Voltage'] = "{:.3f} V".format(bus_voltage + shunt_voltage)
+        battery['Shunt Voltage'] = "{:.6f} V".format(shunt_voltage)
+        battery['Load Voltage'] = "{:.3f} V".format(bus_voltage)
+        battery['Current'] = "{:.6f} A".format(snapshot.current_mA / 1000)
+        battery['Power'] = "{:.3f} W".format(snapshot.power_W)
+        battery['Percent'] = "{:.1f}%".format(percent)
+
+    metrics = dict()
+    metrics['Sensors'] = sensors
+    metrics['Battery'] = battery
+    response = Response(json.dumps(metrics, indent=4), mimetype='application/json')
+    return response(environ, start_response)
+
+
+class _FixedINA219():
+    """Power monitor reading the same values every time."""
+
+    def read_snapshot(self):
+        import INA219
+        return INA219.Snapshot(time.monotonic(), 7.4, 30.0, 300.0, 2.2, False, 5)
+
+
+def _set_car_state(car):
+    """Values for every field of the metrics page."""
+    car._on_light(500.0)
+    car._read_power(_FixedINA219())
+
+
+def _serve_car(ports, base, period, legacy=False):
+    """Runs the HTTP server of the car with the distance counting up every period."""
+    os.environ.setdefault('PYGAME_HIDE_SUPPORT_PROMPT', '1')
+    import logging
+    import car
+    from werkzeug.serving import make_server
+
+    logging.getLogger('werkzeug').setLevel(logging.ERROR)
+
+    def update():
+        k = 0
+        while True:
+            time.sleep(max(base + k * period - time.time(), 0))
+            car._on_distance(float(k))
+            k += 1
+
+    _set_car_state(car)
+    car._stream.start()
+    server = make_server('127.0.0.1', 0, _legacy_dispatch if legacy else car._dispatch_request, threaded=True)
+    threading.Thread(target=update, daemon=True).start()
+    ports.put(server.port)
+    server.serve_forever()
+
+
+def _cpu_time(pid):
+    with open('/proc/{}/stat'.format(pid)) as f:
+        fields = f.read().rsplit(')', 1)[1].split()
+    return (int(fields[11]) + int(fields[12])) / os.sysconf('SC_CLK_TCK')
+
+
+def _memory(pid):
+    """Proportional set size in bytes, which shares the pages of common libraries out between processes."""
+    try:
+        with open('/proc/{}/smaps_rollup'.format(pid)) as f:
+            return next(int(line.split()[1]) for line in f if line.startswith('Pss:')) * 1024
+    except OSError:
+        with open('/proc/{}/status'.format(pid)) as f:
+            return next(int(line.split()[1]) for line in f if line.startswith('VmRSS:')) * 1024
+
+
+def _measure_processes(commands, warmup, duration):
+    """Starts the commands and returns their memory and CPU use per second once settled."""
+    import subprocess
+    import sys
+
+    env = dict(os.environ, SDL_VIDEODRIVER='dummy', PYGAME_HIDE_SUPPORT_PROMPT='1')
+    processes = [subprocess.Popen([sys.executable] + command, env=env, stdout=subprocess.DEVNULL,
+                                  stderr=subprocess.DEVNULL, cwd=os.path.dirname(os.path.abspath(__file__)))
+                 for command in commands]
+    try:
+        time.sleep(warmup)
+        cpu = sum(_cpu_time(p.pid) for p in processes)
+        time.sleep(duration)
+        cpu = sum(_cpu_time(p.pid) for p in processes) - cpu
+        memory = sum(_memory(p.pid) for p in processes)
+    finally:
+        for p in processes:
+            p.terminate()
+        for p in processes:
+            p.wait()
+    return memory, cpu / duration
+
+
+def bench_input(args):
+    """Cold start until the control loop starts and until the first move, and memory, of car.py per joystick input."""
+    import subprocess
+    import sys
+    import tempfile
+
+    event = struct.Struct('=IhBB')
+    env = dict(os.environ, SDL_VIDEODRIVER='dummy', PYGAME_HIDE_SUPPORT_PROMPT='1', PYTHONUNBUFFERED='1')
+    for name in ('pygame', 'js', 'none'):
+        moved = []
+        simulator = sim.mCoreSimulator(on_command=lambda now, device, arguments:
+                                       device == sim.MOVE and not moved and moved.append(now))
+        simulator.start()
+        with tempfile.TemporaryDirectory() as directory:
+            command = [sys.executable, 'car.py', '-sp', simulator.port, '-hp', '0', '--input', name]
+            if name == 'js':
+                # A joystick pushed forward, in a pipe standing in for the device
+                device = os.path.join(directory, 'js0')
+                os.mkfifo(device)
+                fd = os.open(device, os.O_RDWR)
+                os.write(fd, event.pack(0, 0, 0x82, 0) + event.pack(0, -32767, 0x82, 1))
+                command += ['--joystick-device', device]
+            start = time.monotonic()
+            process = subprocess.Popen(command, env=env, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+                                       cwd=os.path.dirname(os.path.abspath(__file__)))
+            try:
+                # Printed once the joystick is open and the control loop about to start
+                process.stdout.readline()
+                ready = time.monotonic() - start
+                while not moved and name == 'js' and time.monotonic() - start < 10:
+                    time.sleep(0.001)
+                # Only the js input has a joystick to drive with
+                first_move = moved[0] - start if moved else None
+                time.sleep(3)
+                memory = _memory(process.pid)
+            finally:
+                process.terminate()
+                process.wait()
+                if name == 'js':
+                    os.close(fd)
+                simulator.close()
+
+        _report("input: {} start".format(name), ready * 1e3, "ms")
+        if first_move is not None:
+            _report("input: {} first move".format(name), first_move * 1e3, "ms")
+        _report("input: {} memory".format(name), memory / (1 << 20), "MB")
+
+
+def bench_fleet(args):
+    """Memory and CPU of driving robots from one fleet process and from one car process each."""
+    results = {}
+    for count in (1, 2, 4, 8):
+        simulators = [sim.mCoreSimulator() for i in range(count)]
+        for simulator in simulators:
+            simulator.start()
+        ports = [simulator.port for simulator in simulators]
+        try:
+            results['fleet', count] = _measure_processes(
+                [['fleet.py', '-sp'] + ports + ['-hp', '0', '--input', 'none']], 2, 4)
+            results['car', count] = _measure_processes(
+                [['car.py', '-sp', port, '-hp', '0', '--input', 'none'] for port in ports], 2, 4)
+        finally:
+            for simulator in simulators:
+                simulator.close()
+        for name in ('fleet', 'car'):
+            memory, cpu = results[name, count]
+            _report("fleet: {} x{} memory".format(name, count), memory / (1 << 20), "MB")
+            _report("fleet: {} x{} cpu".format(name, count), cpu * 100, "%")
+
+    for name in ('fleet', 'car'):
+        memory = (results[name, 8][0] - results[name, 1][0]) / 7
+        cpu = (results[name, 8][1] - results[name, 1][1]) / 7
+        _report("fleet: {} memory per extra robot".format(name), memory / (1 << 20), "MB")
+        _report("fleet: {} cpu per extra robot".format(name), cpu * 100, "%")
+
+
+def _serve_camera(ports, fps, size):
+    camera = sim.MJPEGServer(fps, size)
+    camera.start()
+    ports.put(camera.port)
+    while True:
+        time.sleep(1)
+
+
+def _snapshot_viewer(port, end, counts):
+    count = 0
+    while time.time() < end:
+        # One request per frame, as the page used to load them
+        conn = http.client.HTTPConnection('127.0.0.1', port)
+        conn.request('GET', '/?action=snapshot')
+        response = conn.getresponse()
+        response.read()
+        conn.close()
+        count += response.status == 200
+    counts.append(count)
+
+
+def _mjpeg_viewer(port, end, counts):
+    conn = http.client.HTTPConnection('127.0.0.1', port)
+    conn.request('GET', '/stream')
+    response = conn.getresponse()
+    count = 0
+    while time.time() < end:
+        line = response.readline()
+        if line.startswith(b'Content-Length:'):
+            length = int(line[15:])
+            while response.readline() != b'\r\n':
+                pass
+            response.read(length)
+            count += 1
+    conn.close()
+    counts.append(count)
+
+
+def bench_camera(args):
+    """Frames per second per viewer and server CPU of polling camera snapshots and of the MJPEG proxy."""
+    import subprocess
+    import sys
+
+    fps = 30
+    duration = 4
+    for viewers in (1, 4, 8):
+        for name in ('polling', 'proxy'):
+            ports = Queue()
+            source = Process(target=_serve_camera, args=(ports, fps, 40000), daemon=True)
+            source.start()
+            port = ports.get()
+            pids = [source.pid]
+            proxy = None
+            if name == 'proxy':
+                proxy = subprocess.Popen([sys.executable, 'camera.py', '-u', 'http://127.0.0.1:{}/?action=stream'.format(
+                    port), '-t', 'none', '-hp', '0'], stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+                    env=dict(os.environ, PYTHONUNBUFFERED='1'), cwd=os.path.dirname(os.path.abspath(__file__)))
+                # Starting ... on host:port with PID ...
+                port = int(proxy.stdout.readline().split()[-4].rsplit(b':', 1)[1])
+                pids.append(proxy.pid)
+            viewer = _mjpeg_viewer if name == 'proxy' else _snapshot_viewer
+            time.sleep(1)
+
+            counts = []
+            end = time.time() + duration
+            cpu = sum(_cpu_time(pid) for pid in pids)
+            threads = [threading.Thread(target=viewer, args=(port, end, counts)) for i in range(viewers)]
+            for th in threads:
+                th.start()
+            for th in threads:
+                th.join()
+            cpu = sum(_cpu_time(pid) for pid in pids) - cpu
+            if proxy is not None:
+                proxy.terminate()
+                proxy.wait()
+            source.terminate()
+            source.join()
+
+            _report("camera: {} x{} rate".format(name, viewers), sum(counts) / duration / viewers, "fps/viewer")
+            _report("camera: {} x{} cpu".format(name, viewers), cpu / duration * 100, "%")
+
+
+def _poll_viewer(port, base, period, end, latencies):
+    seen = None
+    # Viewers poll out of step with each other and with the updates
+    time.sleep(random.uniform(0, 0.5))
+    while time.time() < end:
+        conn = http.client.HTTPConnection('127.0.0.1', port)
+        conn.request('GET', '/')
+        distance = json.loads(conn.getresponse().read())['Sensors'].get('Distance')
+        conn.close()
+        if distance is not None and distance != seen:
+            # The first value seen was set before the viewer started
+            if seen is not None:
+                latencies.append(time.time() - base - float(distance.split()[0]) * period)
+            seen = distance
+        time.sleep(0.5)
+
+
+def _stream_viewer(port, base, period, end, latencies):
+    conn = http.client.HTTPConnection('127.0.0.1', port)
+    conn.request('GET', '/stream')
+    response = conn.getresponse()
+    # The first event is the whole state
+    while response.readline().strip():
+        pass
+    while time.time() < end:
+        line = response.readline()
+        if line.startswith(b'data:'):
+            distance = json.loads(line[5:]).get('Distance')
+            if distance is not None:
+                latencies.append(time.time() - base - float(distance.split()[0]) * period)
+    conn.close()
+
+
+def bench_stream(args):
+    """Server CPU per viewer and update latency of polling the sensors and of the event stream."""
+    viewers = 5
+    duration = 6
+    # The distance changes once a second
+    period = 1.0
+
+    for name, viewer in (("polling", _poll_viewer), ("stream", _stream_viewer)):
+        base = time.time()
+        ports = Queue()
+        server = Process(target=_serve_car, args=(ports, base, period), daemon=True)
+        server.start()
+        port = ports.get()
+        time.sleep(0.5)
+
+        latencies = []
+        end = time.time() + duration
+        cpu = _cpu_time(server.pid)
+        threads = [threading.Thread(target=viewer, args=(port, base, period, end, latencies))
+                   for i in range(viewers)]
+        for th in threads:
+            th.start()
+        for th in threads:
+            th.join()
+        cpu = _cpu_time(server.pid) - cpu
+        server.terminate()
+        server.join()
+
+        _report("stream: {} cpu".format(name), cpu / duration / viewers * 1e3, "ms/s/viewer")
+        _report_percentiles("stream: {} latency".format(name), latencies, 1e3, "ms")
+
+
+def _http_client(port, headers, end, counts):
+    conn = http.client.HTTPConnection('127.0.0.1', port)
+    count = 0
+    while time.time() < end:
+        conn.request('GET', '/', headers=headers)
+        response = conn.getresponse()
+        response.read()
+        if response.status == 200 and 'If-None-Match' in headers:
+            headers['If-None-Match'] = response.getheader('ETag')
+        count += 1
+    conn.close()
+    counts.append(count)
+
+
+def bench_http(args):
+    """Requests per second and CPU per request of the metrics page, formatted per request and cached."""
+    os.environ.setdefault('PYGAME_HIDE_SUPPORT_PROMPT', '1')
+    import car
+
+    _set_car_state(car)
+    environ = {'REQUEST_METHOD': 'GET', 'PATH_INFO': '/', 'SERVER_NAME': 'localhost', 'SERVER_PORT': '80',
+               'wsgi.url_scheme': 'http'}
+
+    def call(app, n):
+        for i in range(n):
+            b''.join(app(environ, _noop))
+
+    count = max(args.count // 10, 100)
+    _report("http: formatted", _ns_per_op(partial(call, _legacy_dispatch), count) / 1e3, "us/request")
+    _report("http: cached", _ns_per_op(partial(call, car._dispatch_request), count) / 1e3, "us/request")
+
+    clients = 4
+    duration = 3
+    period = 0.1
+    for name, legacy, headers in (("formatted", True, {}),
+                                  ("cached", False, {}),
+                                  ("cached gzip", False, {'Accept-Encoding': 'gzip'}),
+                                  ("cached 304", False, {'If-None-Match': '"none"'})):
+        ports = Queue()
+        server = Process(target=_serve_car, args=(ports, time.time(), period, legacy), daemon=True)
+        server.start()
+        port = ports.get()
+
+        counts = []
+        end = time.time() + duration
+        cpu = _cpu_time(server.pid)
+        threads = [threading.Thread(target=_http_client, args=(port, dict(headers), end, counts))
+                   for i in range(clients)]
+        for th in threads:
+            th.start()
+        for th in threads:
+            th.join()
+        cpu = _cpu_time(server.pid) - cpu
+        server.terminate()
+        server.join()
+
+        _report("http: {} rate".format(name), sum(counts) / duration, "requests/s")
+        _report("http: {} cpu".format(name), cpu / sum(counts) * 1e6, "us/request")
+
+
+_BENCHMARKS = {
+    'camera': bench_camera,
+    'codec': bench_codec,
+    'fleet': bench_fleet,
+    'hid': bench_hid,
+    'http': bench_http,
+    'input': bench_input,
+    'link': bench_link,
+    'loop': bench_loop,
+    'motion': bench_motion,
+    'parser': bench_parser,
+    'pending': bench_pending,
+    'power': bench_power,
+    'reader': bench_reader,
+    'recorder': bench_recorder,
+    'replay': bench_replay,
+    'rtt': bench_rtt,
+    'state': bench_state,
+    'stream': bench_stream,
+    'telemetry': bench_telemetry,
+    'throughput': bench_throughput,
+    'timer': bench_timer,
+    'writer': bench_writer,
+}
+
+
+def _parse_commandline_arguments():
+    parser = argparse.ArgumentParser(description='mBot Car benchmarks')
+
+    parser.add_argument("benchmarks", nargs='*', metavar="benchmark",
+                        help="Benchmarks to run, all by default: {}".format(", ".join(sorted(_BENCHMARKS))))
+    parser.add_argument("-n", "--count", dest="count", type=int, required=False, default=100000,
+                        help="Number of operations per benchmark")
+    parser.add_argument("--json", dest="json", action='store_true', required=False,
+                        help="Print the results as JSON for tracking regressions")
+
+    args = parser.parse_args()
+    for name in args.benchmarks:
+        if name not in _BENCHMARKS:
+            parser.error("unknown benchmark: {}".format(name))
+    return parser, args
+
+
+def main():
+    global _json
+
+    parser, args = _parse_commandline_arguments()
+    _json = args.json
+
+    for name in args.benchmarks or sorted(_BENCHMARKS):
+        _BENCHMARKS[name](args)
+
+    if _json:
+        print(json.dumps({'time': time.time(), 'count': args.count, 'results': _results}))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,377 @@
+import argparse
+import http.client
+import json
+import logging
+import socket
+import threading
+import traceback
+from os import getpid
+from platform import node
+from time import time
+from urllib.parse import urlsplit
+from werkzeug.serving import make_server
+from werkzeug.wrappers import Response
+
+BOUNDARY = 'mbotframe'
+
+
+class Frame:
+    """A camera frame as the multipart part sent to viewers, built once for all of them."""
+
+    __slots__ = ('seq', 'time', 'part', 'jpeg')
+
+    def __init__(self, seq, time, jpeg, telemetry=b'{}'):
+        self.seq = seq
+        self.time = time
+        header = b''.join((
+            '--{}\r\nContent-Type: image/jpeg\r\nContent-Length: {}\r\nX-Timestamp: {:.6f}\r\n'.format(
+                BOUNDARY, len(jpeg), time).encode(),
+            b'X-Telemetry: ', telemetry, b'\r\n\r\n'))
+        self.part = b''.join((header, jpeg, b'\r\n'))
+        # The JPEG data within the part
+        self.jpeg = memoryview(self.part)[len(header):-2]
+
+
+class FrameHub:
+    """Hands the latest camera frame to any number of viewers.
+
+       Viewers always get the newest frame once they are done sending the
+       previous one, so a slow viewer skips frames instead of buffering
+       them, and no viewer slows down the others or the camera.
+    """
+
+    def __init__(self):
+        self.viewers = 0
+        self.frames = 0
+        self.sent = 0
+        self.dropped = 0
+        self._cond = threading.Condition()
+        self._frame = None
+        self._closed = False
+
+    def publish(self, frame):
+        with self._cond:
+            self._frame = frame
+            self.frames += 1
+            self._cond.notify_all()
+
+    def latest(self):
+        return self._frame
+
+    def close(self):
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+
+    def stream(self, timeout=5):
+        """Yields the parts of one viewer until the hub is closed or no frame came for ``timeout`` seconds."""
+        with self._cond:
+            self.viewers += 1
+        try:
+            seq = None
+            while True:
+                with self._cond:
+                    if not self._cond.wait_for(
+                            lambda: self._closed or self._frame is not None and self._frame.seq != seq, timeout) \
+                            or self._closed:
+                        return
+                    frame = self._frame
+                    if seq is not None and frame.seq > seq + 1:
+                        self.dropped += frame.seq - seq - 1
+                    seq = frame.seq
+                    self.sent += 1
+                yield frame.part
+        finally:
+            with self._cond:
+                self.viewers -= 1
+
+    def stats(self):
+        return {
+            'viewers': self.viewers,
+            'frames': self.frames,
+            'sent': self.sent,
+            'dropped': self.dropped,
+        }
+
+
+class Telemetry:
+    """Sensor and battery values of the car, followed through its event stream."""
+
+    def __init__(self, url):
+        self.url = urlsplit(url)
+        self._lock = threading.Lock()
+        self._values = {}
+        self._json = b'{}'
+        self._stopped = threading.Event()
+
+    def json(self):
+        return self._json
+
+    def update(self, values):
+        with self._lock:
+            self._values.update(values)
+            self._json = json.dumps(self._values, separators=(',', ':')).encode()
+
+    def start(self):
+        self._th = threading.Thread(target=self._run, daemon=True)
+        self._th.start()
+
+    def close(self):
+        self._stopped.set()
+
+    def _run(self):
+        while not self._stopped.is_set():
+            try:
+                self._follow()
+            except (OSError, http.client.HTTPException, ValueError):
+                pass
+            self._stopped.wait(1)
+
+    def _follow(self):
+        conn = http.client.HTTPConnection(self.url.hostname, self.url.port or 80, timeout=60)
+        try:
+            conn.request('GET', self.url.path or '/')
+            response = conn.getresponse()
+            if response.status != 200:
+                return
+            while not self._stopped.is_set():
+                line = response.readline()
+                if not line:
+                    return
+                if line.startswith(b'data:'):
+                    # The first event carries all values, the others what changed
+                    self.update(json.loads(line[5:]))
+        finally:
+            conn.close()
+
+
+class MJPEGSource:
+    """Reads the multipart JPEG stream of mjpg_streamer over one connection and publishes its frames.
+
+       Data is received into one bytearray with ``recv_into`` and part
+       boundaries and headers are looked up in place. The body of a part
+       with a Content-Length is received straight into a buffer of its own,
+       so a frame is copied once, into the part sent to all viewers.
+    """
+
+    def __init__(self, url, hub, telemetry=None, buffer_size=1 << 16):
+        self.url = urlsplit(url)
+        self.hub = hub
+        self.telemetry = telemetry
+        self.buffer_size = buffer_size
+        self.connections = 0
+        self._seq = 0
+        self._stopped = threading.Event()
+        self._sock = None
+
+    def start(self):
+        self._th = threading.Thread(target=self._run, daemon=True)
+        self._th.start()
+
+    def close(self):
+        self._stopped.set()
+        sock = self._sock
+        if sock is not None:
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+        if hasattr(self, '_th'):
+            self._th.join(1)
+
+    def _run(self):
+        while not self._stopped.is_set():
+            try:
+                with socket.create_connection((self.url.hostname, self.url.port or 80), timeout=10) as sock:
+                    self._sock = sock
+                    self.connections += 1
+                    self._receive(sock)
+            except (OSError, ValueError):
+                if not self._stopped.is_set():
+                    traceback.print_exc()
+            finally:
+                self._sock = None
+            self._stopped.wait(1)
+
+    def _publish(self, jpeg, headers):
+        self._seq += 1
+        telemetry = b'{}' if self.telemetry is None else self.telemetry.json()
+        try:
+            # Capture time set by mjpg_streamer
+            timestamp = float(headers['x-timestamp'])
+        except (KeyError, ValueError):
+            timestamp = time()
+        self.hub.publish(Frame(self._seq, timestamp, jpeg, telemetry))
+
+    def _receive(self, sock):
+        path = self.url.path or '/'
+        if self.url.query:
+            path += '?' + self.url.query
+        sock.sendall('GET {} HTTP/1.0\r\nHost: {}\r\n\r\n'.format(path, self.url.netloc).encode())
+
+        buffer = bytearray(self.buffer_size)
+        view = memoryview(buffer)
+        filled = 0
+        position = 0
+
+        def fill():
+            nonlocal buffer, view, filled, position
+            if position:
+                # Move what is left to the front; the same size, so the view stays valid
+                buffer[:filled - position] = view[position:filled]
+                filled -= position
+                position = 0
+            if filled == len(buffer):
+                view.release()
+                buffer = buffer + bytes(len(buffer))
+                view = memoryview(buffer)
+            n = sock.recv_into(view[filled:])
+            if not n:
+                raise EOFError
+            filled += n
+
+        try:
+            # Response headers
+            while buffer.find(b'\r\n\r\n', 0, filled) < 0:
+                fill()
+            end = buffer.find(b'\r\n\r\n', 0, filled)
+            headers = _headers(view[:end])
+            status = bytes(view[:buffer.find(b'\r\n', 0, end)]).split()
+            if len(status) < 2 or status[1] != b'200':
+                raise ValueError("upstream answered {}".format(b' '.join(status[1:]).decode('ascii', 'replace')))
+            _, _, boundary = headers.get('content-type', '').partition('boundary=')
+            if not boundary:
+                raise ValueError("not a multipart stream")
+            delimiter = b'--' + boundary.strip('"').lstrip('-').encode()
+            position = end + 4
+
+            while not self._stopped.is_set():
+                start = buffer.find(delimiter, position, filled)
+                if start < 0:
+                    # Keep a partial delimiter at the end
+                    position = max(position, filled - len(delimiter))
+                    fill()
+                    continue
+                end = buffer.find(b'\r\n\r\n', start, filled)
+                if end < 0:
+                    position = start
+                    fill()
+                    continue
+                part = _headers(view[start:end])
+                length = part.get('content-length')
+                body = end + 4
+
+                if length is not None:
+                    length = int(length)
+                    jpeg = bytearray(length)
+                    have = min(filled - body, length)
+                    jpeg[:have] = view[body:body + have]
+                    position = body + have
+                    with memoryview(jpeg) as rest:
+                        while have < length:
+                            n = sock.recv_into(rest[have:])
+                            if not n:
+                                raise EOFError
+                            have += n
+                    self._publish(jpeg, part)
+                else:
+                    # Without a length the part ends where the next one starts
+                    while True:
+                        end = buffer.find(b'\r\n' + delimiter, body, filled)
+                        if end >= 0:
+                            break
+                        offset = body - position
+                        fill()
+                        body = position + offset
+                    self._publish(view[body:end], part)
+                    position = end
+        except EOFError:
+            pass
+        finally:
+            view.release()
+
+
+def _headers(data):
+    """Parses the header lines of a part or response, skipping the first line."""
+    headers = {}
+    for line in bytes(data).split(b'\r\n')[1:]:
+        name, _, value = line.decode('latin-1').partition(':')
+        headers[name.strip().lower()] = value.strip()
+    return headers
+
+
+# Variables
+_hub = FrameHub()
+_source: MJPEGSource = None
+
+
+def _dispatch_request(environ, start_response):
+    if environ.get('PATH_INFO') == '/stream':
+        response = Response(_hub.stream(), mimetype='multipart/x-mixed-replace; boundary=' + BOUNDARY,
+                            direct_passthrough=True)
+        response.headers['Cache-Control'] = 'no-cache'
+        # Tell nginx not to buffer the frames
+        response.headers['X-Accel-Buffering'] = 'no'
+        return response(environ, start_response)
+
+    if environ.get('PATH_INFO') == '/snapshot':
+        frame = _hub.latest()
+        if frame is None:
+            response = Response("No frame yet", status=503)
+        else:
+            response = Response(bytes(frame.jpeg), mimetype='image/jpeg')
+            response.headers['Cache-Control'] = 'no-cache'
+            response.headers['X-Timestamp'] = '{:.6f}'.format(frame.time)
+        return response(environ, start_response)
+
+    stats = _hub.stats()
+    if _source is not None:
+        stats['connections'] = _source.connections
+    response = Response(json.dumps(stats), mimetype='application/json')
+    return response(environ, start_response)
+
+
+def _parse_commandline_arguments():
+    parser = argparse.ArgumentParser(description='mBot Car camera')
+
+    parser.add_argument("-u", "--upstream", dest="upstream", required=False,
+                        default='http://127.0.0.1:8090/?action=stream', help="MJPEG stream of the camera")
+    parser.add_argument("-t", "--telemetry", dest="telemetry", required=False,
+                        default='http://127.0.0.1:8060/stream',
+                        help="Event stream of the car with the values sent along with each frame, or none")
+    parser.add_argument("-hp", "--http-port", dest="http_port", type=int, required=False, default=8091,
+                        help="HTTP port for viewers")
+
+    args = parser.parse_args()
+    return parser, args
+
+
+def main():
+    global _source
+
+    parser, args = _parse_commandline_arguments()
+    logging.getLogger('werkzeug').setLevel(logging.WARNING)
+
+    telemetry = None
+    if args.telemetry != 'none':
+        telemetry = Telemetry(args.telemetry)
+        telemetry.start()
+    _source = MJPEGSource(args.upstream, _hub, telemetry)
+    _source.start()
+
+    server = make_server('0.0.0.0', args.http_port, _dispatch_request, threaded=True)
+    print("Starting {} on {}:{} with PID {}".format(parser.description, node(), server.port, getpid()))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        print("Stopping {}".format(parser.description))
+        _hub.close()
+        _source.close()
+        if telemetry is not None:
+            telemetry.close()
+
+
+if __name__ == '__main__':
+    main()
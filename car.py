@@ -1,159 +1,177 @@
 import argparse
+import asyncio
 import threading
-import subprocess
-import pygame
 import time
-import signal
+import traceback
 import json
 import mBot
+import aiobot
+import control
+import poller
+import metrics
+import ticker
+import inputs
+import link
+import power
+import recorder
+import state
+import stream
 import INA219
 from os import getpid
 from platform import node
-from functools import partial
+from werkzeug.http import parse_etags
 from werkzeug.serving import make_server
-from werkzeug.wrappers import Response
+from werkzeug.wrappers import Request, Response
 
 # Constants
-velocity_max = 150
-velocity_min = 75
-distance_max = 20
-distance_min = 5
-curve_max = 2.5
-curve_min = 1.0
-light_threshold = 200
-headlight_time_sec = 30
-
-# Sensors
-_distance: float = None
-_light: float = None
-_line_follow: float = None
-_button: float = None
-
-_battery: float = None
-_bus_voltage: float = None
-_shunt_voltage: float = None
-_current: float = None
-_power: float = None
+power_averaging = {1: INA219.ADCResolution.ADCRES_12BIT_1S, 2: INA219.ADCResolution.ADCRES_12BIT_2S,
+                   4: INA219.ADCResolution.ADCRES_12BIT_4S, 8: INA219.ADCResolution.ADCRES_12BIT_8S,
+                   16: INA219.ADCResolution.ADCRES_12BIT_16S, 32: INA219.ADCResolution.ADCRES_12BIT_32S,
+                   64: INA219.ADCResolution.ADCRES_12BIT_64S, 128: INA219.ADCResolution.ADCRES_12BIT_128S}
+
+# Sensors, written by the mBot reader and the power monitor
+_state = state.StateStore(control.SENSORS, control.max_ages)
 
 # Variables
 _stop_main_event = threading.Event()
+_loop_timer = metrics.LoopTimer(1 / 20)
+_ticker: ticker.Ticker = None
+_telemetry = power.PowerTelemetry()
+_stream = stream.Broadcaster()
+_snapshot = stream.SnapshotCache(('Sensors', 'Battery'))
+_bot: mBot.mBot = None
+_sensors: poller.SensorPoller = None
+_controller = None
+_link: link.LinkMonitor = None
+_recorder: recorder.FlightRecorder = None
 
 
 def _on_distance(value):
-    global _distance
-    _distance = value
+    _state.write('distance', value)
+    _publish('Sensors', control.sensors_view(_state))
 
 
 def _on_light(value):
-    global _light
-    _light = value
+    _state.write('light', value)
+    _publish('Sensors', control.sensors_view(_state))
+
+
+def _publish(group, values):
+    _snapshot.update(group, values)
+    _stream.update(values)
 
 
 def _on_button(value):
-    global _button
-    _button = value
+    _state.write('button', value)
 
 
 def _on_line_follow(value):
-    global _line_follow
-    _line_follow = value
-
-
-def _obstacle_avoidance(direction, distance, distance_min, distance_max, velocity_min, velocity_max):
-    return velocity_max if direction < 0 \
-                           or distance is None \
-                           or distance > distance_max \
-        else 0 if distance < distance_min \
-        else velocity_min if distance_max <= distance_min \
-        else velocity_min + (min(distance, distance_max) - distance_min) * \
-             (velocity_max - velocity_min) / (distance_max - distance_min)
-
-
-def _loop(bot, clock, button_cmd):
-    old_left_speed = 0
-    old_right_speed = 0
-    old_headlights = False
-    old_button = None
-    horn_time = 0
-    headlights_time = 0
-    curve = curve_max
-    while not _stop_main_event.is_set():
-        if not bot.is_alive() and not bot.start(True):
-            time.sleep(1)
-            continue
-
-        # bot.requestLineFollower(10, 2, _on_line_follow)
-        bot.requestUltrasonicSensor(20, 3, _on_distance)
-        bot.requestLightOnBoard(30, _on_light)
-        bot.requestButtonOnBoard(40, _on_button)
-
-        clock.tick(20)
-
-        horn = False
-        for event in pygame.event.get():
-            if event.type == pygame.QUIT:
-                _stop_main_event.set()
-            elif event.type == pygame.JOYBUTTONDOWN:
-                horn = True
-
-        joystick_count = pygame.joystick.get_count()
-        if joystick_count > 0:
-            joystick = pygame.joystick.Joystick(joystick_count - 1)
-            joystick.init()
-            try:
-                axis1 = joystick.get_axis(0)
-                axis2 = joystick.get_axis(1)
-            finally:
-                joystick.quit()
-        else:
-            axis1 = 0
-            axis2 = 0
-
-        # Move if joystick axes are moving
-        steering = -axis1
-        direction = -axis2
+    _state.write('line_follow', value)
+
+
+def _tick(controller, joystick):
+    _loop_timer.begin()
+    axis1, axis2, horn = joystick.read()
+    changed = joystick.changed
+    joystick.changed = None
+    _loop_timer.phase('input')
+    controller.step(axis1, axis2, horn)
+    if _recorder is not None:
+        _recorder.tick(axis1, axis2, *controller.speeds)
+    if changed is not None:
+        _loop_timer.input(changed)
+    _loop_timer.end()
+
+
+def _loop(bot, joystick, button_cmd, rates, shaper, link_min_scale):
+    global _sensors
+    global _controller
+    global _link
+
+    sensors = _sensors = control.sensor_poller(bot, rates, _on_distance, _on_light, _on_button)
+    controller = _controller = control.Controller(bot, button_cmd, _state, _loop_timer, sensors, shaper=shaper)
+    link_monitor = _link = link.LinkMonitor(bot, sensors, _ticker, _loop_timer, min_scale=link_min_scale)
+    sensors.start()
+    try:
+        while not _stop_main_event.is_set():
+            if not bot.is_alive():
+                if not bot.start(True):
+                    time.sleep(1)
+                    continue
+                sensors.reset()
+
+            # React to the joystick at once rather than at the next tick. A tick
+            # run early for input takes the place of the next one, so input
+            # cannot run the loop and send commands faster than its rate.
+            delay = _ticker.remaining()
+            hold = delay - _ticker.period
+            if hold > 0:
+                _stop_main_event.wait(hold)
+                delay = _ticker.remaining()
+            if delay > 0:
+                joystick.wait(delay)
+            _ticker.advance()
+
+            _tick(controller, joystick)
+            link_monitor.update()
+
+        controller.stop()
+    finally:
+        sensors.close()
 
-        speed = _obstacle_avoidance(direction, _distance, distance_min, distance_max, velocity_min, velocity_max)
 
-        left_speed = round(direction * speed * (1 - steering / curve))
-        right_speed = round(direction * speed * (1 + steering / curve))
+async def _async_sensors(sensors):
+    while not _stop_main_event.is_set():
+        await asyncio.sleep(sensors.poll())
 
-        if old_left_speed != left_speed or old_right_speed != right_speed:
-            bot.doMove(left_speed, right_speed)
 
-        # Turn the headlights on in the evening
-        headlights = True if _light is not None and _light < light_threshold \
-                             or (old_headlights and time.time() - headlights_time < headlight_time_sec) else False
+async def _async_power_monitor(averaging, rate):
+    try:
+        ina219 = _create_power_monitor(averaging)
+    except OSError:
+        traceback.print_exc()
+        return
+
+    # A triggered read sleeps through the conversion, 34 ms at 32 samples,
+    # so it runs in a worker thread rather than on the event loop
+    loop = asyncio.get_running_loop()
+    pace = ticker.Ticker(rate)
+    while not _stop_main_event.is_set():
+        await asyncio.sleep(max(pace.remaining(), 0))
+        pace.advance()
+        await loop.run_in_executor(None, _read_power, ina219)
 
-        if old_headlights != headlights:
-            if headlights:
-                bot.doRGBLedOnBoard(0, 253, 172, 10)
-            else:
-                bot.doRGBLedOnBoard(0, 0, 0, 0)
-            headlights_time = time.time()
 
-        # Play horn if any joystick button is pressed
-        if horn and time.time() - horn_time >= 0.500:
-            bot.doBuzzer(123, 250)
-            horn_time = time.time()
+async def _async_loop(bot, joystick, button_cmd, rates, shaper, link_min_scale, averaging, power_rate):
+    global _sensors
+    global _controller
+    global _link
 
-        # Beep if battery is low and needs charge
-        if _battery is not None and _battery < 15 and time.time() - horn_time >= 60:
-            bot.doBuzzer(1400, 250)
-            horn_time = time.time()
+    sensors = _sensors = control.sensor_poller(bot, rates, _on_distance, _on_light, _on_button)
+    link_monitor = _link = link.LinkMonitor(bot, sensors, _ticker, _loop_timer, min_scale=link_min_scale)
+    tasks = [asyncio.ensure_future(_async_sensors(sensors)),
+             asyncio.ensure_future(_async_power_monitor(averaging, power_rate))]
+    try:
+        controller = _controller = control.Controller(bot, button_cmd, _state, _loop_timer, sensors, shaper=shaper)
+        while not _stop_main_event.is_set():
+            if not bot.is_alive():
+                if not await bot.start(True):
+                    await asyncio.sleep(1)
+                    continue
+                sensors.reset()
 
-        # Run an arbitrary command when teh onboard button is pressed
-        button = True if _button == 0 else False if _button == 1023 else None
-        if button and button != old_button:
-            subprocess.run(button_cmd)
+            await asyncio.sleep(max(_ticker.remaining(), 0))
+            _ticker.advance()
 
-        old_left_speed = left_speed
-        old_right_speed = right_speed
-        old_headlights = headlights
-        old_button = button
+            _tick(controller, joystick)
+            link_monitor.update()
 
-    bot.doMove(0, 0)
-    bot.doRGBLedOnBoard(0, 0, 0, 0)
+        controller.stop()
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        await bot.close()
 
 
 def _parse_commandline_arguments():
@@ -165,57 +183,251 @@ def _parse_commandline_arguments():
                         help="HTTP port for reading metrics")
     parser.add_argument("-bc", "--button-cmd", nargs='+', dest="button_cmd", required=False,
                         help="A sequence of program arguments to run when the onboard button is pressed")
+    parser.add_argument("-r", "--rate", dest="rate", type=float, required=False, default=20,
+                        help="Control loop rate in Hz")
+    parser.add_argument("--tick-policy", dest="tick_policy", required=False, default=ticker.SKIP,
+                        choices=[ticker.SKIP, ticker.CATCH_UP],
+                        help="Whether control loop ticks missed are dropped or run late")
+    parser.add_argument("--cpu", dest="cpu", type=int, required=False,
+                        help="Pin the control loop to a CPU")
+    parser.add_argument("--rt-priority", dest="rt_priority", type=int, required=False,
+                        help="Run the control loop with SCHED_FIFO at this priority, 1-99")
+    parser.add_argument("--nice", dest="nice", type=int, required=False,
+                        help="Nice value of the control loop")
+    parser.add_argument("--input", dest="input", required=False, default='pygame', choices=['pygame', 'js', 'none'],
+                        help="Joystick input: pygame, the Linux joystick device without pygame, or none")
+    parser.add_argument("--joystick-device", dest="joystick_device", required=False, default='/dev/input/js*',
+                        help="Joystick devices the js input drives with the last one plugged in of")
+    parser.add_argument("--deadband", dest="deadband", type=float, required=False, default=0.05,
+                        help="Joystick axis values closer to the centre read as 0")
+    parser.add_argument("--axis-threshold", dest="axis_threshold", type=float, required=False, default=0.02,
+                        help="Smallest joystick axis change acted upon")
+    control.add_arguments(parser)
+    parser.add_argument("--link-min-scale", dest="link_min_scale", type=float, required=False, default=0.25,
+                        help="Share of the sensor poll and control loop rates a slow link may scale them down to, "
+                             "1 for fixed rates")
+    parser.add_argument("-pa", "--power-averaging", dest="power_averaging", type=int, required=False, default=32,
+                        choices=sorted(power_averaging),
+                        help="Number of ADC samples the power monitor averages per reading")
+    parser.add_argument("--power-rate", dest="power_rate", type=float, required=False, default=10,
+                        help="Power monitor readings per second")
+    parser.add_argument("--battery-capacity", dest="battery_capacity", type=float, required=False, default=2000,
+                        help="Battery capacity in mAh")
+    parser.add_argument("--stream-rate", dest="stream_rate", type=float, required=False, default=5,
+                        help="Most updates per second pushed to viewers of the sensor stream")
+    parser.add_argument("--record", dest="record", required=False,
+                        help="Directory to keep a log of serial traffic, control loop ticks and power readings in")
+    parser.add_argument("--record-size", dest="record_size", type=int, required=False, default=64,
+                        help="Megabytes the log is limited to, the oldest records overwritten first")
+    parser.add_argument("--asyncio", dest="asyncio", action='store_true', required=False,
+                        help="Run the robot, sensors and power monitor on one asyncio event loop")
 
     args = parser.parse_args()
+    if args.rate <= 0:
+        parser.error("invalid rate: {}".format(args.rate))
+    if not 0 < args.link_min_scale <= 1:
+        parser.error("invalid link scale: {}".format(args.link_min_scale))
+    if args.record_size < 1:
+        parser.error("invalid record size: {}".format(args.record_size))
+    if args.stream_rate <= 0:
+        parser.error("invalid stream rate: {}".format(args.stream_rate))
+    if args.power_rate <= 0:
+        parser.error("invalid power rate: {}".format(args.power_rate))
+    if args.battery_capacity <= 0:
+        parser.error("invalid battery capacity: {}".format(args.battery_capacity))
+
+    control.check_arguments(parser, args)
+
     return parser, args
 
 
-def _install_signal_handler():
-    for s in [signal.SIGINT, signal.SIGTERM]:
-        signal.signal(s, partial(lambda stop_event, *_args: stop_event.set(), _stop_main_event))
+def _create_power_monitor(averaging):
+    ina219 = INA219.INA219(addr=0x42)
+    # Sample on demand, so that all readings come from one conversion
+    ina219.set_sampling(INA219.Mode.SANDBVOLT_TRIGGERED, power_averaging[averaging])
+    return ina219
 
 
-def _power_monitor():
-    global _bus_voltage
-    global _shunt_voltage
-    global _current
-    global _power
-    global _battery
+def _power_monitor(averaging, rate):
+    ina219 = _create_power_monitor(averaging)
 
-    ina219 = INA219.INA219(addr=0x42)
+    pace = ticker.Ticker(rate)
+    while pace.wait(_stop_main_event):
+        _read_power(ina219)
 
-    while not _stop_main_event.wait(2):
-        _bus_voltage = ina219.getBusVoltage_V()  # voltage on V- (load side)
-        _shunt_voltage = ina219.getShuntVoltage_mV() / 1000  # voltage between V+ and V- across the shunt
-        _current = ina219.getCurrent_mA()  # current in mA
-        _power = ina219.getPower_W()  # power in W
-        p = (_bus_voltage - 6) / 2.4 * 100
-        if (p > 100): p = 100
-        if (p < 0): p = 0
-        _battery = p
 
+def _read_power(ina219):
+    snapshot = ina219.read_snapshot()
+    if snapshot is None:
+        return
+    _state.write('power', snapshot, snapshot.time)
+    if _recorder is not None:
+        _recorder.power(snapshot)
+    _telemetry.add(snapshot)
+    _state.write('battery', _telemetry.battery.soc * 100, snapshot.time)
+    _publish('Battery', _battery_view())
 
-def _dispatch_request(environ, start_response):
-    sensors = dict()
-    if _distance is not None:
-        sensors['Distance'] = "{:.1f} cm".format(_distance)
-    if _light is not None:
-        sensors['Light'] = "{:.0f}".format(_light)
 
-    battery = dict()
-    if _battery is not None:
-        battery['PSU Voltage'] = "{:.3f} V".format(_bus_voltage + _shunt_voltage)
-        battery['Shunt Voltage'] = "{:.6f} V".format(_shunt_voltage)
-        battery['Load Voltage'] = "{:.3f} V".format(_bus_voltage)
-        battery['Current'] = "{:.6f} A".format(_current / 1000)
-        battery['Power'] = "{:.3f} W".format(_power)
-        battery['Percent'] = "{:.1f}%".format(_battery)
+def _power_history(request):
+    resolution = request.args.get('resolution', 'raw')
+    if resolution not in power.PowerTelemetry.RESOLUTIONS:
+        return Response("Unknown resolution: {}".format(resolution), status=400)
+    since = request.args.get('since', type=float)
+    columns, rows = _telemetry.history(resolution, since)
+    if request.args.get('format') == 'binary':
+        response = Response(power.PowerTelemetry.pack(rows), mimetype='application/octet-stream')
+        response.headers['X-Columns'] = ','.join(columns)
+        return response
 
-    metrics = dict()
-    metrics['Sensors'] = sensors
-    metrics['Battery'] = battery
-    response = Response(json.dumps(metrics, indent=4), mimetype='application/json')
-    return response(environ, start_response)
+    width = len(columns)
+    series = {column: rows[i::width].tolist() for i, column in enumerate(columns)}
+    return Response(json.dumps(series, separators=(',', ':')), mimetype='application/json')
+
+
+def _dispatch_request(environ, start_response):
+    if environ.get('PATH_INFO') == '/power/history':
+        response = _power_history(Request(environ))
+        return response(environ, start_response)
+
+    if environ.get('PATH_INFO') == '/stream':
+        response = Response(_stream.stream(), mimetype='text/event-stream', direct_passthrough=True)
+        response.headers['Cache-Control'] = 'no-cache'
+        # Tell nginx not to buffer the events
+        response.headers['X-Accel-Buffering'] = 'no'
+        return response(environ, start_response)
+
+    if environ.get('PATH_INFO') == '/timing':
+        timing = _loop_timer.snapshot()
+        if _ticker is not None:
+            timing['scheduler'] = _ticker.stats()
+        timing['stream'] = _stream.stats()
+        response = Response(json.dumps(timing), mimetype='application/json')
+        return response(environ, start_response)
+
+    if environ.get('PATH_INFO') == '/link':
+        response = Response(json.dumps({} if _link is None else _link.stats()), mimetype='application/json')
+        return response(environ, start_response)
+
+    if environ.get('PATH_INFO') == '/metrics':
+        body = _exposition().encode()
+        start_response('200 OK', [('Content-Type', metrics.Exposition.CONTENT_TYPE),
+                                  ('Content-Length', str(len(body)))])
+        return [body]
+
+    return _serve_snapshot(environ, start_response)
+
+
+def _exposition():
+    exposition = metrics.Exposition()
+
+    if _bot is not None:
+        counters = _bot.counters()
+        exposition.counter('mbot_sent_bytes', "Bytes written to the robot", counters.get('bytesSent', 0))
+        exposition.counter('mbot_sent_frames', "Frames written to the robot", counters.get('framesSent', 0))
+        exposition.counter('mbot_coalesced_frames', "Frames replaced by a newer one before they were sent",
+                           counters.get('coalesced', 0))
+        exposition.counter('mbot_received_bytes', "Bytes read from the robot", counters.get('bytesReceived', 0))
+        exposition.counter('mbot_received_frames', "Reply frames read from the robot",
+                           counters.get('framesReceived', 0))
+        exposition.counter('mbot_dropped_bytes', "Bytes read from the robot that were not part of a frame",
+                           counters.get('bytesDropped', 0))
+        exposition.counter('mbot_requests', "Sensor requests sent", counters['requests'])
+        exposition.counter('mbot_request_timeouts', "Sensor requests unanswered in time", counters['timeoutsByExtID'],
+                           'ext_id')
+        exposition.counter('mbot_unsolicited_replies', "Replies to no request in flight", counters['unsolicited'])
+        exposition.counter('mbot_starts', "Connections to the robot, the first one included", counters['starts'])
+        exposition.gauge('mbot_pending_requests', "Sensor requests awaiting a reply", counters['pending'])
+        exposition.gauge('mbot_queued_frames', "Frames waiting to be written", counters['queueDepth'])
+        exposition.counter('mbot_queue_seconds', "Time frames waited to be written", counters.get('queueSeconds', 0))
+
+    if _link is not None:
+        stats = _link.stats()
+        exposition.gauge('mbot_link_rtt_seconds', "Round trip time of sensor requests over the last 10 seconds",
+                         {'0.5': stats['rtt']['p50'], '0.9': stats['rtt']['p90'], '0.99': stats['rtt']['p99']},
+                         'quantile')
+        exposition.gauge('mbot_link_loss_ratio', "Share of sensor requests timed out", stats['loss'])
+        exposition.gauge('mbot_link_bytes_per_second', "Bytes sent and received per second",
+                         stats['bytes_per_second'])
+        exposition.gauge('mbot_link_scale', "Share of the sensor poll and control loop rates the link allows",
+                         stats['scale'])
+        exposition.counter('mbot_link_congestions', "Link updates that found the link congested",
+                           stats['congestions'])
+
+    timer = _loop_timer
+    exposition.counter('car_loop_ticks', "Control loop ticks", timer.ticks)
+    exposition.counter('car_loop_overruns', "Control loop ticks longer than the period", timer.overruns)
+    exposition.counter('car_loop_missed', "Control loop ticks that started more than half a period late",
+                       timer.missed)
+    exposition.histogram('car_loop_tick_seconds', "Duration of control loop ticks", timer.tick)
+    if _controller is not None:
+        exposition.counter('car_motor_commands', "Motor speed changes sent", _controller.moves)
+        stats = _controller.shaper.stats()
+        exposition.counter('car_motion_wanted', "Motor speed changes asked for before shaping", stats['wanted'])
+        exposition.counter('car_motion_keepalives', "Motor commands sent again unchanged", stats['keepalives'])
+        exposition.counter('car_motion_stops', "Emergency stops sent without ramping", stats['stops'])
+        exposition.gauge('car_motion_saved_per_minute', "Motor commands saved by shaping per minute",
+                         stats['saved_per_minute'])
+
+    exposition.gauge('car_sensor_value', "Last value read from a sensor",
+                     {'ultrasonic': _state.read('distance').value, 'light': _state.read('light').value,
+                      'button': _state.read('button').value}, 'sensor')
+    if _sensors is not None:
+        stats = _sensors.stats()
+        exposition.counter('car_sensor_misses', "Sensor samples given up after retries",
+                           {name: sensor['misses'] for name, sensor in stats.items()}, 'sensor')
+        exposition.gauge('car_sensor_age_seconds', "Age of the last value read from a sensor",
+                         {name: sensor['age'] for name, sensor in stats.items()}, 'sensor')
+
+    snapshot = _state.read('power').value
+    if snapshot is not None:
+        exposition.gauge('car_bus_voltage_volts', "Voltage on the load side of the shunt", snapshot.bus_voltage_V)
+        exposition.gauge('car_shunt_voltage_volts', "Voltage across the shunt", snapshot.shunt_voltage_mV / 1000)
+        exposition.gauge('car_current_amperes', "Current drawn from the battery", snapshot.current_mA / 1000)
+        exposition.gauge('car_power_watts', "Power drawn from the battery", snapshot.power_W)
+    battery = _state.read('battery').value
+    exposition.gauge('car_battery_ratio', "Estimated state of charge of the battery",
+                     None if battery is None else battery / 100)
+    stats = _telemetry.stats()
+    exposition.counter('car_battery_energy_joules', "Energy drawn from the battery", stats['energy_mWh'] * 3.6)
+    exposition.counter('car_battery_charge_coulombs', "Charge drawn from the battery", stats['charge_mAh'] * 3.6)
+    return exposition.text()
+
+
+def _serve_snapshot(environ, start_response):
+    snapshot = _snapshot.get()
+    if parse_etags(environ.get('HTTP_IF_NONE_MATCH')).contains(snapshot.etag[1:-1]):
+        start_response('304 Not Modified', [('ETag', snapshot.etag)])
+        return []
+
+    headers = [('Content-Type', 'application/json'), ('ETag', snapshot.etag), ('Cache-Control', 'no-cache'),
+               ('Vary', 'Accept-Encoding')]
+    if 'gzip' in environ.get('HTTP_ACCEPT_ENCODING', ''):
+        body = snapshot.gzip()
+        headers.append(('Content-Encoding', 'gzip'))
+    else:
+        body = snapshot.body()
+    headers.append(('Content-Length', str(len(body))))
+    start_response('200 OK', headers)
+    return [body]
+
+
+def _battery_view():
+    battery = dict()
+    sensors = _state.snapshot()
+    snapshot = sensors['power'].value
+    percent = sensors['battery'].value
+    if snapshot is not None and percent is not None:
+        shunt_voltage = snapshot.shunt_voltage_mV / 1000  # voltage between V+ and V- across the shunt
+        battery['PSU Voltage'] = "{:.3f} V".format(snapshot.bus_voltage_V + shunt_voltage)
+        battery['Shunt Voltage'] = "{:.6f} V".format(shunt_voltage)
+        battery['Load Voltage'] = "{:.3f} V".format(snapshot.bus_voltage_V)  # voltage on V- (load side)
+        battery['Current'] = "{:.6f} A".format(snapshot.current_mA / 1000)
+        battery['Power'] = "{:.3f} W".format(snapshot.power_W)
+        battery['Percent'] = "{:.1f}%".format(percent)
+        stats = _telemetry.stats()
+        battery['Energy'] = "{:.1f} mWh".format(stats['energy_mWh'])
+        battery['Charge'] = "{:.1f} mAh".format(stats['charge_mAh'])
+    return battery
 
 
 def _http_serve(port):
@@ -227,39 +439,70 @@ def _http_serve(port):
 
 
 def _stop_http(server, server_thread):
+    _stream.close()
     server.shutdown()
     server_thread.join(30)
 
 
 def main():
+    global _ticker
+    global _bot
+    global _recorder
+
     parser, args = _parse_commandline_arguments()
 
-    pygame.init()
+    _ticker = ticker.Ticker(args.rate, args.tick_policy)
+    _loop_timer.period = _ticker.period
+    _telemetry.battery.capacity_mAh = args.battery_capacity
+    if args.record is not None:
+        # Rotating overwrites one of 16 segments at a time
+        _recorder = recorder.FlightRecorder(args.record, (args.record_size << 20) // 16, 16)
+        _recorder.open()
+
+    shaper = control.motion_shaper(args)
+
+    if args.input == 'pygame':
+        joystick = inputs.PygameInput(args.deadband, args.axis_threshold, _stop_main_event.set)
+    elif args.input == 'js':
+        joystick = inputs.JoystickInput(args.deadband, args.axis_threshold, args.joystick_device)
+    else:
+        joystick = inputs.NullInput()
     try:
-        pygame.joystick.init()
-
-        clock = pygame.time.Clock()
-
-        _install_signal_handler()
+        control.install_signal_handler(_stop_main_event)
         try:
-            threading.Thread(target=_power_monitor).start()
+            if not args.asyncio:
+                threading.Thread(target=_power_monitor, args=(args.power_averaging, args.power_rate)).start()
 
+            _stream.period = 1 / args.stream_rate
+            _stream.start()
             server, server_thread = _http_serve(args.http_port)
             try:
-                bot = mBot.mBot()
-                bot.createSerial(args.serial_port)
-                try:
-                    print("Starting {} on {}:{} with PID {}".format(parser.description, node(), server.port, getpid()))
-                    _loop(bot, clock, args.button_cmd)
-                    print("Stopping {}".format(parser.description))
-                finally:
-                    bot.close()
+                print("Starting {} on {}:{} with PID {}".format(parser.description, node(), server.port, getpid()))
+                if args.cpu is not None or args.rt_priority is not None or args.nice is not None:
+                    ticker.set_realtime(args.cpu, args.rt_priority, args.nice)
+                if args.asyncio:
+                    bot = _bot = aiobot.mBotAsync()
+                    bot.createSerial(args.serial_port)
+                    bot.recorder = _recorder
+                    asyncio.run(_async_loop(bot, joystick, args.button_cmd, args.poll_rates, shaper,
+                                            args.link_min_scale, args.power_averaging, args.power_rate))
+                else:
+                    bot = _bot = mBot.mBot()
+                    bot.createSerial(args.serial_port)
+                    bot.recorder = _recorder
+                    try:
+                        _loop(bot, joystick, args.button_cmd, args.poll_rates, shaper, args.link_min_scale)
+                    finally:
+                        bot.close()
+                print("Stopping {}".format(parser.description))
             finally:
                 _stop_http(server, server_thread)
         finally:
             _stop_main_event.set()
     finally:
-        pygame.quit()
+        joystick.close()
+        if _recorder is not None:
+            _recorder.close()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,241 @@
+import signal
+import subprocess
+import time
+import motion
+import poller
+
+# Constants
+velocity_max = 150
+velocity_min = 75
+velocity_safe = 75  # forward speed when the distance ahead is unknown
+distance_max = 20
+distance_min = 5
+curve_max = 2.5
+curve_min = 1.0
+light_threshold = 200
+headlight_time_sec = 30
+poll_rates = {'ultrasonic': (10, 25), 'light': (1, 1), 'button': (5, 5)}  # base and maximum Hz
+
+# Values kept in the state store of a car and seconds until they are stale
+SENSORS = ('distance', 'light', 'line_follow', 'button', 'power', 'battery')
+max_ages = {'distance': 0.5, 'light': 5, 'button': 1, 'power': 10, 'battery': 10}
+# Store values read by each polled sensor
+FIELDS = {'ultrasonic': 'distance', 'light': 'light', 'button': 'button'}
+
+
+def obstacle_avoidance(direction, distance, distance_min, distance_max, velocity_min, velocity_max):
+    return velocity_max if direction < 0 \
+                           or distance is None \
+                           or distance > distance_max \
+        else 0 if distance < distance_min \
+        else velocity_min if distance_max <= distance_min \
+        else velocity_min + (min(distance, distance_max) - distance_min) * \
+             (velocity_max - velocity_min) / (distance_max - distance_min)
+
+
+class Controller:
+    """Driving logic of one control loop tick, shared by car.py, fleet.py and the replay harness.
+
+       Sensor values come from ``store``, phases are timed with ``timer``.
+       The wall clock and the way the button command is run can be replaced
+       for replays. Motor speeds go through the motion shaper.
+    """
+
+    def __init__(self, bot, button_cmd, store, timer, sensors=None, clock=time.time, run=subprocess.run,
+                 shaper=None):
+        self._bot = bot
+        self._button_cmd = button_cmd
+        self._sensors = sensors
+        self.shaper = motion.MotionShaper() if shaper is None else shaper
+        self._store = store
+        self._timer = timer
+        self._clock = clock
+        self._run = run
+        self._old_left_speed = 0
+        self._old_right_speed = 0
+        self._old_headlights = False
+        self._old_button = None
+        self._horn_time = 0
+        self._headlights_time = 0
+        self._curve = curve_max
+        self.moves = 0
+
+    @property
+    def speeds(self):
+        """Wheel speeds of the last move command sent."""
+        return self._old_left_speed, self._old_right_speed
+
+    def step(self, axis1, axis2, horn):
+        bot = self._bot
+        timer = self._timer
+
+        sensors = self._store.snapshot()
+        distance = sensors.value('distance')
+        light = sensors.value('light')
+        for name, field in (('ultrasonic', 'distance'), ('light', 'light')):
+            age = sensors.age(field)
+            if age is not None:
+                timer.age(name, age)
+        timer.phase('sensors')
+
+        # Move if joystick axes are moving
+        steering = -axis1
+        direction = -axis2
+
+        speed = obstacle_avoidance(direction, distance, distance_min, distance_max, velocity_min, velocity_max)
+        if direction > 0 and distance is None:
+            # The distance reading is missing or too old to trust
+            speed = min(speed, velocity_safe)
+
+        # Look ahead more often the faster the car drives forward
+        if self._sensors is not None:
+            self._sensors.scale('ultrasonic', direction * speed / velocity_max)
+
+        left_speed = round(direction * speed * (1 - steering / self._curve))
+        right_speed = round(direction * speed * (1 + steering / self._curve))
+        timer.phase('mixing')
+
+        # Stop at once when an obstacle is close ahead
+        now = self._clock()
+        speeds = self.shaper.update(left_speed, right_speed, now, direction > 0 and speed == 0)
+        if speeds is not None:
+            left_speed, right_speed = speeds
+            bot.doMove(left_speed, right_speed)
+            self.moves += 1
+        else:
+            left_speed, right_speed = self._old_left_speed, self._old_right_speed
+        timer.phase('serial')
+
+        # Turn the headlights on in the evening
+        headlights = True if light is not None and light < light_threshold \
+                             or (self._old_headlights and now - self._headlights_time < headlight_time_sec) \
+            else False
+
+        if self._old_headlights != headlights:
+            if headlights:
+                bot.doRGBLedOnBoard(0, 253, 172, 10)
+            else:
+                bot.doRGBLedOnBoard(0, 0, 0, 0)
+            self._headlights_time = now
+
+        # Play horn if any joystick button is pressed
+        if horn and now - self._horn_time >= 0.500:
+            bot.doBuzzer(123, 250)
+            self._horn_time = now
+
+        # Beep if battery is low and needs charge
+        battery = sensors.value('battery')
+        if battery is not None and battery < 15 and now - self._horn_time >= 60:
+            bot.doBuzzer(1400, 250)
+            self._horn_time = now
+
+        # Run an arbitrary command when teh onboard button is pressed
+        button = sensors.value('button')
+        button = True if button == 0 else False if button == 1023 else None
+        if button and button != self._old_button and self._button_cmd:
+            self._run(self._button_cmd)
+
+        self._old_left_speed = left_speed
+        self._old_right_speed = right_speed
+        self._old_headlights = headlights
+        self._old_button = button
+        timer.phase('effects')
+
+    def stop(self):
+        self._bot.doMove(0, 0)
+        self.shaper.reset()
+        self._old_left_speed = self._old_right_speed = 0
+        self._bot.doRGBLedOnBoard(0, 0, 0, 0)
+
+
+def sensor_poller(bot, rates, on_distance, on_light, on_button):
+    """Polls the sensors of a car at ``rates``, handing the values read to the callbacks."""
+    return poller.SensorPoller(bot, [
+        # poller.Sensor('line_follow', lambda ext_id, callback, timeout:
+        #               bot.requestLineFollower(ext_id, 2, callback, timeout), on_line_follow, 1, ext_id=10),
+        poller.Sensor('ultrasonic', lambda ext_id, callback, timeout:
+                      bot.requestUltrasonicSensor(ext_id, 3, callback, timeout), on_distance, *rates['ultrasonic'],
+                      ext_id=20),
+        poller.Sensor('light', lambda ext_id, callback, timeout:
+                      bot.requestLightOnBoard(ext_id, callback, timeout), on_light, *rates['light'], ext_id=30),
+        poller.Sensor('button', lambda ext_id, callback, timeout:
+                      bot.requestButtonOnBoard(ext_id, callback, timeout), on_button, *rates['button'], ext_id=40),
+    ])
+
+
+def ext_id_fields(sensors=None):
+    """Store values by the extIDs their sensors are polled on, those of ``sensor_poller`` by default."""
+    if sensors is None:
+        sensors = sensor_poller(None, poll_rates, None, None, None)
+    return {ext_id: FIELDS[name] for ext_id, name in sensors.ext_ids().items()}
+
+
+def store_writers(store):
+    """Callbacks of ``sensor_poller`` that only write the values into ``store``."""
+    return tuple(lambda value, name=name: store.write(name, value) for name in ('distance', 'light', 'button'))
+
+
+def sensors_view(store):
+    sensors = dict()
+    distance = store.read('distance').value
+    if distance is not None:
+        sensors['Distance'] = "{:.1f} cm".format(distance)
+    light = store.read('light').value
+    if light is not None:
+        sensors['Light'] = "{:.0f}".format(light)
+    return sensors
+
+
+def add_arguments(parser):
+    """Adds the sensor polling and motion shaping options shared by car.py and fleet.py."""
+    parser.add_argument("-pr", "--poll-rate", nargs='+', dest="poll_rates", required=False, default=[],
+                        metavar="SENSOR=HZ[:MAX_HZ]",
+                        help="Polling rate of a sensor: {}".format(", ".join(poll_rates)))
+    parser.add_argument("--acceleration", dest="acceleration", type=float, required=False, default=600,
+                        help="Most motor speed units a second the wheels speed up by, 0 for no limit")
+    parser.add_argument("--deceleration", dest="deceleration", type=float, required=False, default=1200,
+                        help="Most motor speed units a second the wheels slow down by, 0 for no limit")
+    parser.add_argument("--speed-step", dest="speed_step", type=int, required=False, default=5,
+                        help="Motor speeds sent are multiples of this")
+    parser.add_argument("--speed-hysteresis", dest="speed_hysteresis", type=float, required=False, default=2,
+                        help="How far past the halfway point between two speed steps the speed has to move")
+    parser.add_argument("--move-keepalive", dest="move_keepalive", type=float, required=False, default=1.0,
+                        help="Seconds after which an unchanged move command is sent again, 0 for never")
+
+
+def check_arguments(parser, args):
+    """Checks the options of ``add_arguments`` and turns the polling rates into a dict."""
+    if args.acceleration < 0 or args.deceleration < 0:
+        parser.error("invalid acceleration: {}".format(min(args.acceleration, args.deceleration)))
+    if args.speed_step < 1 or args.speed_hysteresis < 0:
+        parser.error("invalid speed step or hysteresis: {} {}".format(args.speed_step, args.speed_hysteresis))
+    if args.move_keepalive < 0:
+        parser.error("invalid move keepalive: {}".format(args.move_keepalive))
+    args.poll_rates = parse_poll_rates(parser, args.poll_rates)
+
+
+def parse_poll_rates(parser, values):
+    rates = dict(poll_rates)
+    for arg in values:
+        try:
+            name, rate = arg.split('=')
+            base, _, maximum = rate.partition(':')
+            if name not in rates:
+                raise ValueError
+            rates[name] = float(base), float(maximum or base)
+            if min(rates[name]) <= 0:
+                raise ValueError
+        except ValueError:
+            parser.error("invalid polling rate: {}".format(arg))
+    return rates
+
+
+def motion_shaper(args):
+    """A motion shaper with the limits of the options of ``add_arguments``, one for each car."""
+    return motion.MotionShaper(args.acceleration, args.deceleration, args.speed_step, args.speed_hysteresis,
+                               args.move_keepalive)
+
+
+def install_signal_handler(stop_event):
+    for s in [signal.SIGINT, signal.SIGTERM]:
+        signal.signal(s, lambda *_args: stop_event.set())
@@ -0,0 +1,286 @@
+import argparse
+import asyncio
+import json
+import os
+import resource
+import threading
+import traceback
+import aiobot
+import control
+import inputs
+import link
+import metrics
+import state
+import ticker
+from os import getpid
+from platform import node
+from werkzeug.serving import make_server
+from werkzeug.wrappers import Response
+
+
+class _Car:
+    """One robot of the fleet with a link, sensors, state and control loop of its own."""
+
+    def __init__(self, name, port, joystick, rates, rate, shaper, link_min_scale):
+        self.name = name
+        self.port = port
+        self.joystick = joystick
+        self.bot = aiobot.mBotAsync()
+        self.bot.createSerial(port)
+        self.store = state.StateStore(control.SENSORS, control.max_ages)
+        self.ticker = ticker.Ticker(rate)
+        self.timer = metrics.LoopTimer(self.ticker.period)
+        self.sensors = control.sensor_poller(self.bot, rates, *control.store_writers(self.store))
+        self.controller = control.Controller(self.bot, None, self.store, self.timer, self.sensors, shaper=shaper)
+        self.link = link.LinkMonitor(self.bot, self.sensors, self.ticker, self.timer, min_scale=link_min_scale)
+        self.errors = 0
+
+
+# Variables
+_stop_main_event = threading.Event()
+_cars = []
+
+
+def _tick(fleet_car):
+    timer = fleet_car.timer
+    joystick = fleet_car.joystick
+    timer.begin()
+    axis1, axis2, horn = joystick.read()
+    changed = joystick.changed
+    joystick.changed = None
+    timer.phase('input')
+    fleet_car.controller.step(axis1, axis2, horn)
+    if changed is not None:
+        timer.input(changed)
+    timer.end()
+
+
+async def _drive(fleet_car, offset):
+    """Control loop of one car. An error stops the car until its next tick, leaving the others be."""
+    bot = fleet_car.bot
+    # Spread the ticks of the cars over the period
+    await asyncio.sleep(offset)
+    try:
+        while not _stop_main_event.is_set():
+            if not bot.is_alive():
+                if not await bot.start(True):
+                    await asyncio.sleep(1)
+                    continue
+                fleet_car.sensors.reset()
+
+            await asyncio.sleep(max(fleet_car.ticker.remaining(), 0))
+            fleet_car.ticker.advance()
+
+            try:
+                _tick(fleet_car)
+                fleet_car.link.update()
+            except Exception:
+                traceback.print_exc()
+                fleet_car.errors += 1
+                fleet_car.controller.stop()
+
+        fleet_car.controller.stop()
+    finally:
+        await bot.close()
+
+
+async def _poll(fleet_car):
+    while not _stop_main_event.is_set():
+        await asyncio.sleep(fleet_car.sensors.poll())
+
+
+async def _run(cars):
+    """Runs all cars on one event loop, which waits on the serial ports of all of them with a selector."""
+    period = min(fleet_car.ticker.period for fleet_car in cars)
+    tasks = []
+    for index, fleet_car in enumerate(cars):
+        tasks.append(asyncio.ensure_future(_drive(fleet_car, period * index / len(cars))))
+        tasks.append(asyncio.ensure_future(_poll(fleet_car)))
+    for result in await asyncio.gather(*tasks, return_exceptions=True):
+        if isinstance(result, Exception):
+            traceback.print_exception(type(result), result, result.__traceback__)
+
+
+def _dispatch_request(environ, start_response):
+    if environ.get('PATH_INFO') == '/metrics':
+        body = _exposition().encode()
+        start_response('200 OK', [('Content-Type', metrics.Exposition.CONTENT_TYPE),
+                                  ('Content-Length', str(len(body)))])
+        return [body]
+
+    if environ.get('PATH_INFO') == '/link':
+        response = Response(json.dumps({fleet_car.name: fleet_car.link.stats() for fleet_car in _cars}),
+                            mimetype='application/json')
+        return response(environ, start_response)
+
+    if environ.get('PATH_INFO') == '/timing':
+        timing = {}
+        for fleet_car in _cars:
+            timing[fleet_car.name] = fleet_car.timer.snapshot()
+            timing[fleet_car.name]['scheduler'] = fleet_car.ticker.stats()
+        response = Response(json.dumps(timing), mimetype='application/json')
+        return response(environ, start_response)
+
+    cars = {}
+    for fleet_car in _cars:
+        cars[fleet_car.name] = {
+            'Port': fleet_car.port,
+            'Connected': fleet_car.bot.is_alive(),
+            'Sensors': control.sensors_view(fleet_car.store),
+        }
+    response = Response(json.dumps(cars), mimetype='application/json')
+    return response(environ, start_response)
+
+
+def _exposition():
+    exposition = metrics.Exposition()
+
+    def each(value):
+        return {fleet_car.name: value(fleet_car) for fleet_car in _cars}
+
+    counters = each(lambda fleet_car: fleet_car.bot.counters())
+    exposition.gauge('fleet_bots', "Robots driven by the fleet", len(_cars))
+    exposition.gauge('mbot_connected', "Whether the link to the robot is up",
+                     each(lambda fleet_car: int(fleet_car.bot.is_alive())), 'bot')
+    exposition.counter('mbot_sent_frames', "Frames written to the robot",
+                       {name: value.get('framesSent', 0) for name, value in counters.items()}, 'bot')
+    exposition.counter('mbot_received_frames', "Reply frames read from the robot",
+                       {name: value.get('framesReceived', 0) for name, value in counters.items()}, 'bot')
+    exposition.counter('mbot_dropped_bytes', "Bytes read from the robot that were not part of a frame",
+                       {name: value.get('bytesDropped', 0) for name, value in counters.items()}, 'bot')
+    exposition.counter('mbot_request_timeouts', "Sensor requests unanswered in time",
+                       {name: value['timeouts'] for name, value in counters.items()}, 'bot')
+    exposition.counter('mbot_starts', "Connections to the robot, the first one included",
+                       {name: value['starts'] for name, value in counters.items()}, 'bot')
+
+    links = each(lambda fleet_car: fleet_car.link.stats())
+    exposition.gauge('mbot_link_rtt_median_seconds', "Median round trip time of sensor requests over 10 seconds",
+                     {name: value['rtt']['p50'] for name, value in links.items()}, 'bot')
+    exposition.gauge('mbot_link_loss_ratio', "Share of sensor requests timed out",
+                     {name: value['loss'] for name, value in links.items()}, 'bot')
+    exposition.gauge('mbot_link_scale', "Share of the sensor poll and control loop rates the link allows",
+                     {name: value['scale'] for name, value in links.items()}, 'bot')
+
+    exposition.counter('car_loop_ticks', "Control loop ticks", each(lambda fleet_car: fleet_car.timer.ticks), 'bot')
+    exposition.counter('car_loop_overruns', "Control loop ticks longer than the period",
+                       each(lambda fleet_car: fleet_car.timer.overruns), 'bot')
+    exposition.counter('car_loop_missed', "Control loop ticks that started more than half a period late",
+                       each(lambda fleet_car: fleet_car.timer.missed), 'bot')
+    exposition.counter('car_loop_errors', "Control loop ticks that failed", each(lambda fleet_car: fleet_car.errors),
+                       'bot')
+    exposition.counter('car_motor_commands', "Motor speed changes sent",
+                       each(lambda fleet_car: fleet_car.controller.moves), 'bot')
+    exposition.gauge('car_distance_centimetres', "Last distance read from the ultrasonic sensor",
+                     each(lambda fleet_car: fleet_car.store.read('distance').value), 'bot')
+    exposition.gauge('car_light', "Last value read from the light sensor",
+                     each(lambda fleet_car: fleet_car.store.read('light').value), 'bot')
+
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    exposition.counter('process_cpu_seconds', "CPU time of the fleet process", usage.ru_utime + usage.ru_stime)
+    exposition.gauge('process_resident_memory_bytes', "Resident memory of the fleet process", _resident_memory())
+    return exposition.text()
+
+
+def _resident_memory():
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except OSError:
+        return None
+
+
+def _http_serve(port):
+    server = make_server('0.0.0.0', port, _dispatch_request, threaded=True)
+
+    server_thread = threading.Thread(target=server.serve_forever)
+    server_thread.start()
+    return server, server_thread
+
+
+def _parse_commandline_arguments():
+    parser = argparse.ArgumentParser(description='Makeblock mBot fleet')
+
+    parser.add_argument("-sp", "--serial-ports", nargs='+', dest="serial_ports", required=True,
+                        help="Serial ports of the robots")
+    parser.add_argument("-js", "--joysticks", nargs='+', dest="joysticks", type=int, required=False,
+                        help="Joystick slot driving each robot, in the order of the serial ports; the n-th "
+                             "joystick plugged in drives the n-th robot by default")
+    parser.add_argument("-n", "--names", nargs='+', dest="names", required=False,
+                        help="Names of the robots in the metrics, the serial port names by default")
+    parser.add_argument("-hp", "--http-port", dest="http_port", type=int, required=False, default=8060,
+                        help="HTTP port for reading metrics")
+    parser.add_argument("-r", "--rate", dest="rate", type=float, required=False, default=20,
+                        help="Control loop rate in Hz")
+    parser.add_argument("--link-min-scale", dest="link_min_scale", type=float, required=False, default=0.25,
+                        help="Share of the sensor poll and control loop rates a slow link may scale them down to, "
+                             "1 for fixed rates")
+    parser.add_argument("--input", dest="input", required=False, default='pygame', choices=['pygame', 'js', 'none'],
+                        help="Joystick input: pygame, the Linux joystick devices without pygame, or none")
+    parser.add_argument("--joystick-device", dest="joystick_device", required=False, default='/dev/input/js{}',
+                        help="Joystick device of a slot for the js input, {} standing for the slot")
+    parser.add_argument("--deadband", dest="deadband", type=float, required=False, default=0.05,
+                        help="Joystick axis values closer to the centre read as 0")
+    parser.add_argument("--axis-threshold", dest="axis_threshold", type=float, required=False, default=0.02,
+                        help="Smallest joystick axis change acted upon")
+    control.add_arguments(parser)
+
+    args = parser.parse_args()
+    if args.rate <= 0:
+        parser.error("invalid rate: {}".format(args.rate))
+    if not 0 < args.link_min_scale <= 1:
+        parser.error("invalid link scale: {}".format(args.link_min_scale))
+    if args.joysticks is None:
+        args.joysticks = list(range(len(args.serial_ports)))
+    if len(args.joysticks) != len(args.serial_ports):
+        parser.error("one joystick per serial port needed")
+    if args.names is None:
+        args.names = [os.path.basename(port) for port in args.serial_ports]
+    if len(args.names) != len(args.serial_ports) or len(set(args.names)) != len(args.names):
+        parser.error("one distinct name per serial port needed")
+    control.check_arguments(parser, args)
+
+    return parser, args
+
+
+def main():
+    parser, args = _parse_commandline_arguments()
+
+    if args.input == 'pygame':
+        joysticks = inputs.PygameJoysticks(args.deadband, args.axis_threshold, _stop_main_event.set)
+    else:
+        joysticks = None
+    try:
+        for name, port, slot in zip(args.names, args.serial_ports, args.joysticks):
+            if joysticks is not None:
+                joystick = joysticks.joystick(slot)
+            elif args.input == 'js':
+                # The kernel numbers joysticks from the lowest free slot too
+                joystick = inputs.JoystickInput(args.deadband, args.axis_threshold,
+                                                args.joystick_device.format(slot))
+            else:
+                joystick = inputs.NullInput()
+            _cars.append(_Car(name, port, joystick, args.poll_rates, args.rate, control.motion_shaper(args),
+                              args.link_min_scale))
+
+        control.install_signal_handler(_stop_main_event)
+        try:
+            server, server_thread = _http_serve(args.http_port)
+            try:
+                print("Starting {} of {} on {}:{} with PID {}".format(parser.description, len(_cars), node(),
+                                                                      server.port, getpid()))
+                asyncio.run(_run(_cars))
+                print("Stopping {}".format(parser.description))
+            finally:
+                server.shutdown()
+                server_thread.join(30)
+        finally:
+            _stop_main_event.set()
+    finally:
+        for fleet_car in _cars:
+            fleet_car.joystick.close()
+        if joysticks is not None:
+            joysticks.close()
+
+
+if __name__ == '__main__':
+    main()
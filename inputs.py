@@ -0,0 +1,346 @@
+import glob
+import os
+import select
+import struct
+from time import monotonic, sleep
+
+# struct js_event of linux/joystick.h: time in ms, value, type and axis or button number
+_JS_EVENT = struct.Struct('=IhBB')
+_JS_EVENT_BUTTON = 0x01
+_JS_EVENT_AXIS = 0x02
+_JS_EVENT_INIT = 0x80
+
+
+class NullInput:
+    """No joystick: the car stands still."""
+
+    changed = None
+
+    def read(self):
+        return 0, 0, False
+
+    def wait(self, timeout):
+        sleep(timeout)
+        return False
+
+    def close(self):
+        pass
+
+
+class _Axes:
+    """Steering and throttle axes and whether a button was pressed.
+
+       Axis values within ``deadband`` of the centre read as 0, and moves
+       smaller than ``threshold`` are ignored so that a noisy axis does not
+       generate motor commands.
+    """
+
+    def __init__(self, deadband, threshold):
+        self._deadband = deadband
+        self._threshold = threshold
+        self._axes = [0.0, 0.0]
+        self._horn = False
+        # When the axes last changed without the control loop reading them
+        self.changed = None
+
+    def _set_axis(self, axis, value):
+        if abs(value) < self._deadband:
+            value = 0.0
+        old = self._axes[axis]
+        if value == old or (abs(value - old) < self._threshold and value not in (0.0, -1.0, 1.0)):
+            return False
+        self._axes[axis] = value
+        if self.changed is None:
+            self.changed = monotonic()
+        return True
+
+    def _take(self):
+        horn = self._horn
+        self._horn = False
+        return self._axes[0], self._axes[1], horn
+
+
+class PygameInput(_Axes):
+    """Joystick read through pygame events, kept open and replaced when devices are plugged in or removed."""
+
+    def __init__(self, deadband=0.05, threshold=0.02, on_quit=None):
+        import pygame
+
+        super().__init__(deadband, threshold)
+        self._pygame = pygame
+        self._on_quit = on_quit
+        self._joystick = None
+
+        pygame.init()
+        pygame.joystick.init()
+        # pygame 2 announces joysticks present at start with JOYDEVICEADDED
+
+    def _open(self, index):
+        self._close_joystick()
+        self._joystick = self._pygame.joystick.Joystick(index)
+        self._joystick.init()
+        for axis in range(min(self._joystick.get_numaxes(), 2)):
+            self._set_axis(axis, self._joystick.get_axis(axis))
+
+    def _close_joystick(self):
+        if self._joystick is not None:
+            self._joystick.quit()
+            self._joystick = None
+        self._set_axis(0, 0.0)
+        self._set_axis(1, 0.0)
+
+    def _handle(self, event):
+        """Updates the state from an event and returns True if it matters to the car."""
+        pygame = self._pygame
+        if event.type == pygame.JOYAXISMOTION:
+            if self._joystick is not None and event.instance_id == self._joystick.get_instance_id() \
+                    and event.axis < 2:
+                return self._set_axis(event.axis, event.value)
+        elif event.type == pygame.JOYBUTTONDOWN:
+            self._horn = True
+            return True
+        elif event.type == pygame.JOYDEVICEADDED:
+            # Drive with the joystick connected last
+            self._open(event.device_index)
+            return True
+        elif event.type == pygame.JOYDEVICEREMOVED:
+            if self._joystick is not None and event.instance_id == self._joystick.get_instance_id():
+                self._close_joystick()
+                count = pygame.joystick.get_count()
+                if count > 0:
+                    self._open(count - 1)
+                return True
+        elif event.type == pygame.QUIT:
+            if self._on_quit is not None:
+                self._on_quit()
+            return True
+        return False
+
+    def read(self):
+        """Returns the steering and throttle axes and whether a button was pressed."""
+        for event in self._pygame.event.get():
+            self._handle(event)
+        return self._take()
+
+    def wait(self, timeout):
+        """Sleeps until an input the car must react to arrives or the timeout passes.
+
+           Returns True if woken by input.
+        """
+        pygame = self._pygame
+        end = monotonic() + timeout
+        while True:
+            remaining = end - monotonic()
+            if remaining <= 0:
+                return False
+            event = pygame.event.wait(max(int(remaining * 1000), 1))
+            if event.type == pygame.NOEVENT:
+                return False
+            if self._handle(event):
+                return True
+
+    def close(self):
+        self._close_joystick()
+        self._pygame.quit()
+
+
+class JoystickInput(_Axes):
+    """Joystick read without pygame from the last plugged in ``/dev/input/js*``, or any pipe of ``js_event``s."""
+
+    def __init__(self, deadband=0.05, threshold=0.02, pattern='/dev/input/js*', rescan=1.0):
+        super().__init__(deadband, threshold)
+        self._pattern = pattern
+        self._rescan = rescan
+        self._known = set()
+        self._path = None
+        self._fd = None
+        self._partial = b''
+        self._scanned = 0.0
+        self._scan()
+
+    def _scan(self):
+        """Opens a device that appeared since the last scan, run every ``rescan`` seconds.
+
+           Without a device open, any device still plugged in is opened.
+           Returns True if the device changed.
+        """
+        self._scanned = monotonic()
+        paths = set(glob.glob(self._pattern))
+        changed = self._path is not None and self._path not in paths
+        if changed:
+            self._close_device()
+        added = paths if self._path is None else paths - self._known
+        self._known = paths
+        # jsN numbers grow with the order devices were plugged in
+        for path in sorted(added, key=lambda path: (len(path), path), reverse=True):
+            if self._open(path):
+                return True
+        return changed
+
+    def _open(self, path):
+        try:
+            fd = os.open(path, os.O_RDONLY | os.O_NONBLOCK)
+        except OSError:
+            return False
+        self._close_device()
+        self._fd = fd
+        self._path = path
+        # The driver reports the state of all axes first, flagged as init events
+        self._drain()
+        return True
+
+    def _close_device(self):
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+            self._path = None
+            self._partial = b''
+        self._set_axis(0, 0.0)
+        self._set_axis(1, 0.0)
+
+    def _drain(self):
+        """Handles the events waiting and returns True if any matters to the car."""
+        matters = False
+        while self._fd is not None:
+            try:
+                data = os.read(self._fd, _JS_EVENT.size * 64)
+            except BlockingIOError:
+                break
+            except OSError:
+                # Unplugged
+                self._close_device()
+                return True
+            if not data:
+                self._close_device()
+                return True
+            data = self._partial + data
+            end = len(data) - len(data) % _JS_EVENT.size
+            self._partial = data[end:]
+            for _, value, kind, number in _JS_EVENT.iter_unpack(data[:end]):
+                if kind & ~_JS_EVENT_INIT == _JS_EVENT_AXIS:
+                    if number < 2 and self._set_axis(number, value / 32768):
+                        matters = True
+                elif kind == _JS_EVENT_BUTTON and value:
+                    self._horn = True
+                    matters = True
+        return matters
+
+    def read(self):
+        """Returns the steering and throttle axes and whether a button was pressed."""
+        if monotonic() - self._scanned >= self._rescan:
+            self._scan()
+        self._drain()
+        return self._take()
+
+    def wait(self, timeout):
+        """Sleeps until an input the car must react to arrives or the timeout passes.
+
+           Returns True if woken by input.
+        """
+        end = monotonic() + timeout
+        while True:
+            now = monotonic()
+            remaining = end - now
+            if remaining <= 0:
+                return False
+            rescan = self._scanned + self._rescan - now
+            if rescan <= 0:
+                if self._scan():
+                    return True
+                rescan = self._rescan
+            if self._fd is None:
+                sleep(min(remaining, rescan))
+                continue
+            readable, _, _ = select.select([self._fd], [], [], min(remaining, rescan))
+            if readable and self._drain():
+                return True
+
+    def close(self):
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+
+class PygameJoysticks:
+    """Several joysticks read through pygame events, one for each car of a fleet.
+
+       A joystick plugged in takes the lowest free slot and gives it up when
+       removed. ``joystick(slot)`` returns the input of a slot, which stands
+       still while no joystick is in it. Reading any slot handles the events
+       of all of them. The inputs never wait: the fleet runs its control
+       loops on deadlines alone.
+    """
+
+    def __init__(self, deadband=0.05, threshold=0.02, on_quit=None):
+        import pygame
+
+        self._pygame = pygame
+        self._deadband = deadband
+        self._threshold = threshold
+        self._on_quit = on_quit
+        self._slots = {}
+        # Slot and joystick by instance id
+        self._devices = {}
+
+        pygame.init()
+        pygame.joystick.init()
+
+    def joystick(self, slot):
+        if slot not in self._slots:
+            self._slots[slot] = _PygameSlot(self, self._deadband, self._threshold)
+        return self._slots[slot]
+
+    def _pump(self):
+        for event in self._pygame.event.get():
+            self._handle(event)
+
+    def _handle(self, event):
+        pygame = self._pygame
+        if event.type == pygame.JOYAXISMOTION:
+            device = self._devices.get(event.instance_id)
+            if device is not None and event.axis < 2:
+                self.joystick(device[0])._set_axis(event.axis, event.value)
+        elif event.type == pygame.JOYBUTTONDOWN:
+            device = self._devices.get(event.instance_id)
+            if device is not None:
+                self.joystick(device[0])._horn = True
+        elif event.type == pygame.JOYDEVICEADDED:
+            joystick = pygame.joystick.Joystick(event.device_index)
+            joystick.init()
+            if joystick.get_instance_id() in self._devices:
+                return
+            taken = {slot for slot, _ in self._devices.values()}
+            slot = next(slot for slot in range(len(taken) + 1) if slot not in taken)
+            self._devices[joystick.get_instance_id()] = slot, joystick
+            for axis in range(min(joystick.get_numaxes(), 2)):
+                self.joystick(slot)._set_axis(axis, joystick.get_axis(axis))
+        elif event.type == pygame.JOYDEVICEREMOVED:
+            device = self._devices.pop(event.instance_id, None)
+            if device is not None:
+                slot, joystick = device
+                joystick.quit()
+                self.joystick(slot)._set_axis(0, 0.0)
+                self.joystick(slot)._set_axis(1, 0.0)
+        elif event.type == pygame.QUIT:
+            if self._on_quit is not None:
+                self._on_quit()
+
+    def close(self):
+        for _, joystick in self._devices.values():
+            joystick.quit()
+        self._devices.clear()
+        self._pygame.quit()
+
+
+class _PygameSlot(_Axes):
+    def __init__(self, joysticks, deadband, threshold):
+        super().__init__(deadband, threshold)
+        self._joysticks = joysticks
+
+    def read(self):
+        """Returns the steering and throttle axes and whether a button was pressed."""
+        self._joysticks._pump()
+        return self._take()
+
+    def close(self):
+        pass
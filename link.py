@@ -0,0 +1,127 @@
+from collections import deque
+from time import monotonic
+
+
+def _percentile(values, p):
+    return values[min(len(values) * p // 100, len(values) - 1)] if values else None
+
+
+class LinkMonitor:
+    """Measures the link to the robot and scales the traffic on it to what it carries.
+
+       Every ``interval`` seconds ``update`` takes the round trip times of
+       the sensor requests answered since the last update, the share of
+       requests that timed out, the bytes moved per second and how long
+       frames waited to be written. The link is congested when replies take
+       ``rtt_factor`` times longer than the fastest of the last ``history``
+       updates plus ``rtt_slack`` seconds, more than ``max_loss`` of the
+       requests time out, or frames wait longer than ``max_wait`` seconds in
+       the write queue on average. A congested link cuts ``scale`` by
+       ``decrease``, down to ``min_scale``; a healthy one raises it by
+       ``increase`` up to 1. The sensor poll rates and the control loop rate,
+       and with it the rate of move commands, follow the scale, so that a
+       slow link does not build up a queue of frames.
+    """
+
+    def __init__(self, bot, sensors, ticker, timer=None, interval=1.0, min_scale=0.25, decrease=0.7, increase=0.1,
+                 rtt_factor=2.0, rtt_slack=0.01, max_loss=0.1, max_wait=0.05, history=10):
+        self._bot = bot
+        self._sensors = sensors
+        self._ticker = ticker
+        self._timer = timer
+        self.rate = ticker.rate
+        self.interval = interval
+        self.min_scale = min_scale
+        self.decrease = decrease
+        self.increase = increase
+        self.rtt_factor = rtt_factor
+        self.rtt_slack = rtt_slack
+        self.max_loss = max_loss
+        self.max_wait = max_wait
+        self.scale = 1.0
+        self.congestions = 0
+        self.updates = 0
+        self.rtt = None
+        self.loss = 0.0
+        self.bytes_per_second = 0.0
+        self.wait = 0.0
+        self.reason = None
+        self._minima = deque(maxlen=history)
+        self._time = None
+        self._counters = None
+
+    def _sample(self):
+        counters = self._bot.counters()
+        requests = timeouts = 0
+        for sensor in self._sensors.stats().values():
+            requests += sensor['requests']
+            timeouts += sensor['timeouts']
+        return (requests, timeouts, counters.get('bytesSent', 0) + counters.get('bytesReceived', 0),
+                counters.get('framesSent', 0), counters.get('queueSeconds', 0.0))
+
+    def update(self, now=None):
+        """Measures the link and sets the rates once the interval is over. Returns whether it did."""
+        if now is None:
+            now = monotonic()
+        if self._time is None:
+            self._time = now
+            self._counters = self._sample()
+            return False
+        elapsed = now - self._time
+        if elapsed < self.interval:
+            return False
+
+        counters = self._sample()
+        requests, timeouts, moved, frames, waited = (new - old for new, old in zip(counters, self._counters))
+        rtts = sorted(rtt for _, rtt in self._bot.roundTrips(self._time))
+        self._time = now
+        self._counters = counters
+        self.updates += 1
+
+        self.loss = min(timeouts / requests, 1.0) if requests else 0.0
+        self.bytes_per_second = moved / elapsed
+        self.wait = waited / frames if frames else 0.0
+        self.rtt = _percentile(rtts, 50)
+        if rtts:
+            self._minima.append(rtts[0])
+
+        if self.loss > self.max_loss:
+            self.reason = 'loss'
+        elif self.rtt is not None and self.rtt > min(self._minima) * self.rtt_factor + self.rtt_slack:
+            self.reason = 'rtt'
+        elif self.wait > self.max_wait:
+            self.reason = 'queue'
+        else:
+            self.reason = None
+
+        if self.reason is not None:
+            self.congestions += 1
+            self.scale = max(self.scale * self.decrease, self.min_scale)
+        else:
+            self.scale = min(self.scale + self.increase, 1.0)
+        self._apply()
+        return True
+
+    def _apply(self):
+        self._sensors.throttle = self.scale
+        if self._ticker.rate != self.rate * self.scale:
+            self._ticker.set_rate(self.rate * self.scale)
+            if self._timer is not None:
+                self._timer.period = self._ticker.period
+
+    def stats(self, window=10.0):
+        """Link quality of the last update, with round trip time percentiles over the last ``window`` seconds."""
+        rtts = sorted(rtt for _, rtt in self._bot.roundTrips(monotonic() - window))
+        return {
+            'scale': self.scale,
+            'congested': self.reason,
+            'congestions': self.congestions,
+            'rtt': {'p50': _percentile(rtts, 50), 'p90': _percentile(rtts, 90), 'p99': _percentile(rtts, 99),
+                    'min': min(self._minima) if self._minima else None},
+            'loss': self.loss,
+            'bytes_per_second': self.bytes_per_second,
+            'queue_wait': self.wait,
+            'rates': dict({'tick': self._ticker.rate},
+                          **{name: sensor['rate'] * self._sensors.throttle
+                             for name, sensor in self._sensors.stats().items()}),
+        }
@@ -4,28 +4,36 @@
 # License: GNU GENERAL PUBLIC LICENSE
 #
 
+import os
 import serial
+import selectors
 import struct
 import threading
 import hid
 import traceback
-from time import sleep, time
-from multiprocessing import Manager
+from collections import OrderedDict, deque
+from itertools import count
+from time import sleep, monotonic
 
 
 class mSerial():
-    def __init__(self, port):
+    def __init__(self, port, baudrate=115200):
         self._port = port
+        self._baudrate = baudrate
+        # 8N1 framing puts 10 bits on the wire per byte
+        self.rate = baudrate / 10
 
     def start(self):
-        self._ser = serial.Serial(self._port, 115200)
+        self._ser = serial.Serial(self._port, self._baudrate)
 
     def writePackage(self, package):
         self._ser.write(package)
-        sleep(0.01)
 
-    def read(self):
-        return self._ser.read()
+    def read(self, size=1):
+        return self._ser.read(size)
+
+    def fileno(self):
+        return self._ser.fileno()
 
     def isOpen(self):
         return hasattr(self, '_ser') and self._ser.isOpen()
@@ -38,72 +46,548 @@ class mSerial():
 
 
 class mHID():
-    def __init__(self, manager):
-        self._manager = manager
+    """mCore behind the USB HID 2.4G dongle.
+
+       A report holds a length byte and up to 63 bytes of the stream, so the
+       writer packs queued frames that fit into one report. Reports go out
+       no more than one per ``interval`` seconds. Received bytes are kept in
+       a bytearray; a poll waits at most ``timeout`` seconds for a report.
+       ``backend`` stands in for the hid module, e.g. ``sim.HIDModule``.
+    """
+
+    VENDOR_ID = 0x0416
+    PRODUCT_ID = 0xffff
+    REPORT_SIZE = 64
+
+    def __init__(self, backend=None, timeout=0.01, interval=0.01):
+        self._hid = hid if backend is None else backend
+        self.timeout = timeout
+        self.interval = interval
+        self.batch = self.REPORT_SIZE - 1
+        self._device = None
+        self._buffer = bytearray()
 
     def start(self):
-        self._dict = self._manager.dict()
-        self._dict.device = hid.device()
-        self._dict.device.open(0x0416, 0xffff)
-        # self.dict.device.hid_set_nonblocking(self.device,1)
-        self.__buffer = []
-        self.__bufferIndex = 0
+        device = self._hid.device()
+        device.open(self.VENDOR_ID, self.PRODUCT_ID)
+        device.set_nonblocking(1)
+        self._buffer.clear()
+        self._device = device
 
     def writePackage(self, package):
-        buf = []
-        buf += [0, len(package)]
-        for i in range(len(package)):
-            buf += [package[i]]
-        n = self._dict.device.write(buf)
-        sleep(0.01)
-
-    def read(self):
-        c = self.__buffer[0]
-        self.__buffer = self.__buffer[1:]
-        return chr(c)
+        if len(package) > self.batch:
+            raise ValueError("Frame too long for a report: {} bytes".format(len(package)))
+        # Report ID 0, then the length of the data
+        self._device.write(bytes((0, len(package))) + bytes(package))
+
+    def read(self, size=1):
+        data = bytes(self._buffer[:size])
+        del self._buffer[:size]
+        return data
 
     def isOpen(self):
-        return True
+        return self._device is not None
 
     def inWaiting(self):
-        buf = self._dict.device.read(64)
-        l = 0
-        if len(buf) > 0:
-            l = buf[0]
-        if l > 0:
-            for i in range(0, l):
-                self.__buffer += [buf[i + 1]]
-        return len(self.__buffer)
+        """Takes in the reports received and returns the number of bytes to read.
+
+           Waits up to ``timeout`` for a report when nothing is buffered.
+        """
+        timeout = 0 if self._buffer else int(self.timeout * 1000)
+        while True:
+            report = self._device.read(self.REPORT_SIZE, timeout) if timeout else self._device.read(self.REPORT_SIZE)
+            if not report:
+                return len(self._buffer)
+            self._buffer += bytes(report[1:1 + report[0]])
+            timeout = 0
 
     def close(self):
-        self._dict.device.close()
+        if self._device is not None:
+            self._device.close()
+            self._device = None
+
+
+class mPending():
+    """Thread-safe table of requests awaiting a reply, keyed by extID.
+
+       The last ``history`` replies are kept in ``roundTrips`` as the time
+       they arrived and their round trip time.
+    """
+
+    def __init__(self, timeout=1, history=256):
+        self.timeout = timeout
+        self._lock = threading.Lock()
+        self._table = {}
+        self.roundTrips = deque(maxlen=history)
+        self.requests = 0
+        self.responses = 0
+        self.timeouts = 0
+        self.unsolicited = 0
+        self.timeoutsByExtID = {}
+
+    def __len__(self):
+        return len(self._table)
+
+    def __contains__(self, extID):
+        return extID in self._table
+
+    def add(self, extID, callback, timeout=None):
+        """Registers a request. Returns False while an earlier request for the
+           same extID is still within its deadline.
+        """
+        now = monotonic()
+        deadline = now + (self.timeout if timeout is None else timeout)
+        with self._lock:
+            entry = self._table.get(extID)
+            if entry is not None:
+                if entry[1] > now:
+                    return False
+                self._timedOut(extID)
+            self._table[extID] = (callback, deadline, now)
+            self.requests += 1
+        return True
+
+    def cancel(self, extID):
+        """Gives up waiting for a reply, counting the request as timed out."""
+        with self._lock:
+            if self._table.pop(extID, None) is not None:
+                self._timedOut(extID)
+
+    def pop(self, extID):
+        """Removes a request and returns its callback with the round trip time,
+           or None if nothing was waiting for this extID.
+        """
+        with self._lock:
+            entry = self._table.pop(extID, None)
+            if entry is None:
+                self.unsolicited += 1
+                return None
+            self.responses += 1
+            now = monotonic()
+            self.roundTrips.append((now, now - entry[2]))
+        return entry[0], now - entry[2]
+
+    def expire(self, now=None):
+        """Drops requests past their deadline and returns their extIDs."""
+        if now is None:
+            now = monotonic()
+        with self._lock:
+            expired = [extID for extID, entry in self._table.items() if entry[1] <= now]
+            for extID in expired:
+                del self._table[extID]
+                self._timedOut(extID)
+        return expired
+
+    def _timedOut(self, extID):
+        self.timeouts += 1
+        self.timeoutsByExtID[extID] = self.timeoutsByExtID.get(extID, 0) + 1
+
+    def clear(self):
+        with self._lock:
+            self._table.clear()
+
+    def stats(self):
+        return {
+            'pending': len(self._table),
+            'requests': self.requests,
+            'responses': self.responses,
+            'timeouts': self.timeouts,
+            'unsolicited': self.unsolicited,
+        }
+
+
+class mWriter():
+    """Writes frames to the device from a dedicated thread.
+
+       Frames are queued by priority and sent no faster than the device byte
+       rate, or one write per device interval, allows. A frame queued with
+       the key of a frame still waiting in the queue replaces it, so only the
+       latest value of a command is sent. Devices with a ``batch`` size get
+       the frames waiting written together as long as they fit into it, and
+       refuse frames longer than that with a ValueError when queued. Each
+       write is logged to the optional ``recorder`` with the time it was made.
+    """
+
+    MOTION = 0
+    REQUEST = 1
+    DISPLAY = 2
+    SOUND = 3
+
+    def __init__(self, device, onError=None, rate=None, recorder=None):
+        self._device = device
+        self._onError = onError
+        self.recorder = recorder
+        self.rate = getattr(device, 'rate', None) if rate is None else rate
+        self.interval = getattr(device, 'interval', None)
+        self.batch = getattr(device, 'batch', None)
+        self._cond = threading.Condition()
+        self._queues = tuple(OrderedDict() for _ in range(self.SOUND + 1))
+        self._depth = 0
+        self._seq = count()
+        self._exiting = False
+        self.enqueued = 0
+        self.coalesced = 0
+        self.sent = 0
+        self.writes = 0
+        self.bytes = 0
+        self.maxDepth = 0
+        self.latencySum = 0.0
+        self.latencyMax = 0.0
+
+    @property
+    def depth(self):
+        return self._depth
+
+    def start(self):
+        self._th = threading.Thread(target=self._run, daemon=True)
+        self._th.start()
+
+    def is_alive(self):
+        return hasattr(self, '_th') and self._th.is_alive()
+
+    def close(self, timeout=1):
+        """Stops the thread once the frames already queued are sent."""
+        with self._cond:
+            self._exiting = True
+            self._cond.notify()
+        if self.is_alive() and self._th is not threading.current_thread():
+            self._th.join(timeout)
+
+    def put(self, package, priority=REQUEST, key=None):
+        with self._cond:
+            self._put(package, priority, key)
+            self._cond.notify()
+
+    def _put(self, package, priority, key):
+        if self.batch and len(package) > self.batch:
+            raise ValueError("Frame too long for the device: {} bytes".format(len(package)))
+        queue = self._queues[priority]
+        if key is None:
+            key = next(self._seq)
+        entry = queue.get(key)
+        if entry is not None:
+            # Keep the place and the time of the frame replaced, so that the
+            # latency counts from when the command first waited
+            self.coalesced += 1
+            queue[key] = package, entry[1]
+        else:
+            self._depth += 1
+            if self._depth > self.maxDepth:
+                self.maxDepth = self._depth
+            queue[key] = package, monotonic()
+        self.enqueued += 1
+
+    def _pop(self):
+        """Returns the next frames to write, the time the first was queued and the number of frames."""
+        package, queued = self._popOne()
+        if not self.batch:
+            return package, queued, 1
+        frames = 1
+        while self._depth:
+            following = next(iter(next(queue for queue in self._queues if queue).values()))[0]
+            if len(package) + len(following) > self.batch:
+                break
+            package = package + self._popOne()[0]
+            frames += 1
+        return package, queued, frames
+
+    def _popOne(self):
+        for queue in self._queues:
+            if queue:
+                self._depth -= 1
+                return queue.popitem(last=False)[1]
+        return None
+
+    def _clear(self):
+        for queue in self._queues:
+            queue.clear()
+        self._depth = 0
+
+    def _run(self):
+        ready = monotonic()
+        while True:
+            with self._cond:
+                while not self._depth and not self._exiting:
+                    self._cond.wait()
+                if not self._depth:
+                    return
+
+            # Wait for the link to drain before choosing the frame, so that
+            # the newest command queued meanwhile is the one that goes out
+            delay = ready - monotonic()
+            if delay > 0:
+                sleep(delay)
+
+            with self._cond:
+                package, queued, frames = self._pop()
+
+            if not self._write(package):
+                with self._cond:
+                    self._exiting = True
+                    self._clear()
+                if self._onError is not None:
+                    self._onError()
+                return
+
+            ready = self._sent(package, queued, ready, frames)
+
+    def _write(self, package):
+        try:
+            self._device.writePackage(package)
+            return True
+        except OSError:
+            traceback.print_exc()
+            return False
+
+    def _sent(self, package, queued, ready, frames=1):
+        """Accounts for frames written and returns when the link is free again."""
+        now = monotonic()
+        if self.recorder is not None:
+            self.recorder.sent(package, now)
+        latency = now - queued
+        self.sent += frames
+        self.writes += 1
+        self.bytes += len(package)
+        self.latencySum += latency
+        if latency > self.latencyMax:
+            self.latencyMax = latency
+        if self.rate:
+            return max(ready, now) + len(package) / self.rate
+        if self.interval:
+            return max(ready, now) + self.interval
+        return now
+
+    def stats(self):
+        return {
+            'depth': self._depth,
+            'maxDepth': self.maxDepth,
+            'enqueued': self.enqueued,
+            'coalesced': self.coalesced,
+            'sent': self.sent,
+            'writes': self.writes,
+            'bytes': self.bytes,
+            'latencyAvg': self.latencySum / self.sent if self.sent else 0.0,
+            'latencyMax': self.latencyMax,
+        }
+
+    def counters(self):
+        return {'framesSent': self.sent, 'bytesSent': self.bytes, 'coalesced': self.coalesced,
+                'queueSeconds': self.latencySum}
+
+
+_FLOAT = struct.Struct('<f')
+_DOUBLE = struct.Struct('<d')
+_SHORT = struct.Struct('<h')
+_HEADER = struct.Struct('<BBBBBB')
+
+# Actions
+_GET = 0x01
+_RUN = 0x02
+
+
+class mCommand():
+    """Encoder of the frames of one command of the mCore firmware.
+
+       A frame is ``0xff 0x55 length extID action device`` followed by the
+       arguments packed with the struct ``format``, or by the bytes of a
+       string if ``format`` is None. Frames that never change, like a
+       request for a sensor on a port, are built once by ``cached``.
+    """
+
+    def __init__(self, action, device, format=''):
+        self.action = action
+        self.device = device
+        self._struct = None if format is None else struct.Struct('<BBBBBB' + format)
+        self._frames = {}
+
+    def encode(self, extID, *args):
+        if self._struct is None:
+            data = args[0]
+            return _HEADER.pack(0xff, 0x55, len(data) + 3, extID, self.action, self.device) + data
+        return self._struct.pack(0xff, 0x55, self._struct.size - 3, extID, self.action, self.device, *args)
+
+    def cached(self, extID, *args):
+        key = (extID,) + args
+        frame = self._frames.get(key)
+        if frame is None:
+            frame = self._frames[key] = self.encode(extID, *args)
+        return frame
+
+
+# Commands of the firmware with the arguments following the device
+_COMMANDS = {
+    'ultrasonic': mCommand(_GET, 0x01, 'B'),  # port
+    'light': mCommand(_GET, 0x03, 'B'),  # port
+    'irRead': mCommand(_GET, 0x0d),
+    'lineFollower': mCommand(_GET, 0x11, 'B'),  # port
+    'button': mCommand(_GET, 0x1f, 'B'),  # port
+    'move': mCommand(_RUN, 0x05, 'hh'),  # left, right
+    'rgbLed': mCommand(_RUN, 0x08, 'BBBBBB'),  # port, slot, index, red, green, blue
+    'sevSeg': mCommand(_RUN, 0x09, 'Bf'),  # port, number
+    'motor': mCommand(_RUN, 0x0a, 'Bh'),  # port, speed
+    'servo': mCommand(_RUN, 0x0b, 'BBB'),  # port, slot, angle
+    'irSend': mCommand(_RUN, 0x0d, None),  # message
+    'buzzer': mCommand(_RUN, 0x22, 'HH'),  # frequency, milliseconds
+}
+_STOP = _COMMANDS['move'].encode(0, 0, 0)
+
+
+def _decodeByte(view, position):
+    return view[position]
+
+
+def _decodeFloat(view, position):
+    value = _FLOAT.unpack_from(view, position)[0]
+    return 0 if value < -255 or value > 1023 else value
+
+
+def _decodeShort(view, position):
+    return _SHORT.unpack_from(view, position)[0]
+
+
+def _decodeString(view, position):
+    return bytes(view[position + 1:position + 1 + view[position]]).decode('ascii', 'replace')
+
+
+def _decodeDouble(view, position):
+    return _FLOAT.unpack_from(view, position)[0]
+
+
+def _decodeDouble8(view, position):
+    return _DOUBLE.unpack_from(view, position)[0]
+
+
+# Reply types with the size of their value, None for a length byte and a
+# string, and its decoder. A double is 4 bytes on the AVR boards and 8 on
+# others, told apart by where the frame ends.
+_REPLIES = {
+    1: ((1, _decodeByte),),
+    2: ((4, _decodeFloat),),
+    3: ((2, _decodeShort),),
+    4: ((None, _decodeString),),
+    5: ((4, _decodeDouble), (8, _decodeDouble8)),
+}
+
+
+def _match(buffer, start, length):
+    """Returns the end of the value and the decoder of the reply at ``start``,
+       None if the reply is incomplete or False if none starts there.
+    """
+    if length - start < 5:
+        return None
+    replies = _REPLIES.get(buffer[start + 3])
+    if replies is None:
+        return False
+    for size, decoder in replies:
+        end = start + 4 + (buffer[start + 4] + 1 if size is None else size)
+        if length < end + 2:
+            return None
+        if buffer[end] == 0x0d and buffer[end + 1] == 0x0a:
+            return end, decoder
+    return False
+
+
+class mParser():
+    """Splits the byte stream received from mCore into reply frames.
+
+       A reply is ``0xff 0x55 extID type value 0x0d 0x0a``, where the type
+       defines the size of the value. Bytes that do not form a valid frame
+       are skipped and counted as dropped.
+    """
+
+    def __init__(self, callback, size=512):
+        self._callback = callback
+        self._size = size
+        self._buffer = bytearray()
+        self.bytes = 0
+        self.frames = 0
+        self.dropped = 0
+
+    def counters(self):
+        return {'bytesReceived': self.bytes, 'framesReceived': self.frames, 'bytesDropped': self.dropped}
+
+    def feed(self, data):
+        buffer = self._buffer
+        buffer += data
+        self.bytes += len(data)
+        length = len(buffer)
+        position = 0
+        with memoryview(buffer) as view:
+            while True:
+                start = buffer.find(b'\xff\x55', position)
+                if start < 0:
+                    # A trailing 0xff may be the first half of the next header
+                    keep = length - 1 if length > position and buffer[-1] == 0xff else length
+                    self.dropped += keep - position
+                    position = keep
+                    break
+                self.dropped += start - position
+                position = start
+
+                frame = _match(buffer, start, length)
+                if frame is False:
+                    self.dropped += 2
+                    position += 2
+                    continue
+                if frame is None:
+                    # Noise can look like the header of a long frame. Rather
+                    # than wait for its end, resync at a later complete frame.
+                    later = buffer.find(b'\xff\x55', start + 2)
+                    while later >= 0 and not _match(buffer, later, length):
+                        later = buffer.find(b'\xff\x55', later + 2)
+                    if later < 0:
+                        # Wait for the rest of the frame
+                        break
+                    self.dropped += later - start
+                    position = later
+                    continue
+
+                end, decode = frame
+                self.frames += 1
+                self._callback(buffer[start + 2], decode(view, start + 4))
+                position = end + 2
+
+        del buffer[:position]
+        if len(buffer) > self._size:
+            self.dropped += len(buffer) - self._size
+            del buffer[:len(buffer) - self._size]
 
 
 class mBot():
-    def __init__(self):
-        self._manager = Manager()
-        self._selectors = self._manager.dict()
+    def __init__(self, timeout=1):
+        self._selectors = mPending(timeout)
+        self.starts = 0
+        self._totals = {}
+        # Optional recorder.FlightRecorder of the frames sent and replies received
+        self.recorder = None
 
     def createSerial(self, port):
         self._device = mSerial(port)
 
-    def createHID(self):
-        self._device = mHID(self._manager)
+    def createHID(self, backend=None):
+        self._device = mHID(backend)
 
     def start(self, silent=False):
         try:
             self.__exiting = False
-            self.__buffer = []
-            self.__bufferIndex = 0
-            self.__isParseStart = False
-            self.__isParseStartIndex = 0
+            self.starts += 1
+            self._retire('_parser')
+            self._parser = mParser(self._onParse)
             self._selectors.clear()
 
+            if hasattr(self, '_writer'):
+                self._writer.close()
             if self._device.isOpen():
                 self._device.close()
+            self._closeWakeup()
             self._device.start()
+            self._wakeup = os.pipe()
 
-            self._th = threading.Thread(target=self._onRead, args=(self._onParse,))
+            self._retire('_writer')
+            self._writer = mWriter(self._device, self.close, recorder=self.recorder)
+            self._writer.start()
+
+            self._th = threading.Thread(target=self._onRead, args=(self._parser.feed,))
             self._th.start()
             return True
         except OSError:
@@ -116,164 +600,164 @@ class mBot():
     def is_alive(self):
         return hasattr(self, '_th') and self._th.is_alive()
 
+    def _retire(self, name):
+        """Adds the counters of the parser or writer about to be replaced to the totals."""
+        if hasattr(self, name):
+            for key, value in getattr(self, name).counters().items():
+                self._totals[key] = self._totals.get(key, 0) + value
+
+    def counters(self):
+        """Link and request counters since the bot was created, over all connections."""
+        counters = dict(self._totals)
+        for name in ('_parser', '_writer'):
+            if hasattr(self, name):
+                for key, value in getattr(self, name).counters().items():
+                    counters[key] = counters.get(key, 0) + value
+        counters.update(self._selectors.stats())
+        counters['timeoutsByExtID'] = dict(self._selectors.timeoutsByExtID)
+        counters['starts'] = self.starts
+        counters['queueDepth'] = self._writer.depth if hasattr(self, '_writer') else 0
+        return counters
+
+    def roundTrips(self, since=0):
+        """Times and round trip times of the replies that arrived after ``since``."""
+        with self._selectors._lock:
+            return [roundTrip for roundTrip in self._selectors.roundTrips if roundTrip[0] > since]
+
+    def cancelRequest(self, extID):
+        """Stops waiting for the reply to a request, so that the extID can be requested again at once."""
+        self._selectors.cancel(extID)
+
     def close(self):
         self.__exiting = True
+        if hasattr(self, '_writer'):
+            self._writer.close()
+        if hasattr(self, '_wakeup'):
+            try:
+                os.write(self._wakeup[1], b'\0')
+            except OSError:
+                pass
+        if self.is_alive() and self._th is not threading.current_thread():
+            self._th.join(1)
         self._device.close()
+        if not self.is_alive():
+            self._closeWakeup()
+
+    def _closeWakeup(self):
+        if hasattr(self, '_wakeup'):
+            for fd in self._wakeup:
+                os.close(fd)
+            del self._wakeup
 
     def _onRead(self, callback):
         try:
-            while 1:
-                if self.__exiting:
-                    break
-                if self._device.isOpen():
-                    n = self._device.inWaiting()
-                    for i in range(n):
-                        r = self._device.read()
-                        if r is None:
-                            break
-                        callback(ord(r))
-                    sleep(0.01)
-                else:
-                    sleep(0.5)
+            if hasattr(self._device, 'fileno'):
+                self._onSelect(callback)
+            else:
+                self._onPoll(callback)
         except OSError:
             if self.__exiting:
                 pass
             else:
                 raise
 
-    def _writePackage(self, pack):
-        try:
-            self._device.writePackage(pack)
-        except OSError:
-            traceback.print_exc()
-            self.close()
+    def _onSelect(self, callback):
+        """Sleeps until the device has data or close() wakes the thread up."""
+        with selectors.DefaultSelector() as selector:
+            selector.register(self._device.fileno(), selectors.EVENT_READ)
+            selector.register(self._wakeup[0], selectors.EVENT_READ)
+            while not self.__exiting:
+                for key, _ in selector.select():
+                    if key.fd == self._wakeup[0]:
+                        return
+                    self._onReadable(callback)
+
+    def _onPoll(self, callback):
+        """Polls devices that cannot be waited on with select."""
+        # Devices with a timeout wait for data themselves
+        pause = 0 if getattr(self._device, 'timeout', None) else 0.01
+        while not self.__exiting:
+            if self._device.isOpen():
+                n = self._device.inWaiting()
+                if n:
+                    callback(self._device.read(n))
+                elif pause:
+                    sleep(pause)
+            else:
+                sleep(0.5)
+
+    def _onReadable(self, callback):
+        # Reading at least one byte raises an error if the port was readable
+        # because the other end hung up
+        callback(self._device.read(self._device.inWaiting() or 1))
+
+    def _writePackage(self, pack, priority=mWriter.REQUEST, key=None):
+        self._writer.put(pack, priority, key)
 
     def doRGBLed(self, port, slot, index, red, green, blue):
-        self._writePackage(bytearray([0xff, 0x55, 0x9, 0x0, 0x2, 0x8, port, slot, index, red, green, blue]))
+        command = _COMMANDS['rgbLed']
+        if red or green or blue:
+            frame = command.encode(0, port, slot, index, red, green, blue)
+        else:
+            frame = command.cached(0, port, slot, index, 0, 0, 0)
+        self._writePackage(frame, mWriter.DISPLAY, ('led', port, slot, index))
 
     def doRGBLedOnBoard(self, index, red, green, blue):
         self.doRGBLed(0x7, 0x2, index, red, green, blue)
 
     def doMotor(self, port, speed):
-        self._writePackage(bytearray([0xff, 0x55, 0x6, 0x0, 0x2, 0xa, port] + self._short2bytes(speed)))
+        self._writePackage(_COMMANDS['motor'].encode(0, port, speed), mWriter.MOTION, ('motor', port))
 
     def doMove(self, leftSpeed, rightSpeed):
-        self._writePackage(
-            bytearray([0xff, 0x55, 0x7, 0x0, 0x2, 0x5] + self._short2bytes(-leftSpeed) + self._short2bytes(rightSpeed)))
+        frame = _COMMANDS['move'].encode(0, -leftSpeed, rightSpeed) if leftSpeed or rightSpeed else _STOP
+        self._writePackage(frame, mWriter.MOTION, 'move')
 
     def doServo(self, port, slot, angle):
-        self._writePackage(bytearray([0xff, 0x55, 0x6, 0x0, 0x2, 0xb, port, slot, angle]))
+        self._writePackage(_COMMANDS['servo'].encode(0, port, slot, angle), mWriter.MOTION, ('servo', port, slot))
 
     def doBuzzer(self, buzzer, time=0):
-        self._writePackage(
-            bytearray([0xff, 0x55, 0x7, 0x0, 0x2, 0x22] + self._short2bytes(buzzer) + self._short2bytes(time)))
+        self._writePackage(_COMMANDS['buzzer'].encode(0, buzzer, time), mWriter.SOUND, 'buzzer')
 
     def doSevSegDisplay(self, port, display):
-        self._writePackage(bytearray([0xff, 0x55, 0x8, 0x0, 0x2, 0x9, port] + self._float2bytes(display)))
+        self._writePackage(_COMMANDS['sevSeg'].encode(0, port, display), mWriter.DISPLAY, ('sevseg', port))
 
     def doIROnBoard(self, message):
-        self._writePackage(bytearray([0xff, 0x55, len(message) + 3, 0x0, 0x2, 0xd, message]))
-
-    def requestLightOnBoard(self, extID, callback):
-        self.requestLight(extID, 8, callback)
-
-    def requestLight(self, extID, port, callback):
-        if self._doCallback(extID, callback):
-            self._writePackage(bytearray([0xff, 0x55, 0x4, extID, 0x1, 0x3, port]))
-
-    def requestButtonOnBoard(self, extID, callback):
-        if self._doCallback(extID, callback):
-            self._writePackage(bytearray([0xff, 0x55, 0x4, extID, 0x1, 0x1f, 0x7]))
-
-    def requestIROnBoard(self, extID, callback):
-        if self._doCallback(extID, callback):
-            self._writePackage(bytearray([0xff, 0x55, 0x3, extID, 0x1, 0xd]))
-
-    def requestUltrasonicSensor(self, extID, port, callback):
-        if self._doCallback(extID, callback):
-            self._writePackage(bytearray([0xff, 0x55, 0x4, extID, 0x1, 0x1, port]))
-
-    def requestLineFollower(self, extID, port, callback):
-        if self._doCallback(extID, callback):
-            self._writePackage(bytearray([0xff, 0x55, 0x4, extID, 0x1, 0x11, port]))
-
-    def _onParse(self, byte):
-        value = 0
-        self.__buffer += [byte]
-        bufferLength = len(self.__buffer)
-        if bufferLength >= 2:
-            if self.__buffer[bufferLength - 1] == 0x55 \
-                    and self.__buffer[bufferLength - 2] == 0xff:
-                self.__isParseStart = True
-                self.__isParseStartIndex = bufferLength - 2
-            if self.__buffer[bufferLength - 1] == 0xa and \
-                    self.__buffer[bufferLength - 2] == 0xd and self.__isParseStart == True:
-                self.__isParseStart = False
-                position = self.__isParseStartIndex + 2
-                extID = self.__buffer[position]
-                position += 1
-                type = self.__buffer[position]
-                position += 1
-                # 1 byte 2 float 3 short 4 len+string 5 double
-                if type == 1:
-                    value = self.__buffer[position]
-                if type == 2:
-                    value = self._readFloat(position)
-                    if (value < -255 or value > 1023):
-                        value = 0
-                if type == 3:
-                    value = self._readShort(position)
-                if type == 4:
-                    value = self._readString(position)
-                if type == 5:
-                    value = self._readDouble(position)
-                if (type <= 5):
-                    self._responseValue(extID, value)
-                self.__buffer = []
-
-    def _readFloat(self, position):
-        v = [self.__buffer[position], self.__buffer[position + 1], self.__buffer[position + 2],
-             self.__buffer[position + 3]]
-        return struct.unpack('<f', struct.pack('4B', *v))[0]
-
-    def _readShort(self, position):
-        v = [self.__buffer[position], self.__buffer[position + 1]]
-        return struct.unpack('<h', struct.pack('2B', *v))[0]
-
-    def _readString(self, position):
-        l = self.__buffer[position]
-        position += 1
-        s = ""
-        for i in range(l):
-            s += self.__buffer[position + i].charAt(0)
-        return s
-
-    def _readDouble(self, position):
-        v = [self.__buffer[position], self.__buffer[position + 1], self.__buffer[position + 2],
-             self.__buffer[position + 3]]
-        return struct.unpack('<f', struct.pack('4B', *v))[0]
+        if isinstance(message, str):
+            message = message.encode('ascii')
+        self._writePackage(_COMMANDS['irSend'].encode(0, bytes(message)), mWriter.DISPLAY, 'ir')
 
-    def _responseValue(self, extID, value):
-        key = "callback_" + str(extID)
-        try:
-            callback, _ = self._selectors.pop(key)
-            callback(value)
-        except KeyError:
-            pass
+    def requestLightOnBoard(self, extID, callback, timeout=None):
+        self.requestLight(extID, 8, callback, timeout)
 
-    def _doCallback(self, extID, callback):
-        key = "callback_" + str(extID)
-        try:
-            callback, t = self._selectors[key]
-            return time() - t > 1
-        except KeyError:
-            self._selectors[key] = callback, time()
-            return True
+    def requestLight(self, extID, port, callback, timeout=None):
+        self._requestSensor('light', extID, callback, timeout, port)
+
+    def requestButtonOnBoard(self, extID, callback, timeout=None):
+        self._requestSensor('button', extID, callback, timeout, 0x7)
+
+    def requestIROnBoard(self, extID, callback, timeout=None):
+        self._requestSensor('irRead', extID, callback, timeout)
+
+    def requestUltrasonicSensor(self, extID, port, callback, timeout=None):
+        self._requestSensor('ultrasonic', extID, callback, timeout, port)
 
-    def _float2bytes(self, fval):
-        val = struct.pack("f", fval)
-        return [val[0], val[1], val[2], val[3]]
+    def requestLineFollower(self, extID, port, callback, timeout=None):
+        self._requestSensor('lineFollower', extID, callback, timeout, port)
+
+    def _requestSensor(self, name, extID, callback, timeout, *args):
+        if self._doCallback(extID, callback, timeout):
+            self._writePackage(_COMMANDS[name].cached(extID, *args), key=extID)
+
+    def _onParse(self, extID, value):
+        if self.recorder is not None:
+            self.recorder.received(extID, value)
+        self._responseValue(extID, value)
+
+    def _responseValue(self, extID, value):
+        entry = self._selectors.pop(extID)
+        if entry is not None:
+            callback, _ = entry
+            callback(value)
 
-    def _short2bytes(self, sval):
-        val = struct.pack("h", sval)
-        return [val[0], val[1]]
+    def _doCallback(self, extID, callback, timeout=None):
+        return self._selectors.add(extID, callback, timeout)
@@ -0,0 +1,158 @@
+from bisect import bisect_right
+from time import monotonic, perf_counter
+
+# Upper bounds of the histogram buckets in seconds, 100 us to 1 s
+DEFAULT_BOUNDS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0)
+
+
+class Histogram:
+    """Counts values into fixed buckets. Recording takes no locks and allocates nothing."""
+
+    __slots__ = ('bounds', 'counts', 'count', 'sum', 'max')
+
+    def __init__(self, bounds=DEFAULT_BOUNDS):
+        self.bounds = tuple(bounds)
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def record(self, value):
+        self.counts[bisect_right(self.bounds, value)] += 1
+        self.count += 1
+        self.sum += value
+        if value > self.max:
+            self.max = value
+
+    def snapshot(self):
+        buckets = []
+        total = 0
+        for bound, count in zip(self.bounds + (float('inf'),), self.counts):
+            total += count
+            buckets.append((bound, total))
+        return {
+            'count': self.count,
+            'sum': self.sum,
+            'max': self.max,
+            'mean': self.sum / self.count if self.count else 0.0,
+            'buckets': [{'le': str(bound), 'count': count} for bound, count in buckets],
+        }
+
+
+class LoopTimer:
+    """Times the phases of control loop ticks.
+
+       A tick is ``begin()``, a ``phase(name)`` call at the end of each phase
+       and ``end()``. A tick that takes longer than the period is an overrun;
+       one starting more than half a period late has missed its deadline.
+    """
+
+    PHASES = ('input', 'sensors', 'mixing', 'serial', 'effects')
+
+    def __init__(self, period, bounds=DEFAULT_BOUNDS):
+        self.period = period
+        self.phases = {name: Histogram(bounds) for name in self.PHASES}
+        self.tick = Histogram(bounds)
+        self.interval = Histogram(bounds)
+        self.input_latency = Histogram(bounds)
+        self.ages = {}
+        self.ticks = 0
+        self.overruns = 0
+        self.missed = 0
+        self._bounds = bounds
+        self._start = None
+        self._mark = 0.0
+
+    def begin(self):
+        now = perf_counter()
+        if self._start is not None:
+            interval = now - self._start
+            self.interval.record(interval)
+            if interval > self.period * 1.5:
+                self.missed += 1
+        self._start = self._mark = now
+
+    def phase(self, name):
+        now = perf_counter()
+        self.phases[name].record(now - self._mark)
+        self._mark = now
+
+    def end(self):
+        duration = perf_counter() - self._start
+        self.tick.record(duration)
+        self.ticks += 1
+        if duration > self.period:
+            self.overruns += 1
+
+    def input(self, changed):
+        """Records the delay from a joystick move to the motor command it caused."""
+        self.input_latency.record(monotonic() - changed)
+
+    def age(self, name, age):
+        """Records how old a sensor value was when the control loop used it."""
+        histogram = self.ages.get(name)
+        if histogram is None:
+            histogram = self.ages[name] = Histogram(self._bounds)
+        histogram.record(age)
+
+    def snapshot(self):
+        return {
+            'period': self.period,
+            'ticks': self.ticks,
+            'overruns': self.overruns,
+            'missed': self.missed,
+            'tick': self.tick.snapshot(),
+            'interval': self.interval.snapshot(),
+            'input_latency': self.input_latency.snapshot(),
+            'phases': {name: histogram.snapshot() for name, histogram in self.phases.items()},
+            'ages': {name: histogram.snapshot() for name, histogram in list(self.ages.items())},
+        }
+
+
+class Exposition:
+    """Writes metrics in the OpenMetrics text format.
+
+       Values given as a dict are written as one sample per key, with the
+       key as the value of ``label``. Samples that are None are left out.
+    """
+
+    CONTENT_TYPE = 'application/openmetrics-text; version=1.0.0; charset=utf-8'
+
+    def __init__(self):
+        self._lines = []
+
+    def counter(self, name, help, value, label=None):
+        self._family(name, 'counter', help)
+        self._samples(name + '_total', value, label)
+
+    def gauge(self, name, help, value, label=None):
+        self._family(name, 'gauge', help)
+        self._samples(name, value, label)
+
+    def histogram(self, name, help, histogram):
+        self._family(name, 'histogram', help)
+        # Count the buckets rather than read the total, which another thread may have moved on
+        total = 0
+        for bound, count in zip(histogram.bounds + (float('inf'),), histogram.counts):
+            total += count
+            self._lines.append('{}_bucket{{le="{}"}} {}\n'.format(name, '+Inf' if bound == float('inf') else bound,
+                                                                 total))
+        self._lines.append('{}_count {}\n{}_sum {}\n'.format(name, total, name, histogram.sum))
+
+    def _family(self, name, kind, help):
+        self._lines.append('# TYPE {} {}\n# HELP {} {}\n'.format(name, kind, name, help))
+
+    def _samples(self, name, value, label):
+        if label is None:
+            value = {None: value}
+        for key, sample in value.items():
+            if sample is None:
+                continue
+            if key is None:
+                self._lines.append('{} {}\n'.format(name, sample))
+            else:
+                key = str(key).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+                self._lines.append('{}{{{}="{}"}} {}\n'.format(name, label, key, sample))
+
+    def text(self):
+        return ''.join(self._lines) + '# EOF\n'
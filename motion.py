@@ -0,0 +1,106 @@
+class MotionShaper:
+    """Turns the wheel speeds wanted on each tick into as few move commands as will do.
+
+       Speeds ramp towards their target by at most ``acceleration`` units a
+       second when speeding up and ``deceleration`` when slowing down or
+       reversing, so the motors get no step changes; 0 lifts the limit.
+       The speeds sent are multiples of ``step`` and only change to another
+       multiple once the ramped speed is ``hysteresis`` past the halfway
+       point, so a noisy joystick axis does not flip between two of them.
+       The last command is sent again after ``keepalive`` seconds in case a
+       frame got lost, and a stop once more after that. An emergency stop
+       bypasses all of this and is sent at once.
+    """
+
+    def __init__(self, acceleration=600, deceleration=1200, step=5, hysteresis=2, keepalive=1.0, max_speed=255):
+        self.acceleration = acceleration
+        self.deceleration = deceleration
+        self.step = step
+        self.hysteresis = hysteresis
+        self.keepalive = keepalive
+        self.max_speed = max_speed
+        # Longest time a ramp advances in one update, so a stall does not turn into a step
+        self.max_dt = 0.25
+        self.wanted = 0
+        self.sent = 0
+        self.keepalives = 0
+        self.stops = 0
+        self._targets = (0, 0)
+        self._speeds = [0.0, 0.0]
+        self._levels = (0, 0)
+        self._start = None
+        self._time = None
+        self._sent_time = None
+        # Nothing to repeat for motors that were never started
+        self._repeats = 1
+
+    def update(self, left, right, now, stop=False):
+        """Returns the speeds to send for those wanted at time ``now``, or None if nothing needs sending.
+
+           ``stop`` asks for an emergency stop.
+        """
+        if (left, right) != self._targets:
+            # The command sent without shaping
+            self.wanted += 1
+            self._targets = left, right
+        if self._start is None:
+            self._start = self._time = self._sent_time = now
+        dt = min(max(now - self._time, 0.0), self.max_dt)
+        self._time = now
+
+        if stop:
+            self._speeds = [0.0, 0.0]
+            levels = 0, 0
+            if levels != self._levels:
+                self.stops += 1
+        else:
+            levels = self._shape(0, left, dt), self._shape(1, right, dt)
+
+        if levels == self._levels:
+            if not self.keepalive or now - self._sent_time < self.keepalive or (levels == (0, 0) and self._repeats):
+                return None
+            self.keepalives += 1
+            self._repeats += 1
+        else:
+            self._repeats = 0
+        self._levels = levels
+        self._sent_time = now
+        self.sent += 1
+        return levels
+
+    def _shape(self, wheel, target, dt):
+        speed = self._speeds[wheel]
+        if speed != target:
+            faster = abs(target) > abs(speed) and target * speed >= 0
+            limit = self.acceleration if faster else self.deceleration
+            if limit:
+                change = limit * dt
+                speed = min(max(target, speed - change), speed + change)
+            else:
+                speed = target
+            self._speeds[wheel] = speed
+
+        level = self._levels[wheel]
+        if speed == target == 0:
+            return 0
+        if abs(speed - level) < self.step / 2 + self.hysteresis:
+            return level
+        level = round(speed / self.step) * self.step
+        return min(max(level, -self.max_speed), self.max_speed)
+
+    def reset(self):
+        """Forgets the speeds, after the motors were stopped without the shaper."""
+        self._targets = (0, 0)
+        self._speeds = [0.0, 0.0]
+        self._levels = (0, 0)
+        self._repeats = 1
+
+    def stats(self):
+        minutes = 0 if self._start is None else (self._time - self._start) / 60
+        return {
+            'wanted': self.wanted,
+            'sent': self.sent,
+            'keepalives': self.keepalives,
+            'stops': self.stops,
+            'saved_per_minute': (self.wanted - self.sent) / minutes if minutes else 0.0,
+        }
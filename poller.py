@@ -0,0 +1,170 @@
+import threading
+from functools import partial
+from time import monotonic
+
+
+class Sensor:
+    """Polling schedule and counters of one sensor.
+
+       ``request(extID, callback, timeout)`` sends a request for the sensor.
+       Up to ``depth`` requests are kept in flight, each on its own extID
+       starting at ``ext_id``. A request unanswered within ``timeout`` is
+       sent again right away, up to ``retries`` times, before the sample is
+       counted as missed.
+    """
+
+    def __init__(self, name, request, callback, rate, max_rate=None, ext_id=0, depth=2, timeout=0.15, retries=1):
+        self.name = name
+        self.request = request
+        self.callback = callback
+        self.base_rate = rate
+        self.max_rate = rate if max_rate is None else max_rate
+        self.rate = rate
+        self.ext_ids = range(ext_id, ext_id + depth)
+        self.timeout = timeout
+        self.retries = retries
+
+        self.value = None
+        self.time = None
+        self.requests = 0
+        self.replies = 0
+        self.late = 0
+        self.timeouts = 0
+        self.misses = 0
+
+        self._next_time = 0
+        self._retry = 0
+        self._outstanding = {}
+
+    def stats(self, now=None):
+        if now is None:
+            now = monotonic()
+        return {
+            'value': self.value,
+            'age': None if self.time is None else now - self.time,
+            'rate': self.rate,
+            'in_flight': len(self._outstanding),
+            'requests': self.requests,
+            'replies': self.replies,
+            'late': self.late,
+            'timeouts': self.timeouts,
+            'misses': self.misses,
+        }
+
+
+class SensorPoller:
+    """Requests sensor values from the robot, each sensor at its own rate.
+
+       ``throttle`` slows all sensors down to a fraction of their rates.
+    """
+
+    def __init__(self, bot, sensors):
+        self._bot = bot
+        self.throttle = 1.0
+        self._sensors = {sensor.name: sensor for sensor in sensors}
+        self._callbacks = {(sensor.name, ext_id): partial(self._on_reply, sensor, ext_id)
+                           for sensor in sensors for ext_id in sensor.ext_ids}
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+
+    def __getitem__(self, name):
+        return self._sensors[name]
+
+    def ext_ids(self):
+        """Names of the sensors by the extIDs they are polled on."""
+        return {ext_id: sensor.name for sensor in self._sensors.values() for ext_id in sensor.ext_ids}
+
+    def scale(self, name, fraction):
+        """Sets the rate of a sensor between its base and maximum rate."""
+        sensor = self._sensors[name]
+        fraction = min(max(fraction, 0), 1)
+        sensor.rate = sensor.base_rate + (sensor.max_rate - sensor.base_rate) * fraction
+
+    def reset(self):
+        """Forgets requests in flight, e.g. after reconnecting to the robot."""
+        with self._lock:
+            for sensor in self._sensors.values():
+                sensor._outstanding.clear()
+                sensor._retry = 0
+                sensor._next_time = 0
+
+    def poll(self, now=None):
+        """Sends the requests that are due and returns the seconds until the next one."""
+        if now is None:
+            now = monotonic()
+        if not self._bot.is_alive():
+            return 0.5
+
+        due = []
+        expired = []
+        wake = now + 1
+        with self._lock:
+            for sensor in self._sensors.values():
+                outstanding = sensor._outstanding
+                for ext_id, (sent, attempt) in list(outstanding.items()):
+                    if now - sent < sensor.timeout:
+                        wake = min(wake, sent + sensor.timeout)
+                        continue
+                    del outstanding[ext_id]
+                    expired.append(ext_id)
+                    sensor.timeouts += 1
+                    if attempt < sensor.retries:
+                        sensor._retry = attempt + 1
+                    else:
+                        sensor.misses += 1
+
+                if len(outstanding) >= len(sensor.ext_ids):
+                    continue
+                if sensor._retry:
+                    attempt = sensor._retry
+                    sensor._retry = 0
+                elif now >= sensor._next_time:
+                    attempt = 0
+                    sensor._next_time = max(sensor._next_time + 1 / (sensor.rate * self.throttle), now)
+                else:
+                    wake = min(wake, sensor._next_time)
+                    continue
+
+                ext_id = next(ext_id for ext_id in sensor.ext_ids if ext_id not in outstanding)
+                outstanding[ext_id] = now, attempt
+                sensor.requests += 1
+                due.append((sensor, ext_id))
+                wake = min(wake, sensor._next_time, now + sensor.timeout)
+
+        # The bot may still wait for the reply a little longer and would not
+        # send a retry on the same extID
+        for ext_id in expired:
+            self._bot.cancelRequest(ext_id)
+        for sensor, ext_id in due:
+            sensor.request(ext_id, self._callbacks[sensor.name, ext_id], sensor.timeout)
+
+        return max(wake - now, 0)
+
+    def _on_reply(self, sensor, ext_id, value):
+        with self._lock:
+            if sensor._outstanding.pop(ext_id, None) is None:
+                sensor.late += 1
+            else:
+                sensor.replies += 1
+            sensor.value = value
+            sensor.time = monotonic()
+        sensor.callback(value)
+
+    def start(self):
+        self._stop.clear()
+        self._th = threading.Thread(target=self._run, daemon=True)
+        self._th.start()
+
+    def close(self):
+        self._stop.set()
+        if hasattr(self, '_th'):
+            self._th.join(1)
+
+    def _run(self):
+        delay = 0
+        while not self._stop.wait(delay):
+            delay = self.poll()
+
+    def stats(self):
+        now = monotonic()
+        return {name: sensor.stats(now) for name, sensor in self._sensors.items()}
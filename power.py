@@ -0,0 +1,196 @@
+import sys
+import threading
+from array import array
+from bisect import bisect_left
+from time import time
+
+VALUES = ('bus_voltage', 'shunt_voltage', 'current', 'power')  # V, V, A, W
+
+
+class Ring:
+    """A fixed number of rows of floats, the oldest overwritten first.
+
+       The first column is the time of the row. Rows are stored in one
+       array allocated up front, so memory use does not grow.
+    """
+
+    __slots__ = ('columns', 'capacity', 'width', '_data', '_next', '_count')
+
+    def __init__(self, capacity, columns):
+        self.columns = tuple(columns)
+        self.capacity = capacity
+        self.width = len(self.columns)
+        self._data = array('d', bytes(8 * capacity * self.width))
+        self._next = 0
+        self._count = 0
+
+    def __len__(self):
+        return self._count
+
+    def append(self, row):
+        start = self._next * self.width
+        data = self._data
+        for i, value in enumerate(row):
+            data[start + i] = value
+        self._next = (self._next + 1) % self.capacity
+        if self._count < self.capacity:
+            self._count += 1
+
+    def rows(self, since=None):
+        """Returns the rows from time ``since`` on, oldest first, as one flat array."""
+        width = self.width
+        first = (self._next - self._count) % self.capacity
+        if first + self._count <= self.capacity:
+            rows = self._data[first * width:(first + self._count) * width]
+        else:
+            rows = self._data[first * width:] + self._data[:self._next * width]
+        if since is not None:
+            rows = rows[bisect_left(rows[::width], since) * width:]
+        return rows
+
+
+class Downsampled:
+    """Minimum, maximum and mean of each value over fixed intervals of time."""
+
+    def __init__(self, interval, capacity, names=VALUES):
+        self.interval = interval
+        self.ring = Ring(capacity, ('time',) + tuple('{}_{}'.format(name, stat) for name in names
+                                                     for stat in ('min', 'max', 'mean')))
+        self._start = None
+        self._count = 0
+        self._min = [0.0] * len(names)
+        self._max = [0.0] * len(names)
+        self._sum = [0.0] * len(names)
+
+    def add(self, now, values):
+        start = now - now % self.interval
+        if self._count and start != self._start:
+            self.flush()
+        if not self._count:
+            self._start = start
+            self._min[:] = self._max[:] = self._sum[:] = values
+        else:
+            for i, value in enumerate(values):
+                if value < self._min[i]:
+                    self._min[i] = value
+                if value > self._max[i]:
+                    self._max[i] = value
+                self._sum[i] += value
+        self._count += 1
+
+    def flush(self):
+        """Stores the interval in progress."""
+        if not self._count:
+            return
+        row = [self._start]
+        for low, high, total in zip(self._min, self._max, self._sum):
+            row += (low, high, total / self._count)
+        self.ring.append(row)
+        self._count = 0
+
+
+class Battery:
+    """State of charge from the charge drawn, corrected towards the open circuit voltage.
+
+       Counting charge is precise over minutes but drifts and needs a known
+       start, while the voltage is absolute but sags under load. The voltage
+       under load plus the drop over the internal ``resistance`` estimates
+       the open circuit voltage, which pulls the count towards it with a
+       time constant of ``tau`` seconds at rest and more slowly the higher
+       the current.
+    """
+
+    def __init__(self, capacity_mAh=2000, empty_V=6.0, full_V=8.4, resistance=0.15, tau=300, load_A=0.2):
+        self.capacity_mAh = capacity_mAh
+        self.empty_V = empty_V
+        self.full_V = full_V
+        self.resistance = resistance
+        self.tau = tau
+        self.load_A = load_A
+        self.soc = None
+
+    def voltage_soc(self, voltage, current):
+        ocv = voltage + current * self.resistance
+        return min(max((ocv - self.empty_V) / (self.full_V - self.empty_V), 0.0), 1.0)
+
+    def update(self, voltage, current, charge_mAh, dt):
+        """Updates the estimate with the battery voltage and current and the charge drawn during dt seconds."""
+        soc = self.voltage_soc(voltage, current)
+        if self.soc is None:
+            self.soc = soc
+        else:
+            weight = min(dt / (self.tau * (1 + abs(current) / self.load_A)), 1.0)
+            self.soc -= charge_mAh / self.capacity_mAh
+            self.soc = min(max(self.soc + (soc - self.soc) * weight, 0.0), 1.0)
+        return self.soc
+
+
+class PowerTelemetry:
+    """Power samples kept at full rate, per second and per minute, and the energy and charge used."""
+
+    RESOLUTIONS = ('raw', 'second', 'minute')
+
+    def __init__(self, capacity=3000, seconds=3600, minutes=1440, battery=None):
+        self.raw = Ring(capacity, ('time',) + VALUES)
+        self.seconds = Downsampled(1, seconds)
+        self.minutes = Downsampled(60, minutes)
+        self.battery = Battery() if battery is None else battery
+        self.energy_mWh = 0.0
+        self.charge_mAh = 0.0
+        self.samples = 0
+        self.overflows = 0
+        self._lock = threading.Lock()
+        self._last = None
+
+    def add(self, snapshot, now=None):
+        """Records an INA219 snapshot taken at wall clock time ``now``, unless recorded already."""
+        if self._last is not None and snapshot.time == self._last[0]:
+            return
+        if now is None:
+            now = time()
+        shunt_voltage = snapshot.shunt_voltage_mV / 1000
+        current = snapshot.current_mA / 1000
+        values = (snapshot.bus_voltage_V, shunt_voltage, current, snapshot.power_W)
+        with self._lock:
+            self.raw.append((now,) + values)
+            self.seconds.add(now, values)
+            self.minutes.add(now, values)
+
+            # Trapezoids between samples, timed by the monotonic clock of the readings
+            charge = 0.0
+            dt = 0.0
+            if self._last is not None:
+                last_time, last_current, last_power = self._last
+                dt = snapshot.time - last_time
+                charge = (last_current + current) / 2 * dt / 3.6
+                self.charge_mAh += charge
+                self.energy_mWh += (last_power + snapshot.power_W) / 2 * dt / 3.6
+            self._last = snapshot.time, current, snapshot.power_W
+            self.battery.update(snapshot.bus_voltage_V + shunt_voltage, current, charge, dt)
+            self.samples += 1
+            if snapshot.overflow:
+                self.overflows += 1
+
+    def history(self, resolution='raw', since=None):
+        """Returns the column names and the rows as one flat array of doubles."""
+        ring = {'raw': self.raw, 'second': self.seconds.ring, 'minute': self.minutes.ring}[resolution]
+        with self._lock:
+            return ring.columns, ring.rows(since)
+
+    @staticmethod
+    def pack(rows):
+        """Little-endian doubles, row after row."""
+        if sys.byteorder != 'little':
+            rows = array('d', rows)
+            rows.byteswap()
+        return rows.tobytes()
+
+    def stats(self):
+        with self._lock:
+            return {
+                'samples': self.samples,
+                'overflows': self.overflows,
+                'energy_mWh': self.energy_mWh,
+                'charge_mAh': self.charge_mAh,
+                'soc': self.battery.soc,
+            }
@@ -0,0 +1,247 @@
+import argparse
+import csv
+import mmap
+import os
+import struct
+import sys
+import threading
+from time import monotonic, time
+
+# Kinds of records
+END = 0
+SENT = 1
+RECEIVED = 2
+RECEIVED_TEXT = 3
+TICK = 4
+POWER = 5
+
+FIELDS = {
+    SENT: ('sent', ('frame',)),
+    RECEIVED: ('received', ('ext_id', 'value')),
+    RECEIVED_TEXT: ('received_text', ('ext_id', 'text')),
+    TICK: ('tick', ('axis1', 'axis2', 'left', 'right')),
+    POWER: ('power', ('bus_voltage_V', 'shunt_voltage_mV', 'current_mA', 'power_W', 'overflow')),
+}
+
+_MAGIC = b'MBFR'
+# Magic, format version, sequence number, wall clock and monotonic time at the start of the segment
+_SEGMENT = struct.Struct('<4sHQdd')
+# Monotonic time, kind and payload size of a record
+_HEADER = struct.Struct('<dBB')
+_RECEIVED = struct.Struct('<dBBBd')
+_TICK = struct.Struct('<dBBffhh')
+_POWER = struct.Struct('<dBBffffB')
+_PAYLOADS = {RECEIVED: struct.Struct('<Bd'), TICK: struct.Struct('<ffhh'), POWER: struct.Struct('<ffffB')}
+
+
+class FlightRecorder:
+    """Appends serial traffic, control loop ticks and power readings to memory-mapped log files.
+
+       The log is a ring of ``segments`` files of ``segment_size`` bytes in
+       ``directory``, allocated when first used. When a segment is full the
+       oldest one is overwritten. Nothing is synced to disk explicitly: the
+       kernel writes the mapped pages back in its own time, so a record costs
+       a struct pack into memory.
+    """
+
+    def __init__(self, directory, segment_size=4 << 20, segments=16):
+        self.directory = directory
+        self.segment_size = segment_size
+        self.segments = segments
+        self.records = 0
+        self.rotations = 0
+        self._lock = threading.Lock()
+        self._mmap = None
+        self._position = 0
+        self._index = -1
+        self._seq = 0
+
+    def open(self):
+        os.makedirs(self.directory, exist_ok=True)
+        # Continue after the newest segment of the previous run
+        for index, seq in _segments(self.directory):
+            if seq >= self._seq:
+                self._seq, self._index = seq, index
+        with self._lock:
+            self._rotate()
+
+    def close(self):
+        with self._lock:
+            if self._mmap is not None:
+                self._mmap.flush()
+                self._mmap.close()
+                self._mmap = None
+
+    def __enter__(self):
+        self.open()
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def _rotate(self):
+        if self._mmap is not None:
+            self._mmap.close()
+            self.rotations += 1
+        self._index = (self._index + 1) % self.segments
+        self._seq += 1
+        path = _path(self.directory, self._index)
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            if os.fstat(fd).st_size != self.segment_size:
+                os.ftruncate(fd, self.segment_size)
+                if hasattr(os, 'posix_fallocate'):
+                    # Reserve the blocks now rather than on the first write to each page
+                    os.posix_fallocate(fd, 0, self.segment_size)
+            self._mmap = mmap.mmap(fd, self.segment_size)
+        finally:
+            os.close(fd)
+        _SEGMENT.pack_into(self._mmap, 0, _MAGIC, 1, self._seq, time(), monotonic())
+        self._position = _SEGMENT.size
+        self._mmap[self._position + 8] = END
+
+    def _reserve(self, size):
+        """Returns the position of a record of the given size, rotating if the segment is full."""
+        if self._position + size + _HEADER.size > self.segment_size:
+            self._rotate()
+        position = self._position
+        self._position += size
+        # Mark the end of the log, as the rest of a reused segment holds old records
+        self._mmap[self._position + 8] = END
+        self.records += 1
+        return position
+
+    def sent(self, frame, now=None):
+        """Records the frames of one write to the robot, made at monotonic time ``now``."""
+        with self._lock:
+            if self._mmap is None:
+                return
+            size = _HEADER.size + len(frame)
+            position = self._reserve(size)
+            _HEADER.pack_into(self._mmap, position, monotonic() if now is None else now, SENT, len(frame))
+            self._mmap[position + _HEADER.size:position + size] = frame
+
+    def received(self, extID, value):
+        """Records a reply decoded from the robot."""
+        with self._lock:
+            if self._mmap is None:
+                return
+            if isinstance(value, str):
+                text = value.encode('ascii', 'replace')[:254]
+                size = _HEADER.size + 1 + len(text)
+                position = self._reserve(size)
+                _HEADER.pack_into(self._mmap, position, monotonic(), RECEIVED_TEXT, 1 + len(text))
+                self._mmap[position + _HEADER.size] = extID
+                self._mmap[position + _HEADER.size + 1:position + size] = text
+            else:
+                position = self._reserve(_RECEIVED.size)
+                _RECEIVED.pack_into(self._mmap, position, monotonic(), RECEIVED, _RECEIVED.size - _HEADER.size,
+                                    extID, value)
+
+    def tick(self, axis1, axis2, left, right):
+        """Records the joystick axes and the motor speeds of a control loop tick."""
+        with self._lock:
+            if self._mmap is None:
+                return
+            position = self._reserve(_TICK.size)
+            _TICK.pack_into(self._mmap, position, monotonic(), TICK, _TICK.size - _HEADER.size,
+                            axis1, axis2, left, right)
+
+    def power(self, snapshot):
+        """Records an INA219 snapshot."""
+        with self._lock:
+            if self._mmap is None:
+                return
+            position = self._reserve(_POWER.size)
+            _POWER.pack_into(self._mmap, position, snapshot.time, POWER, _POWER.size - _HEADER.size,
+                             snapshot.bus_voltage_V, snapshot.shunt_voltage_mV, snapshot.current_mA,
+                             snapshot.power_W, snapshot.overflow)
+
+
+def _path(directory, index):
+    return os.path.join(directory, 'segment-{:03d}.bin'.format(index))
+
+
+def _segments(directory):
+    """Yields the index and sequence number of the segments in the directory."""
+    for name in os.listdir(directory):
+        if not (name.startswith('segment-') and name.endswith('.bin')):
+            continue
+        with open(os.path.join(directory, name), 'rb') as f:
+            header = f.read(_SEGMENT.size)
+        if len(header) == _SEGMENT.size:
+            magic, version, seq, _, _ = _SEGMENT.unpack(header)
+            if magic == _MAGIC:
+                yield int(name[8:-4]), seq
+
+
+def read(directory):
+    """Yields the records of the log as ``(time, kind, values)``, oldest first.
+
+       Times are seconds on the wall clock.
+    """
+    for index, _ in sorted(_segments(directory), key=lambda segment: segment[1]):
+        with open(_path(directory, index), 'rb') as f:
+            data = f.read()
+        _, _, _, wall, mono = _SEGMENT.unpack_from(data)
+        offset = wall - mono
+        position = _SEGMENT.size
+        while position + _HEADER.size <= len(data):
+            timestamp, kind, size = _HEADER.unpack_from(data, position)
+            if kind == END:
+                break
+            payload = data[position + _HEADER.size:position + _HEADER.size + size]
+            position += _HEADER.size + size
+            yield timestamp + offset, kind, _decode(kind, payload)
+
+
+def _decode(kind, payload):
+    if kind == SENT:
+        return payload.hex(),
+    if kind == RECEIVED_TEXT:
+        return payload[0], payload[1:].decode('ascii', 'replace')
+    return _PAYLOADS[kind].unpack(payload)
+
+
+def to_numpy(directory, kind):
+    """Returns the records of one kind as a NumPy structured array."""
+    import numpy
+
+    names = ('time',) + FIELDS[kind][1]
+    rows = [(timestamp,) + values for timestamp, record_kind, values in read(directory) if record_kind == kind]
+    if kind in (SENT, RECEIVED_TEXT):
+        return numpy.array(rows, dtype=[(name, object) for name in names])
+    return numpy.array(rows, dtype=[(name, 'f8') for name in names])
+
+
+def _parse_commandline_arguments():
+    parser = argparse.ArgumentParser(description='mBot Car flight recorder')
+
+    parser.add_argument("directory", help="Directory of the flight recorder log")
+    parser.add_argument("-k", "--kind", dest="kind", required=False, default='tick',
+                        choices=[name for name, _ in FIELDS.values()] + ['all'],
+                        help="Records to write as CSV")
+
+    args = parser.parse_args()
+    return parser, args
+
+
+def main():
+    parser, args = _parse_commandline_arguments()
+
+    writer = csv.writer(sys.stdout)
+    if args.kind == 'all':
+        writer.writerow(('time', 'kind', 'values'))
+        for timestamp, kind, values in read(args.directory):
+            writer.writerow(('{:.6f}'.format(timestamp), FIELDS[kind][0]) + values)
+        return
+
+    kind = next(kind for kind, (name, _) in FIELDS.items() if name == args.kind)
+    writer.writerow(('time',) + FIELDS[kind][1])
+    for timestamp, record_kind, values in read(args.directory):
+        if record_kind == kind:
+            writer.writerow(('{:.6f}'.format(timestamp),) + values)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,220 @@
+import argparse
+import csv
+import math
+import random
+import sys
+import time
+import control
+import motion
+import power
+import recorder
+import state
+
+# Columns of a trace file; empty cells are values not read at that time
+TRACE_FIELDS = ('time', 'axis1', 'axis2', 'horn', 'distance', 'light', 'button', 'battery')
+SENSORS = ('distance', 'light', 'button', 'battery')
+
+
+class VirtualClock:
+    """Time that moves only when told to."""
+
+    def __init__(self, start=0.0):
+        self.time = start
+
+    def __call__(self):
+        return self.time
+
+
+class FakeBot:
+    """Takes the place of mBot and logs the commands sent to it as ``(time, command, arguments...)``."""
+
+    def __init__(self, clock):
+        self.commands = []
+        self._clock = clock
+
+    def is_alive(self):
+        return True
+
+    def _command(self, name, *args):
+        self.commands.append((self._clock(), name) + args)
+
+    def doMove(self, leftSpeed, rightSpeed):
+        self._command('move', leftSpeed, rightSpeed)
+
+    def doMotor(self, port, speed):
+        self._command('motor', port, speed)
+
+    def doServo(self, port, slot, angle):
+        self._command('servo', port, slot, angle)
+
+    def doRGBLed(self, port, slot, index, red, green, blue):
+        self._command('led', port, slot, index, red, green, blue)
+
+    def doRGBLedOnBoard(self, index, red, green, blue):
+        self.doRGBLed(0x7, 0x2, index, red, green, blue)
+
+    def doBuzzer(self, buzzer, time=0):
+        self._command('buzzer', buzzer, time)
+
+    def doSevSegDisplay(self, port, display):
+        self._command('sevseg', port, display)
+
+    def doIROnBoard(self, message):
+        self._command('ir', message)
+
+
+class _NullTimer:
+    def phase(self, name):
+        pass
+
+    def age(self, name, age):
+        pass
+
+
+def replay(events, rate=20, max_ages=control.max_ages, shaper=None):
+    """Runs the control logic of the car over a trace as fast as it can.
+
+       ``events`` are ``(time, name, value)`` in order of time, where the
+       name is ``axes`` with a value of ``(axis1, axis2, horn)``, or one of
+       ``SENSORS``. Ticks are ``1 / rate`` seconds apart on a virtual clock
+       starting at the first event. Motor speeds go through ``shaper``, a
+       ``motion.MotionShaper`` with its defaults if not given. Returns the
+       commands the control logic sent and the number of ticks.
+    """
+    events = iter(events)
+    event = next(events, None)
+    if event is None:
+        return [], 0
+
+    clock = VirtualClock(event[0])
+    store = state.StateStore(control.SENSORS, max_ages, clock)
+    bot = FakeBot(clock)
+    controller = control.Controller(bot, ['button'], store, _NullTimer(), clock=clock,
+                                    run=lambda command: bot._command('run', *command), shaper=shaper)
+
+    start = clock.time
+    ticks = 0
+    axis1 = axis2 = 0.0
+    horn = False
+    while event is not None:
+        now = clock.time = start + ticks / rate
+        while event is not None and event[0] <= now:
+            timestamp, name, value = event
+            if name == 'axes':
+                axis1, axis2, pressed = value
+                horn = horn or pressed
+            else:
+                store.write(name, value, timestamp)
+            event = next(events, None)
+
+        controller.step(axis1, axis2, horn)
+        horn = False
+        ticks += 1
+
+    controller.stop()
+    return bot.commands, ticks
+
+
+def read_trace(path):
+    """Yields the events of a CSV trace with the columns of ``TRACE_FIELDS``."""
+    with open(path, newline='') as f:
+        for row in csv.DictReader(f):
+            timestamp = float(row['time'])
+            if row.get('axis1') or row.get('axis2') or row.get('horn'):
+                yield timestamp, 'axes', (float(row.get('axis1') or 0), float(row.get('axis2') or 0),
+                                          bool(int(row.get('horn') or 0)))
+            for name in SENSORS:
+                if row.get(name):
+                    yield timestamp, name, float(row[name])
+
+
+def read_flight(directory, ext_ids=None):
+    """Yields the events of a flight recorder log: the joystick axes, sensor replies and battery charge."""
+    if ext_ids is None:
+        ext_ids = control.ext_id_fields()
+    battery = power.Battery()
+    for timestamp, kind, values in recorder.read(directory):
+        if kind == recorder.TICK:
+            yield timestamp, 'axes', (values[0], values[1], False)
+        elif kind == recorder.RECEIVED and values[0] in ext_ids:
+            yield timestamp, ext_ids[values[0]], values[1]
+        elif kind == recorder.POWER:
+            bus_voltage, shunt_voltage_mV, current_mA = values[:3]
+            soc = battery.voltage_soc(bus_voltage + shunt_voltage_mV / 1000, current_mA / 1000)
+            yield timestamp, 'battery', soc * 100
+
+
+def synthetic(duration, rate=20, noise=0.0, seed=0):
+    """Yields the events of a drive towards a wall and back that gets dark on the way, on a draining battery.
+
+       The joystick axes jitter by up to ``noise``.
+    """
+    jitter = random.Random(seed)
+    ticks = int(duration * rate)
+    for tick in range(ticks):
+        t = tick / rate
+        phase = t / duration
+        axis1 = 0.5 * math.sin(t / 3) + jitter.uniform(-noise, noise)
+        axis2 = (-1.0 if phase < 0.5 else 1.0) + jitter.uniform(-noise, noise)
+        yield t, 'axes', (axis1, min(max(axis2, -1.0), 1.0), tick % (rate * 10) == 0)
+        if tick % 2 == 0:
+            # Closing in on the wall and backing off again
+            yield t, 'distance', 2 + 100 * abs(1 - 2 * phase)
+        if tick % rate == 0:
+            yield t, 'light', 600 * (1 - phase)
+            yield t, 'battery', 100 - 90 * phase
+        if tick % (rate // 4 or 1) == 0:
+            yield t, 'button', 0.0 if tick == ticks // 2 else 1023.0
+
+
+def _parse_commandline_arguments():
+    parser = argparse.ArgumentParser(description='mBot Car control loop replay')
+
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument("trace", nargs='?',
+                        help="CSV trace with the columns {}".format(", ".join(TRACE_FIELDS)))
+    source.add_argument("--flight", dest="flight", help="Flight recorder log directory to replay")
+    source.add_argument("--synthetic", dest="synthetic", type=float, help="Seconds of a made up drive to replay")
+    parser.add_argument("--noise", dest="noise", type=float, required=False, default=0.0,
+                        help="Most the joystick axes of the synthetic drive jitter by")
+    parser.add_argument("--no-shaping", dest="shaping", action='store_false', required=False,
+                        help="Send every change of the motor speeds as it is")
+    parser.add_argument("-r", "--rate", dest="rate", type=float, required=False, default=20,
+                        help="Control loop rate in Hz")
+
+    args = parser.parse_args()
+    if args.rate <= 0:
+        parser.error("invalid rate: {}".format(args.rate))
+    return parser, args
+
+
+def main():
+    parser, args = _parse_commandline_arguments()
+
+    if args.flight is not None:
+        events = read_flight(args.flight)
+    elif args.synthetic is not None:
+        events = synthetic(args.synthetic, int(args.rate), args.noise)
+    else:
+        events = read_trace(args.trace)
+
+    # Without shaping every rounded speed change is sent right away
+    shaper = motion.MotionShaper() if args.shaping else motion.MotionShaper(0, 0, 1, 0, 0)
+    start = time.perf_counter()
+    commands, ticks = replay(events, args.rate, shaper=shaper)
+    elapsed = time.perf_counter() - start
+
+    writer = csv.writer(sys.stdout)
+    writer.writerow(('time', 'command', 'arguments'))
+    for command in commands:
+        writer.writerow(('{:.3f}'.format(command[0]),) + command[1:])
+    print("{} ticks, {} commands, {:.0f} ticks/s".format(ticks, len(commands), ticks / elapsed if elapsed else 0),
+          file=sys.stderr)
+    stats = shaper.stats()
+    print("{} moves wanted, {} sent, {} keepalives, {} emergency stops, {:.0f} saved per minute".format(
+        stats['wanted'], stats['sent'], stats['keepalives'], stats['stops'], stats['saved_per_minute']),
+        file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,511 @@
+import argparse
+import heapq
+import os
+import random
+import selectors
+import socket
+import struct
+import threading
+import time
+import tty
+from collections import deque
+
+# Devices of the mCore firmware
+ULTRASONIC = 0x01
+LIGHT = 0x03
+MOVE = 0x05
+RGBLED = 0x08
+SEVSEG = 0x09
+MOTOR = 0x0a
+SERVO = 0x0b
+IR = 0x0d
+LINEFOLLOWER = 0x11
+BUTTON = 0x1f
+BUZZER = 0x22
+
+_GET = 0x01
+_RUN = 0x02
+
+_FLOAT = struct.Struct('<f')
+_SHORT = struct.Struct('<h')
+_MOVE = struct.Struct('<hh')
+_BUZZER = struct.Struct('<HH')
+
+
+class mCoreSimulator():
+    """A virtual mCore board on a pseudo-terminal.
+
+       Sensor requests are answered with the values set in ``values`` after
+       ``delay`` seconds, give or take ``jitter``. A share ``drop`` of the
+       requests is never answered. Bytes cross the link no faster than
+       ``baudrate`` allows either way, so frames sent faster than that queue
+       up as on a slow radio link. Commands received are logged in ``commands`` as
+       ``(time, device, arguments)`` and passed to ``on_command`` if given.
+    """
+
+    def __init__(self, values=None, delay=0.0, jitter=0.0, drop=0.0, baudrate=115200, seed=None, log=1000,
+                 on_command=None):
+        self.values = {ULTRASONIC: 40.0, LIGHT: 500.0, LINEFOLLOWER: 3.0, BUTTON: 1023.0}
+        if values is not None:
+            self.values.update(values)
+        self.delay = delay
+        self.jitter = jitter
+        self.drop = drop
+        self.rate = baudrate / 10
+        self.commands = deque(maxlen=log)
+        self._on_command = on_command
+        self.requests = 0
+        self.replies = 0
+        self.dropped = 0
+        self._random = random.Random(seed)
+        self._buffer = bytearray()
+        self._replies = []
+        self._seq = 0
+        # Bytes from the host with the time they are through the link
+        self._inbound = deque()
+
+    def start(self):
+        self._master, self._slave = os.openpty()
+        tty.setraw(self._slave)
+        os.set_blocking(self._master, False)
+        self.port = os.ttyname(self._slave)
+        self._wakeup = os.pipe()
+        self._th = threading.Thread(target=self._run, daemon=True)
+        self._th.start()
+
+    def close(self):
+        os.write(self._wakeup[1], b'\0')
+        self._th.join(1)
+        for fd in (self._master, self._slave) + self._wakeup:
+            os.close(fd)
+
+    def send(self, data, delay=0.0):
+        """Sends ``data`` to the host after ``delay`` seconds, e.g. part of a reply or noise on the link."""
+        self._seq += 1
+        heapq.heappush(self._replies, (time.monotonic() + delay, self._seq, bytes(data)))
+        if hasattr(self, '_th') and self._th.is_alive():
+            os.write(self._wakeup[1], b'\1')
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def _run(self):
+        ready = arrival = time.monotonic()
+        with selectors.DefaultSelector() as selector:
+            selector.register(self._master, selectors.EVENT_READ)
+            selector.register(self._wakeup[0], selectors.EVENT_READ)
+            while True:
+                wake = []
+                if self._replies:
+                    wake.append(max(self._replies[0][0], ready))
+                if self._inbound:
+                    wake.append(self._inbound[0][0])
+                timeout = max(min(wake) - time.monotonic(), 0) if wake else None
+                for key, _ in selector.select(timeout):
+                    if key.fd == self._wakeup[0]:
+                        # A zero byte stops the simulator, others only wake it up
+                        if b'\0' in os.read(self._wakeup[0], 64):
+                            return
+                        continue
+                    try:
+                        data = os.read(self._master, 4096)
+                    except BlockingIOError:
+                        data = b''
+                    arrival = max(arrival, time.monotonic()) + len(data) / self.rate
+                    self._inbound.append((arrival, data))
+
+                now = time.monotonic()
+                while self._inbound and self._inbound[0][0] <= now:
+                    arrived, data = self._inbound.popleft()
+                    self._receive(data, arrived)
+
+                while self._replies and self._replies[0][0] <= now and ready <= now:
+                    _, _, reply = heapq.heappop(self._replies)
+                    try:
+                        os.write(self._master, reply)
+                        self.replies += 1
+                    except BlockingIOError:
+                        # The host stopped reading and the pty is full
+                        self.dropped += 1
+                    ready = max(ready, now) + len(reply) / self.rate
+
+    def _receive(self, data, now):
+        buffer = self._buffer
+        buffer += data
+        position = 0
+        while True:
+            start = buffer.find(b'\xff\x55', position)
+            if start < 0 or len(buffer) < start + 3:
+                break
+            end = start + 3 + buffer[start + 2]
+            if len(buffer) < end:
+                position = start
+                break
+            self._execute(bytes(buffer[start + 3:end]), now)
+            position = end
+        del buffer[:position]
+
+    def _execute(self, frame, now):
+        if len(frame) < 3:
+            return
+        extID, action, device = frame[0], frame[1], frame[2]
+        args = frame[3:]
+        if action == _GET:
+            self.requests += 1
+            value = self.values.get(device)
+            if value is None:
+                return
+            if self._random.random() < self.drop:
+                self.dropped += 1
+                return
+            delay = max(self.delay + self._random.uniform(-self.jitter, self.jitter), 0)
+            reply = b'\xff\x55' + bytes((extID, 0x02)) + _FLOAT.pack(value) + b'\r\n'
+            self._seq += 1
+            heapq.heappush(self._replies, (now + delay, self._seq, reply))
+        elif action == _RUN:
+            command = now, device, self._decode(device, args)
+            self.commands.append(command)
+            if self._on_command is not None:
+                self._on_command(*command)
+
+    @staticmethod
+    def _decode(device, args):
+        try:
+            if device == MOVE:
+                left, right = _MOVE.unpack(args)
+                return -left, right
+            if device == MOTOR:
+                return args[0], _SHORT.unpack(args[1:3])[0]
+            if device == BUZZER:
+                return _BUZZER.unpack(args)
+            if device == SEVSEG:
+                return args[0], _FLOAT.unpack(args[1:5])[0]
+        except struct.error:
+            pass
+        return tuple(args)
+
+
+class HIDModule():
+    """Stand-in for the hid module with an mCore board behind the USB HID dongle.
+
+       The devices it opens talk to ``simulator``, whose values, delays and
+       command log apply as on the serial port; the simulator need not be
+       started. Reports written and read are counted, and the stream bytes
+       of the last ``log`` reports written are kept in ``reports``. A report
+       read carries the replies due that fit into it whole, or with ``chunk``
+       set the next ``chunk`` bytes of them, splitting replies over reports.
+    """
+
+    def __init__(self, simulator=None, vendor_id=0x0416, product_id=0xffff, chunk=None, log=1000):
+        self.simulator = mCoreSimulator() if simulator is None else simulator
+        self.vendor_id = vendor_id
+        self.product_id = product_id
+        self.chunk = chunk
+        self.written = 0
+        self.received = 0
+        self.reports = deque(maxlen=log)
+        self._cond = threading.Condition()
+        # Reply bytes due but not read yet when splitting replies
+        self._stream = bytearray()
+
+    def device(self):
+        return _HIDDevice(self)
+
+
+class _HIDDevice():
+    def __init__(self, module):
+        self._module = module
+        self._open = False
+        self._nonblocking = False
+
+    def open(self, vendor_id, product_id):
+        if (vendor_id, product_id) != (self._module.vendor_id, self._module.product_id):
+            raise OSError('open failed')
+        self._open = True
+
+    def set_nonblocking(self, nonblocking):
+        self._nonblocking = bool(nonblocking)
+        return 0
+
+    def write(self, data):
+        if not self._open:
+            raise ValueError('not open')
+        data = bytes(data)
+        # Report ID, length and up to 63 bytes of the stream
+        if len(data) > 65 or len(data) < 2 or data[1] > len(data) - 2:
+            raise OSError('invalid report')
+        module = self._module
+        with module._cond:
+            module.simulator._receive(data[2:2 + data[1]], time.monotonic())
+            module.reports.append(data[2:2 + data[1]])
+            module.written += 1
+            module._cond.notify_all()
+        return len(data)
+
+    def read(self, max_length, timeout_ms=0):
+        if not self._open:
+            raise ValueError('not open')
+        module = self._module
+        replies = module.simulator._replies
+        if timeout_ms > 0:
+            deadline = time.monotonic() + timeout_ms / 1000
+        else:
+            deadline = time.monotonic() if self._nonblocking else None
+        with module._cond:
+            while True:
+                now = time.monotonic()
+                if module._stream or replies and replies[0][0] <= now:
+                    break
+                wait = None if deadline is None else deadline - now
+                if replies:
+                    wait = replies[0][0] - now if wait is None else min(wait, replies[0][0] - now)
+                if wait is not None and wait <= 0:
+                    return []
+                module._cond.wait(wait)
+
+            data = bytearray()
+            if module.chunk is None:
+                # The dongle forwards as many replies as fit into one report
+                while replies and replies[0][0] <= now and len(data) + len(replies[0][2]) < max_length:
+                    data += heapq.heappop(replies)[2]
+                    module.simulator.replies += 1
+            else:
+                while replies and replies[0][0] <= now:
+                    module._stream += heapq.heappop(replies)[2]
+                    module.simulator.replies += 1
+                size = min(module.chunk, max_length - 1)
+                data += module._stream[:size]
+                del module._stream[:size]
+            module.received += 1
+        return [len(data)] + list(data) + [0] * (max_length - 1 - len(data))
+
+    def close(self):
+        self._open = False
+
+
+class INA219Bus():
+    """smbus.SMBus stand-in with an INA219 power monitor behind it.
+
+       The chip reads ``bus_voltage`` volts and ``current`` amperes through
+       a ``shunt`` ohm resistor. A conversion takes ``conversion_time``
+       seconds. Every I2C read and write is counted in ``transactions``.
+    """
+
+    def __init__(self, bus_voltage=7.4, current=0.3, shunt=0.1, conversion_time=0.034):
+        self.bus_voltage = bus_voltage
+        self.current = current
+        self.shunt = shunt
+        self.conversion_time = conversion_time
+        self.transactions = 0
+        self.reset()
+
+    def reset(self):
+        """Power cycles the chip, which loses its config and calibration."""
+        self.registers = {0x00: 0x399F, 0x05: 0}
+        self._started = time.monotonic()
+        self._cleared = self._started
+        self._triggered = None
+
+    def _mode(self):
+        return self.registers[0x00] & 0x07
+
+    def _ready(self, now):
+        mode = self._mode()
+        if mode >= 0x05:
+            # The last conversion of those running back to back since the start
+            converted = self._started + (now - self._started) // self.conversion_time * self.conversion_time
+        elif 0x00 < mode < 0x04 and self._triggered is not None and now >= self._triggered:
+            converted = self._triggered
+        else:
+            return False
+        return converted > self._cleared
+
+    def read_i2c_block_data(self, addr, register, length):
+        self.transactions += 1
+        now = time.monotonic()
+        shunt = int(round(self.current * self.shunt / 0.00001))
+        shunt = max(min(shunt, 32000), -32000)
+        bus = int(self.bus_voltage / 0.004)
+        current = shunt * self.registers[0x05] // 4096
+        if register == 0x01:
+            value = shunt
+        elif register == 0x02:
+            value = bus << 3 | (0x02 if self._ready(now) else 0) | (0x01 if abs(shunt) >= 32000 else 0)
+        elif register == 0x03:
+            value = abs(current) * bus // 5000
+            self._cleared = now
+        elif register == 0x04:
+            value = current
+        else:
+            value = self.registers.get(register, 0)
+        value &= 0xffff
+        return [value >> 8, value & 0xff]
+
+    def write_i2c_block_data(self, addr, register, data):
+        self.transactions += 1
+        self.registers[register] = data[0] << 8 | data[1]
+        if register == 0x00 and 0x00 < self._mode() < 0x04:
+            self._triggered = time.monotonic() + self.conversion_time
+
+
+class MJPEGServer():
+    """Stand-in for mjpg_streamer serving ``?action=stream`` and ``?action=snapshot`` over HTTP.
+
+       It makes ``fps`` frames a second of ``size`` bytes, starting and
+       ending like a JPEG, and sends them as mjpg_streamer does. Frames
+       made and sent and requests served are counted.
+    """
+
+    BOUNDARY = b'boundarydonotcross'
+
+    def __init__(self, fps=30, size=40000, port=0, seed=None):
+        self.fps = fps
+        self.size = size
+        self.frames = 0
+        self.sent = 0
+        self.requests = 0
+        self._random = random.Random(seed)
+        self._cond = threading.Condition()
+        self._frame = None
+        self._stopped = threading.Event()
+        self._sock = socket.create_server(('127.0.0.1', port))
+        self.port = self._sock.getsockname()[1]
+
+    def start(self):
+        # A few different frames, so that nothing can tell them apart by size alone
+        self._images = [b'\xff\xd8' + self._random.randbytes(self.size - 4 - i) + b'\xff\xd9' for i in range(4)]
+        threading.Thread(target=self._capture, daemon=True).start()
+        threading.Thread(target=self._accept, daemon=True).start()
+
+    def close(self):
+        self._stopped.set()
+        with self._cond:
+            self._cond.notify_all()
+        self._sock.close()
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def _capture(self):
+        start = time.monotonic()
+        while not self._stopped.wait(max(start + (self.frames + 1) / self.fps - time.monotonic(), 0)):
+            now = time.time()
+            with self._cond:
+                self._frame = (self.frames, now, self._images[self.frames % len(self._images)])
+                self.frames += 1
+                self._cond.notify_all()
+
+    def _accept(self):
+        while not self._stopped.is_set():
+            try:
+                conn, _ = self._sock.accept()
+            except OSError:
+                return
+            threading.Thread(target=self._serve, args=(conn,), daemon=True).start()
+
+    def _serve(self, conn):
+        with conn:
+            try:
+                request = b''
+                while b'\r\n\r\n' not in request:
+                    data = conn.recv(4096)
+                    if not data:
+                        return
+                    request += data
+                self.requests += 1
+                if b'action=stream' in request.split(b'\r\n', 1)[0]:
+                    self._stream(conn)
+                else:
+                    self._snapshot(conn)
+            except OSError:
+                pass
+
+    def _next(self, seq):
+        with self._cond:
+            self._cond.wait_for(lambda: self._stopped.is_set() or self._frame is not None and self._frame[0] != seq)
+            return None if self._stopped.is_set() else self._frame
+
+    @staticmethod
+    def _part_headers(stamp, image):
+        return 'Content-Type: image/jpeg\r\nContent-Length: {}\r\nX-Timestamp: {:.6f}\r\n\r\n'.format(
+            len(image), stamp).encode()
+
+    def _stream(self, conn):
+        conn.sendall(b'HTTP/1.0 200 OK\r\nConnection: close\r\nServer: MJPG-Streamer/0.2\r\n'
+                     b'Content-Type: multipart/x-mixed-replace;boundary=' + self.BOUNDARY + b'\r\n\r\n'
+                     b'--' + self.BOUNDARY + b'\r\n')
+        seq = None
+        while True:
+            frame = self._next(seq)
+            if frame is None:
+                return
+            seq, stamp, image = frame
+            conn.sendall(self._part_headers(stamp, image) + image + b'\r\n--' + self.BOUNDARY + b'\r\n')
+            self.sent += 1
+
+    def _snapshot(self, conn):
+        # mjpg_streamer answers with the next frame captured
+        with self._cond:
+            seq = None if self._frame is None else self._frame[0]
+        frame = self._next(seq)
+        if frame is None:
+            return
+        _, stamp, image = frame
+        conn.sendall(b'HTTP/1.0 200 OK\r\nConnection: close\r\nServer: MJPG-Streamer/0.2\r\n'
+                     b'Content-Type: image/jpeg\r\nContent-Length: ' + str(len(image)).encode() + b'\r\n'
+                     b'X-Timestamp: ' + '{:.6f}'.format(stamp).encode() + b'\r\n\r\n' + image)
+        self.sent += 1
+
+
+_NAMES = {ULTRASONIC: 'ultrasonic', LIGHT: 'light', MOVE: 'move', RGBLED: 'rgbled', SEVSEG: 'sevseg',
+          MOTOR: 'motor', SERVO: 'servo', IR: 'ir', LINEFOLLOWER: 'linefollower', BUTTON: 'button',
+          BUZZER: 'buzzer'}
+
+
+def _parse_commandline_arguments():
+    parser = argparse.ArgumentParser(description='Virtual mCore board')
+
+    parser.add_argument("-d", "--distance", dest="distance", type=float, required=False, default=40.0,
+                        help="Ultrasonic sensor reading in cm")
+    parser.add_argument("-l", "--light", dest="light", type=float, required=False, default=500.0,
+                        help="Light sensor reading")
+    parser.add_argument("--delay", dest="delay", type=float, required=False, default=0.0,
+                        help="Seconds before a request is answered")
+    parser.add_argument("--jitter", dest="jitter", type=float, required=False, default=0.0,
+                        help="Seconds the reply delay varies by")
+    parser.add_argument("--drop", dest="drop", type=float, required=False, default=0.0,
+                        help="Share of requests left unanswered")
+    parser.add_argument("--baudrate", dest="baudrate", type=int, required=False, default=115200,
+                        help="Serial link speed the replies are limited to")
+
+    args = parser.parse_args()
+    return parser, args
+
+
+def main():
+    parser, args = _parse_commandline_arguments()
+
+    def on_command(t, device, command):
+        print("{:.3f} {} {}".format(t, _NAMES.get(device, hex(device)), command))
+
+    simulator = mCoreSimulator({ULTRASONIC: args.distance, LIGHT: args.light},
+                               args.delay, args.jitter, args.drop, args.baudrate, on_command=on_command)
+    with simulator:
+        print("{} on {}".format(parser.description, simulator.port))
+        try:
+            while True:
+                time.sleep(1)
+        except KeyboardInterrupt:
+            pass
+
+
+if __name__ == '__main__':
+    main()
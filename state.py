@@ -0,0 +1,88 @@
+from itertools import count
+from time import monotonic
+
+
+class Reading:
+    """A value with the monotonic time it was read and a sequence number.
+
+       Readings are never changed once made, so they can be handed between
+       threads without a lock.
+    """
+
+    __slots__ = ('value', 'time', 'seq')
+
+    def __init__(self, value, time, seq):
+        self.value = value
+        self.time = time
+        self.seq = seq
+
+
+_NONE = Reading(None, None, 0)
+
+
+class State:
+    """The readings of a store at one instant."""
+
+    __slots__ = ('time', '_readings', '_limits')
+
+    def __init__(self, time, readings, limits):
+        self.time = time
+        self._readings = readings
+        self._limits = limits
+
+    def __getitem__(self, name):
+        return self._readings[name]
+
+    def age(self, name):
+        """Seconds since the field was written, or None if it never was."""
+        reading = self._readings[name]
+        return None if reading.time is None else self.time - reading.time
+
+    def stale(self, name):
+        """Whether the field was never written or is older than its limit."""
+        age = self.age(name)
+        limit = self._limits.get(name)
+        return age is None or limit is not None and age > limit
+
+    def value(self, name):
+        """The value of the field, or None if it is stale."""
+        return None if self.stale(name) else self._readings[name].value
+
+
+class StateStore:
+    """Latest readings of named fields, each written by a single thread.
+
+       A write replaces the reading of its field with a new one, which
+       needs no lock as long as no two threads write the same field.
+       ``snapshot`` reads all fields twice and retries until nothing changed
+       in between, so it returns readings that all held at the same instant.
+       Readings older than ``limits[name]`` seconds of ``clock`` count as
+       stale.
+    """
+
+    def __init__(self, fields, limits=None, clock=monotonic):
+        self.limits = dict(limits or {})
+        self._clock = clock
+        self._fields = tuple(fields)
+        self._readings = dict.fromkeys(self._fields, _NONE)
+        self._seq = count(1)
+        self.retries = 0
+
+    def write(self, name, value, time=None):
+        if name not in self._readings:
+            raise KeyError(name)
+        self._readings[name] = Reading(value, self._clock() if time is None else time, next(self._seq))
+
+    def read(self, name):
+        return self._readings[name]
+
+    def snapshot(self):
+        readings = self._readings
+        fields = self._fields
+        first = [readings[name] for name in fields]
+        while True:
+            second = [readings[name] for name in fields]
+            if all(a is b for a, b in zip(first, second)):
+                return State(self._clock(), dict(zip(fields, first)), self.limits)
+            self.retries += 1
+            first = second
@@ -0,0 +1,172 @@
+import gzip
+import json
+import threading
+from time import monotonic, time
+
+
+class Broadcaster:
+    """Pushes state changes to any number of Server-Sent Events viewers.
+
+       Producers report values with ``update``. A single thread collects
+       the changes and, at most ``max_rate`` times a second, serializes
+       them once into a delta event that all viewers share. A viewer that
+       connects or falls behind gets the whole state instead. Viewers idle
+       for ``keepalive`` seconds are sent a comment so that proxies keep
+       the connection open and closed connections are noticed.
+    """
+
+    def __init__(self, max_rate=5, keepalive=15):
+        self.period = 1 / max_rate
+        self.keepalive = keepalive
+        self.viewers = 0
+        self.events = 0
+        self._cond = threading.Condition()
+        self._state = {}
+        self._pending = {}
+        self._version = 0
+        self._delta = None
+        self._full = None
+        self._published = 0
+        self._closed = False
+
+    def update(self, values):
+        """Records the values that changed; cheap enough to call on every sample."""
+        with self._cond:
+            if not self.viewers:
+                # Nobody watching: only keep the state for the next viewer
+                if self._pending:
+                    self._pending.update(values)
+                elif any(self._state.get(key) != value for key, value in values.items()):
+                    self._state.update(values)
+                    self._full = None
+                return
+            state = self._state
+            pending = self._pending
+            for key, value in values.items():
+                if key in pending or state.get(key) != value:
+                    pending[key] = value
+            if pending:
+                self._cond.notify_all()
+
+    def start(self):
+        self._closed = False
+        self._th = threading.Thread(target=self._run, daemon=True)
+        self._th.start()
+
+    def close(self):
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+        if hasattr(self, '_th'):
+            self._th.join(1)
+
+    def _run(self):
+        with self._cond:
+            while not self._closed:
+                if not self._pending:
+                    self._cond.wait()
+                    continue
+                delay = self._published + self.period - monotonic()
+                if delay > 0:
+                    # Let more changes accumulate
+                    self._cond.wait(delay)
+                    continue
+                self._publish()
+
+    def _publish(self):
+        changes = {key: value for key, value in self._pending.items() if self._state.get(key) != value}
+        self._pending = {}
+        if not changes:
+            return
+        self._state.update(changes)
+        self._version += 1
+        self._delta = self._event(changes)
+        self._full = None
+        self._published = monotonic()
+        self.events += 1
+        self._cond.notify_all()
+
+    def _event(self, values):
+        data = json.dumps(values, separators=(',', ':'))
+        return 'id: {}\ndata: {}\n\n'.format(self._version, data).encode()
+
+    def stream(self):
+        """Yields the events of one viewer until the broadcaster is closed."""
+        with self._cond:
+            self.viewers += 1
+        try:
+            version = None
+            while True:
+                with self._cond:
+                    if not self._cond.wait_for(lambda: self._closed or self._version != version, self.keepalive):
+                        data = b': keepalive\n\n'
+                    elif self._closed:
+                        return
+                    elif version == self._version - 1:
+                        data = self._delta
+                        version = self._version
+                    else:
+                        if self._full is None:
+                            self._full = self._event(self._state)
+                        data = self._full
+                        version = self._version
+                yield data
+        finally:
+            with self._cond:
+                self.viewers -= 1
+
+    def stats(self):
+        return {
+            'viewers': self.viewers,
+            'events': self.events,
+            'rate': 1 / self.period,
+        }
+
+
+class Snapshot:
+    """One version of the state, serialized on first use and then served as is."""
+
+    __slots__ = ('version', 'etag', 'state', '_body', '_gzip')
+
+    def __init__(self, tag, version, state):
+        self.version = version
+        self.etag = '"{}-{}"'.format(tag, version)
+        self.state = state
+        self._body = None
+        self._gzip = None
+
+    def body(self):
+        if self._body is None:
+            self._body = json.dumps(self.state, separators=(',', ':')).encode()
+        return self._body
+
+    def gzip(self):
+        if self._gzip is None:
+            self._gzip = gzip.compress(self.body(), mtime=0)
+        return self._gzip
+
+
+class SnapshotCache:
+    """The latest snapshot of a state made of groups of values.
+
+       Each producer replaces its group as a whole, so a snapshot never
+       mixes values of two samples. Snapshots are never changed once made.
+    """
+
+    def __init__(self, groups=()):
+        # Tells the versions of this process apart from those of a previous one
+        self._tag = '{:x}'.format(int(time()))
+        self._lock = threading.Lock()
+        self._snapshot = Snapshot(self._tag, 0, {group: {} for group in groups})
+
+    def get(self):
+        return self._snapshot
+
+    def update(self, group, values):
+        with self._lock:
+            snapshot = self._snapshot
+            if snapshot.state.get(group) == values:
+                return
+            state = dict(snapshot.state)
+            state[group] = values
+            self._snapshot = Snapshot(self._tag, snapshot.version + 1, state)
@@ -0,0 +1,161 @@
+import os
+import shutil
+import struct
+import tempfile
+import unittest
+import inputs
+
+# struct js_event of linux/joystick.h
+_EVENT = struct.Struct('=IhBB')
+_BUTTON = 0x01
+_AXIS = 0x02
+_INIT = 0x80
+
+
+class JoystickInputTest(unittest.TestCase):
+    """JoystickInput fed with js_event records through a named pipe in place of /dev/input/js0."""
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.writers = []
+        self.writer = self._plug('js0')
+        self.joystick = inputs.JoystickInput(0.05, 0.02, os.path.join(self.directory, 'js*'),
+                                             rescan=0.01)
+
+    def tearDown(self):
+        self.joystick.close()
+        for fd in self.writers:
+            os.close(fd)
+        shutil.rmtree(self.directory)
+
+    def _plug(self, name):
+        path = os.path.join(self.directory, name)
+        os.mkfifo(path)
+        # Opened for reading too, so that neither end waits for the other
+        fd = os.open(path, os.O_RDWR | os.O_NONBLOCK)
+        self.writers.append(fd)
+        return fd
+
+    def _unplug(self, name, fd):
+        os.remove(os.path.join(self.directory, name))
+        self.writers.remove(fd)
+        os.close(fd)
+
+    def _send(self, kind, number, value, fd=None):
+        os.write(self.writer if fd is None else fd, _EVENT.pack(0, value, kind, number))
+
+    def test_axes_are_scaled_to_one(self):
+        self._send(_AXIS, 0, 16384)
+        self._send(_AXIS, 1, -32768)
+        self.assertEqual(self.joystick.read(), (0.5, -1.0, False))
+        self._send(_AXIS, 0, 32767)
+        self.assertAlmostEqual(self.joystick.read()[0], 1.0, 4)
+
+    def test_axis_values_within_the_deadband_read_as_zero(self):
+        self._send(_AXIS, 0, 16384)
+        self.joystick.read()
+        self._send(_AXIS, 0, 1500)
+        self.assertEqual(self.joystick.read(), (0.0, 0.0, False))
+        self._send(_AXIS, 1, -1500)
+        self.assertEqual(self.joystick.read(), (0.0, 0.0, False))
+
+    def test_changes_below_the_threshold_are_ignored(self):
+        self._send(_AXIS, 1, 16384)
+        self.assertTrue(self.joystick.wait(0.5))
+        self.assertEqual(self.joystick.read()[1], 0.5)
+
+        # 0.01 away
+        self._send(_AXIS, 1, 16712)
+        self.assertFalse(self.joystick.wait(0.05))
+        self.assertEqual(self.joystick.read()[1], 0.5)
+
+        # 0.03 away
+        self._send(_AXIS, 1, 17367)
+        self.assertTrue(self.joystick.wait(0.5))
+        self.assertAlmostEqual(self.joystick.read()[1], 0.53, 4)
+
+    def test_full_deflection_passes_the_threshold(self):
+        self._send(_AXIS, 0, 32000)
+        self.joystick.read()
+        self._send(_AXIS, 0, 32767)
+        self.assertTrue(self.joystick.wait(0.5))
+
+    def test_changed_is_set_by_the_first_move_until_read(self):
+        self.assertIsNone(self.joystick.changed)
+        self._send(_AXIS, 0, 16384)
+        self.joystick.wait(0.5)
+        changed = self.joystick.changed
+        self.assertIsNotNone(changed)
+        self._send(_AXIS, 0, -16384)
+        self.joystick.read()
+        self.assertEqual(self.joystick.changed, changed)
+
+    def test_button_press_sounds_the_horn_once(self):
+        self._send(_BUTTON, 3, 1)
+        self.assertTrue(self.joystick.wait(0.5))
+        self.assertEqual(self.joystick.read(), (0.0, 0.0, True))
+        self.assertEqual(self.joystick.read(), (0.0, 0.0, False))
+
+        self._send(_BUTTON, 3, 0)
+        self.assertFalse(self.joystick.wait(0.05))
+        self.assertEqual(self.joystick.read(), (0.0, 0.0, False))
+
+    def test_axes_past_the_second_are_ignored(self):
+        self._send(_AXIS, 2, 32767)
+        self._send(_AXIS, 3, -32768)
+        self.assertFalse(self.joystick.wait(0.05))
+        self.assertEqual(self.joystick.read(), (0.0, 0.0, False))
+
+    def test_init_events_set_the_axes_without_sounding_the_horn(self):
+        # The driver reports the state of every button and axis on open
+        self._send(_BUTTON | _INIT, 0, 1)
+        self._send(_AXIS | _INIT, 0, -16384)
+        self._send(_AXIS | _INIT, 1, 16384)
+        self.assertEqual(self.joystick.read(), (-0.5, 0.5, False))
+
+    def test_partial_events_are_kept_until_complete(self):
+        event = _EVENT.pack(0, 16384, _AXIS, 0)
+        os.write(self.writer, event[:5])
+        self.assertEqual(self.joystick.read(), (0.0, 0.0, False))
+        os.write(self.writer, event[5:])
+        self.assertEqual(self.joystick.read(), (0.5, 0.0, False))
+
+    def test_unplugged_joystick_stops_the_car(self):
+        self._send(_AXIS, 1, -32768)
+        self.assertEqual(self.joystick.read()[1], -1.0)
+
+        self._unplug('js0', self.writer)
+        self.assertTrue(self.joystick.wait(0.5))
+        self.assertEqual(self.joystick.read(), (0.0, 0.0, False))
+
+    def test_joystick_plugged_in_again_takes_over(self):
+        self._unplug('js0', self.writer)
+        self.joystick.read()
+
+        fd = self._plug('js1')
+        self.assertTrue(self.joystick.wait(0.5))
+        self._send(_AXIS, 1, -16384, fd)
+        self.assertTrue(self.joystick.wait(0.5))
+        self.assertEqual(self.joystick.read(), (0.0, -0.5, False))
+
+    def test_last_joystick_plugged_in_drives(self):
+        fd = self._plug('js1')
+        self.assertTrue(self.joystick.wait(0.5))
+        self._send(_AXIS, 0, 16384)
+        self._send(_AXIS, 0, -16384, fd)
+        self.assertEqual(self.joystick.read(), (-0.5, 0.0, False))
+
+    def test_joystick_still_plugged_in_takes_over(self):
+        fd = self._plug('js1')
+        self.assertTrue(self.joystick.wait(0.5))
+        self._unplug('js1', fd)
+        self.assertTrue(self.joystick.wait(0.5))
+        self.assertEqual(self.joystick.read(), (0.0, 0.0, False))
+
+        self._send(_AXIS, 0, 16384)
+        self.assertTrue(self.joystick.wait(0.5))
+        self.assertEqual(self.joystick.read(), (0.5, 0.0, False))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,106 @@
+import time
+import unittest
+import control
+import link
+import mBot
+import metrics
+import sim
+import state
+import ticker
+
+# Fast enough for a dozen requests in every update
+_RATES = {'ultrasonic': (50, 50), 'light': (20, 20), 'button': (20, 20)}
+_INTERVAL = 0.2
+
+
+class LinkMonitorTest(unittest.TestCase):
+    """LinkMonitor driving the poll and loop rates of a car over a simulated link that slows down and drops."""
+
+    def setUp(self):
+        self.simulator = sim.mCoreSimulator(seed=1)
+        self.simulator.start()
+        self.bot = mBot.mBot()
+        self.bot.createSerial(self.simulator.port)
+        self.bot.start()
+        store = state.StateStore(control.SENSORS, control.max_ages)
+        self.sensors = control.sensor_poller(self.bot, _RATES, *control.store_writers(store))
+        self.ticker = ticker.Ticker(20)
+        self.timer = metrics.LoopTimer(self.ticker.period)
+        self.monitor = link.LinkMonitor(self.bot, self.sensors, self.ticker, self.timer, interval=_INTERVAL,
+                                        min_scale=0.25)
+        self.sensors.start()
+        self.monitor.update()
+
+    def tearDown(self):
+        self.sensors.close()
+        self.bot.close()
+        self.simulator.close()
+
+    def _update(self, count):
+        """Runs ``count`` updates and returns the scale and congestion reason after each."""
+        results = []
+        for _ in range(count):
+            time.sleep(_INTERVAL)
+            self.assertTrue(self.monitor.update())
+            results.append((self.monitor.scale, self.monitor.reason))
+            self._check_rates()
+        return results
+
+    def _check_rates(self):
+        scale = self.monitor.scale
+        self.assertEqual(self.sensors.throttle, scale)
+        self.assertAlmostEqual(self.ticker.rate, 20 * scale)
+        self.assertAlmostEqual(self.ticker.period, 1 / (20 * scale))
+        self.assertEqual(self.timer.period, self.ticker.period)
+        rates = self.monitor.stats()['rates']
+        self.assertAlmostEqual(rates['tick'], 20 * scale)
+        self.assertAlmostEqual(rates['ultrasonic'], 50 * scale)
+
+    def test_healthy_link_keeps_full_rates(self):
+        self.assertEqual(self._update(3), [(1.0, None)] * 3)
+        self.assertEqual(self.monitor.congestions, 0)
+        self.assertIsNotNone(self.monitor.rtt)
+
+    def test_slower_replies_cut_the_rates(self):
+        self._update(2)
+        self.simulator.delay = 0.05
+        scale, reason = self._update(2)[-1]
+        self.assertEqual(reason, 'rtt')
+        self.assertLess(scale, 1.0)
+        self.assertGreater(self.monitor.rtt, 0.04)
+
+    def test_lost_replies_cut_the_rates(self):
+        self._update(2)
+        self.simulator.drop = 0.5
+        results = self._update(3)
+        self.assertIn('loss', [reason for _, reason in results])
+        self.assertLess(results[-1][0], 1.0)
+        self.assertGreater(self.monitor.loss, self.monitor.max_loss)
+
+    def test_rates_stop_at_the_minimum_scale(self):
+        self._update(1)
+        self.simulator.drop = 1.0
+        scales = [scale for scale, _ in self._update(7)]
+        self.assertEqual(scales, sorted(scales, reverse=True))
+        self.assertEqual(scales[-1], 0.25)
+        self.assertEqual(min(scales), 0.25)
+        self.assertAlmostEqual(self.ticker.rate, 5)
+
+    def test_rates_recover_once_the_link_is_healthy(self):
+        self._update(1)
+        self.simulator.drop = 1.0
+        self._update(5)
+        self.assertEqual(self.monitor.scale, 0.25)
+
+        self.simulator.drop = 0.0
+        results = self._update(12)
+        self.assertEqual(results[-1], (1.0, None))
+        scales = [scale for scale, _ in results]
+        # Timeouts of requests sent before the link recovered may still cost a step
+        self.assertGreater(scales.index(1.0), 5)
+        self.assertAlmostEqual(self.ticker.rate, 20)
+        self.assertEqual(self.sensors.throttle, 1.0)
+
+
+if __name__ == '__main__':
+    unittest.main()
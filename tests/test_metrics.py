@@ -0,0 +1,76 @@
+import time
+import unittest
+import metrics
+
+try:
+    from prometheus_client.openmetrics.parser import text_string_to_metric_families
+except ImportError:
+    text_string_to_metric_families = None
+
+
+@unittest.skipIf(text_string_to_metric_families is None, "needs prometheus_client")
+class ExpositionTest(unittest.TestCase):
+    """The metrics pages parse as OpenMetrics with the reference parser of Prometheus."""
+
+    def _parse(self, text):
+        return {family.name: family for family in text_string_to_metric_families(text)}
+
+    def test_families_of_every_kind(self):
+        histogram = metrics.Histogram()
+        for value in (0.0001, 0.002, 0.03, 5.0):
+            histogram.record(value)
+        exposition = metrics.Exposition()
+        exposition.counter('mbot_sent_frames', "Frames written to the robot", 12)
+        exposition.counter('mbot_request_timeouts', "Sensor requests unanswered in time", {20: 1, 30: 0}, 'ext_id')
+        exposition.gauge('car_sensor_value', "Last value read", {'ultrasonic': 40.5, 'light': None, 'a"b\\c': 1},
+                         'sensor')
+        exposition.gauge('car_battery_ratio', "State of charge", None)
+        exposition.histogram('car_loop_tick_seconds', "Duration of ticks", histogram)
+        families = self._parse(exposition.text())
+
+        self.assertEqual(families['mbot_sent_frames'].type, 'counter')
+        self.assertEqual([sample.value for sample in families['mbot_sent_frames'].samples], [12])
+        self.assertEqual({sample.labels['ext_id']: sample.value
+                          for sample in families['mbot_request_timeouts'].samples}, {'20': 1, '30': 0})
+        self.assertEqual({sample.labels['sensor']: sample.value for sample in families['car_sensor_value'].samples},
+                         {'ultrasonic': 40.5, 'a"b\\c': 1})
+        self.assertEqual(families['car_battery_ratio'].samples, [])
+        samples = {sample.name: sample for sample in families['car_loop_tick_seconds'].samples
+                   if sample.name != 'car_loop_tick_seconds_bucket'}
+        self.assertEqual(samples['car_loop_tick_seconds_count'].value, 4)
+        self.assertAlmostEqual(samples['car_loop_tick_seconds_sum'].value, 5.0321)
+
+    def test_car_metrics_with_a_bot_and_link(self):
+        import car
+        import control
+        import link
+        import mBot
+        import sim
+        import ticker
+
+        with sim.mCoreSimulator() as simulator:
+            bot = mBot.mBot()
+            bot.createSerial(simulator.port)
+            bot.start()
+            sensors = control.sensor_poller(bot, control.poll_rates, car._on_distance, car._on_light, car._on_button)
+            saved = car._bot, car._sensors, car._controller, car._link
+            try:
+                car._bot, car._sensors = bot, sensors
+                car._controller = control.Controller(bot, None, car._state, car._loop_timer, sensors)
+                car._link = link.LinkMonitor(bot, sensors, ticker.Ticker(20))
+                sensors.start()
+                time.sleep(0.3)
+                families = self._parse(car._exposition())
+            finally:
+                car._bot, car._sensors, car._controller, car._link = saved
+                sensors.close()
+                bot.close()
+
+        self.assertEqual(families['car_sensor_value'].type, 'gauge')
+        self.assertGreater(families['mbot_requests'].samples[0].value, 0)
+        self.assertIn('mbot_link_rtt_seconds', families)
+        self.assertIn('car_loop_tick_seconds', families)
+
+
+if __name__ == '__main__':
+    unittest.main()
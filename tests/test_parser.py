@@ -0,0 +1,63 @@
+import struct
+import unittest
+import mBot
+
+
+def _float(extID, value):
+    return b'\xff\x55' + bytes((extID, 2)) + struct.pack('<f', value) + b'\r\n'
+
+
+def _string(extID, text):
+    return b'\xff\x55' + bytes((extID, 4, len(text))) + text.encode() + b'\r\n'
+
+
+class ParserTest(unittest.TestCase):
+    """mParser splitting the byte stream of mCore into replies."""
+
+    def setUp(self):
+        self.replies = []
+        self.parser = mBot.mParser(lambda extID, value: self.replies.append((extID, value)))
+
+    def _feed(self, data, size=None):
+        for i in range(0, len(data), size or len(data)):
+            self.parser.feed(data[i:i + (size or len(data))])
+
+    def test_replies_of_all_types(self):
+        self._feed(b'\xff\x55\x01\x01\x07\r\n' + _float(2, 12.5) + b'\xff\x55\x03\x03\x39\x30\r\n'
+                   + _string(4, 'hello') + b'\xff\x55\x05\x05' + struct.pack('<f', 1.5) + b'\r\n'
+                   + b'\xff\x55\x06\x05' + struct.pack('<d', 2.5) + b'\r\n')
+        self.assertEqual(self.replies, [(1, 7), (2, 12.5), (3, 12345), (4, 'hello'), (5, 1.5), (6, 2.5)])
+        self.assertEqual(self.parser.dropped, 0)
+
+    def test_replies_split_over_reads(self):
+        data = b''.join(_float(20, 40.0) + _string(30, 'mBot') for _ in range(5))
+        self._feed(data, 3)
+        self.assertEqual(self.replies, [(20, 40.0), (30, 'mBot')] * 5)
+        self.assertEqual(self.parser.dropped, 0)
+
+    def test_noise_between_replies_is_dropped(self):
+        self._feed(b'\x00\x13\xff' + _float(20, 40.0) + b'\xff\x55\x14\x09\x00' + _float(21, 41.0))
+        self.assertEqual(self.replies, [(20, 40.0), (21, 41.0)])
+        self.assertEqual(self.parser.dropped, 8)
+
+    def test_noise_like_the_header_of_a_long_string_does_not_hold_replies_back(self):
+        # A string of 200 bytes would end only after 206 bytes
+        self._feed(b'\xff\x55\x14\x04\xc8')
+        for _ in range(15):
+            self._feed(_float(20, 40.0))
+        self.assertEqual(self.replies, [(20, 40.0)] * 15)
+        self.assertEqual(self.parser.dropped, 5)
+        self.assertEqual(len(self.parser._buffer), 0)
+
+    def test_noise_like_a_header_before_a_reply_read_in_pieces(self):
+        self._feed(b'\xff\x55\x14\x04\xc8' + _float(20, 40.0) * 3, 4)
+        self.assertEqual(self.replies, [(20, 40.0)] * 3)
+
+    def test_string_containing_a_reply_is_read_whole(self):
+        text = 'ab' + _float(20, 40.0).decode('latin-1')
+        self._feed(b'\xff\x55\x1e\x04' + bytes((len(text),)) + text.encode('latin-1') + b'\r\n')
+        self.assertEqual(self.replies, [(30, text.encode('latin-1').decode('ascii', 'replace'))])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,22 @@
+import tempfile
+import unittest
+import recorder
+import replay
+
+
+class ReadFlightTest(unittest.TestCase):
+    """Replies in a flight log are replayed as the values of the sensors polled on their extIDs."""
+
+    def test_replies_on_every_ext_id_of_a_sensor(self):
+        with tempfile.TemporaryDirectory() as directory:
+            with recorder.FlightRecorder(directory, segment_size=1 << 16, segments=2) as flight:
+                flight.tick(0.0, -1.0, 0, 0)
+                for extID, value in ((20, 40.0), (21, 39.5), (30, 300.0), (31, 120.0), (41, 0.0), (50, 1.0)):
+                    flight.received(extID, value)
+            events = [(kind, value) for _, kind, value in replay.read_flight(directory)]
+        self.assertEqual(events, [('axes', (0.0, -1.0, False)), ('distance', 40.0), ('distance', 39.5),
+                                  ('light', 300.0), ('light', 120.0), ('button', 0.0)])
+
+
+if __name__ == '__main__':
+    unittest.main()
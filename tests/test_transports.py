@@ -0,0 +1,243 @@
+import struct
+import threading
+import time
+import unittest
+import mBot
+import sim
+
+
+def _move(left, right):
+    return b'\xff\x55\x07\x00\x02\x05' + struct.pack('<hh', -left, right)
+
+
+def _buzzer(frequency, milliseconds):
+    return b'\xff\x55\x07\x00\x02\x22' + struct.pack('<HH', frequency, milliseconds)
+
+
+def _led(red, green, blue):
+    return b'\xff\x55\x09\x00\x02\x08' + bytes((7, 2, 0, red, green, blue))
+
+
+def _ultrasonic(extID, port=3):
+    return bytes((0xff, 0x55, 0x04, extID, 0x01, 0x01, port))
+
+
+def _reply(extID, value):
+    return b'\xff\x55' + bytes((extID, 0x02)) + struct.pack('<f', value) + b'\r\n'
+
+
+def _read(test, bot, extIDs, send=None):
+    """Requests the distance on each extID, calls ``send`` and returns the values read."""
+    values = {}
+    done = threading.Event()
+
+    def on_value(extID, value):
+        values[extID] = value
+        if len(values) == len(extIDs):
+            done.set()
+
+    for extID in extIDs:
+        bot.requestUltrasonicSensor(extID, 3, lambda value, extID=extID: on_value(extID, value))
+    if send is not None:
+        send()
+    test.assertTrue(done.wait(2))
+    return values
+
+
+def _wait_for(condition, timeout=2):
+    deadline = time.monotonic() + timeout
+    while not condition() and time.monotonic() < deadline:
+        time.sleep(0.01)
+    return condition()
+
+
+class _FrameChecks:
+    """Frame level checks of mBot over a transport to the simulator.
+
+       ``_connect`` creates the device of the bot on ``self.simulator``,
+       ``limit`` is the longest frame the transport takes, None for any.
+    """
+
+    limit = None
+
+    def setUp(self):
+        self.simulator = sim.mCoreSimulator(values={sim.ULTRASONIC: 12.5})
+        self.bot = mBot.mBot()
+        self._connect()
+        self.bot.start()
+
+    def tearDown(self):
+        self.bot.close()
+        self._disconnect()
+
+    def test_encoded_frames_reach_the_board(self):
+        self.bot.doMove(100, 90)
+        self.bot.doRGBLedOnBoard(0, 253, 172, 10)
+        self.bot.doBuzzer(123, 250)
+        self.assertEqual(_read(self, self.bot, [20]), {20: 12.5})
+
+        self.assertTrue(_wait_for(lambda: len(self.simulator.commands) == 3))
+        commands = {device: arguments for _, device, arguments in self.simulator.commands}
+        self.assertEqual(commands, {sim.MOVE: (100, 90), sim.RGBLED: (7, 2, 0, 253, 172, 10),
+                                    sim.BUZZER: (123, 250)})
+        self.assertEqual(self.simulator.requests, 1)
+
+    def test_replies_split_over_reads_are_put_back_together(self):
+        # The board stays silent; its replies come in pieces of 4 bytes
+        self.simulator.values[sim.ULTRASONIC] = None
+
+        def send():
+            stream = b''.join(_reply(extID, 12.5) for extID in (20, 21, 22))
+            for index in range(0, len(stream), 4):
+                self.simulator.send(stream[index:index + 4], 0.01 * index)
+
+        values = _read(self, self.bot, [20, 21, 22], send)
+        counters = self.bot.counters()
+
+        self.assertEqual(values, {20: 12.5, 21: 12.5, 22: 12.5})
+        self.assertEqual(counters['framesReceived'], 3)
+        self.assertEqual(counters['bytesDropped'], 0)
+
+    def test_noise_between_replies_is_dropped(self):
+        self.simulator.values[sim.ULTRASONIC] = None
+
+        def send():
+            # Noise looking like the header of a long string reply
+            self.simulator.send(b'\x00\x13\xff\x55\x14\x04\xc8')
+            self.simulator.send(_reply(20, 12.5), 0.02)
+            self.simulator.send(b'\r\n\xff\x55', 0.04)
+            self.simulator.send(_reply(21, 7.0), 0.06)
+
+        values = _read(self, self.bot, [20, 21], send)
+        counters = self.bot.counters()
+
+        self.assertEqual(values, {20: 12.5, 21: 7.0})
+        self.assertEqual(counters['framesReceived'], 2)
+        self.assertGreater(counters['bytesDropped'], 0)
+
+    def test_frame_longer_than_the_transport_takes_leaves_the_writer_running(self):
+        message = b'x' * 60
+        if self.limit is not None and len(message) + 6 > self.limit:
+            with self.assertRaises(ValueError):
+                self.bot.doIROnBoard(message)
+        else:
+            self.bot.doIROnBoard(message)
+            self.assertTrue(_wait_for(lambda: any(device == sim.IR for _, device, _ in self.simulator.commands)))
+        self.assertTrue(self.bot._writer.is_alive())
+        self.assertEqual(_read(self, self.bot, [20]), {20: 12.5})
+
+
+class SerialFrameTest(_FrameChecks, unittest.TestCase):
+    """mBot over the serial port of the simulator."""
+
+    def _connect(self):
+        self.simulator.start()
+        self.bot.createSerial(self.simulator.port)
+
+    def _disconnect(self):
+        self.simulator.close()
+
+
+class HIDFrameTest(_FrameChecks, unittest.TestCase):
+    """mBot over the USB HID dongle in front of the simulator."""
+
+    limit = mBot.mHID.REPORT_SIZE - 1
+
+    def _connect(self):
+        self.module = sim.HIDModule(self.simulator)
+        self.bot.createHID(self.module)
+
+    def _disconnect(self):
+        pass
+
+
+class HIDWriterTest(unittest.TestCase):
+    """Frames queued for the dongle go out packed into reports."""
+
+    def setUp(self):
+        self.module = sim.HIDModule()
+        self.device = mBot.mHID(self.module)
+        self.device.start()
+        self.writer = mBot.mWriter(self.device)
+
+    def tearDown(self):
+        self.writer.close()
+        self.device.close()
+
+    def _send(self):
+        # Frames queued before the writer starts are all waiting at its first write
+        self.writer.start()
+        self.writer.close()
+
+    def test_frames_queued_together_share_a_report(self):
+        self.writer.put(_buzzer(123, 250), mBot.mWriter.SOUND, 'buzzer')
+        self.writer.put(_led(253, 172, 10), mBot.mWriter.DISPLAY, 'led')
+        self.writer.put(_ultrasonic(20), mBot.mWriter.REQUEST, 20)
+        self.writer.put(_move(100, 90), mBot.mWriter.MOTION, 'move')
+        self._send()
+
+        # In the order of priority
+        frames = [_move(100, 90), _ultrasonic(20), _led(253, 172, 10), _buzzer(123, 250)]
+        self.assertEqual(list(self.module.reports), [b''.join(frames)])
+        self.assertLessEqual(len(self.module.reports[0]), mBot.mHID.REPORT_SIZE - 1)
+        self.assertEqual(self.writer.stats()['writes'], 1)
+        self.assertEqual(self.writer.stats()['sent'], 4)
+        devices = [device for _, device, _ in self.module.simulator.commands]
+        self.assertEqual(devices, [sim.MOVE, sim.RGBLED, sim.BUZZER])
+        self.assertEqual(self.module.simulator.requests, 1)
+
+    def test_coalesced_frames_take_one_place_in_the_report(self):
+        for speed in range(10):
+            self.writer.put(_move(speed, speed), mBot.mWriter.MOTION, 'move')
+        self.writer.put(_ultrasonic(20), mBot.mWriter.REQUEST, 20)
+        self._send()
+
+        self.assertEqual(list(self.module.reports), [_move(9, 9) + _ultrasonic(20)])
+        self.assertEqual(self.writer.stats()['coalesced'], 9)
+
+    def test_frame_that_does_not_fit_goes_into_the_next_report(self):
+        frames = [_move(speed, -speed) for speed in range(7)]
+        for index, frame in enumerate(frames):
+            self.writer.put(frame, mBot.mWriter.MOTION, ('move', index))
+        self._send()
+
+        reports = list(self.module.reports)
+        self.assertEqual(reports, [b''.join(frames[:6]), frames[6]])
+        for report in reports:
+            self.assertLessEqual(len(report), mBot.mHID.REPORT_SIZE - 1)
+        self.assertEqual([arguments for _, _, arguments in self.module.simulator.commands],
+                         [(speed, -speed) for speed in range(7)])
+
+    def test_frame_longer_than_a_report_is_refused_when_queued(self):
+        with self.assertRaises(ValueError):
+            self.writer.put(b'\xff\x55\x3f\x00\x02\x0d' + b'x' * 60, mBot.mWriter.DISPLAY, 'ir')
+        self.writer.put(_move(50, 50), mBot.mWriter.MOTION, 'move')
+        self._send()
+
+        self.assertEqual(list(self.module.reports), [_move(50, 50)])
+        self.assertEqual(self.writer.stats()['enqueued'], 1)
+
+
+class HIDBotTest(unittest.TestCase):
+    """mBot over the dongle reads replies out of reports."""
+
+    def test_replies_split_by_the_dongle_are_put_back_together(self):
+        # Every 10 byte reply comes in two or three reports of 4 bytes
+        module = sim.HIDModule(sim.mCoreSimulator(values={sim.ULTRASONIC: 12.5}), chunk=4)
+        bot = mBot.mBot()
+        bot.createHID(module)
+        bot.start()
+        try:
+            values = _read(self, bot, [20, 21, 22])
+            counters = bot.counters()
+        finally:
+            bot.close()
+
+        self.assertEqual(values, {20: 12.5, 21: 12.5, 22: 12.5})
+        self.assertGreaterEqual(module.received, 8)
+        self.assertEqual(counters['framesReceived'], 3)
+        self.assertEqual(counters['bytesDropped'], 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,104 @@
+import os
+import traceback
+from time import monotonic, sleep
+import metrics
+
+SKIP = 'skip'
+CATCH_UP = 'catch-up'
+
+
+class Ticker:
+    """Paces a loop at a fixed rate against deadlines on the monotonic clock.
+
+       Deadlines are fixed multiples of the period from the start, so a long
+       tick does not shift the ticks after it. When ticks fall more than a
+       period behind, ``SKIP`` drops them and ``CATCH_UP`` runs them back to
+       back.
+    """
+
+    def __init__(self, rate, policy=SKIP):
+        self.rate = rate
+        self.period = 1 / rate
+        self.policy = policy
+        self.lateness = metrics.Histogram()
+        self.ticks = 0
+        self.skipped = 0
+        self._deadline = None
+        self._interval = self.period
+        self._last = None
+
+    def remaining(self):
+        """Returns the seconds left until the next tick is due."""
+        if self._deadline is None:
+            self._deadline = monotonic()
+        return self._deadline - monotonic()
+
+    def advance(self):
+        """Starts the tick that is due and schedules the one after it."""
+        now = monotonic()
+        self.lateness.record(max(now - self._deadline, 0))
+        if self._last is not None:
+            self._interval += (now - self._last - self._interval) / 16
+        self._last = now
+        self.ticks += 1
+
+        self._deadline += self.period
+        late = now - self._deadline
+        if late >= 0 and self.policy == SKIP:
+            missed = int(late // self.period) + 1
+            self._deadline += missed * self.period
+            self.skipped += missed
+
+    def set_rate(self, rate):
+        """Changes the rate, starting with the deadline of the next tick."""
+        if self._deadline is not None:
+            self._deadline += 1 / rate - self.period
+        self.rate = rate
+        self.period = 1 / rate
+
+    def wait(self, event=None):
+        """Sleeps until the next tick is due, or until the event is set.
+
+           Returns False if interrupted by the event.
+        """
+        delay = self.remaining()
+        if delay > 0:
+            if event is None:
+                sleep(delay)
+            elif event.wait(delay):
+                return False
+        self.advance()
+        return True
+
+    def stats(self):
+        return {
+            'rate': self.rate,
+            'policy': self.policy,
+            'ticks': self.ticks,
+            'skipped': self.skipped,
+            'achieved': 1 / self._interval if self._interval else 0.0,
+            'lateness': self.lateness.snapshot(),
+        }
+
+
+def set_realtime(cpu=None, priority=None, nice=None):
+    """Pins the calling thread to a CPU and raises its scheduling priority on Linux.
+
+       Returns False if the system refused any of the settings.
+    """
+    settings = []
+    if cpu is not None:
+        settings.append(lambda: os.sched_setaffinity(0, {cpu}))
+    if priority is not None:
+        settings.append(lambda: os.sched_setscheduler(0, os.SCHED_FIFO, os.sched_param(priority)))
+    if nice is not None:
+        settings.append(lambda: os.setpriority(os.PRIO_PROCESS, 0, nice))
+
+    result = True
+    for setting in settings:
+        try:
+            setting()
+        except (OSError, AttributeError):
+            traceback.print_exc()
+            result = False
+    return result